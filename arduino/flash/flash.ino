@@ -18,8 +18,14 @@
  * 'e' camera frame capture HI
  * 'f' camera frame capture LO
  * 'r' sense pClamp recording status
+ * 's' start streaming lick counts
  * 'u' broadcast up signal
  * 'w' wipe lick counter
+ * 'x' stop streaming lick counts
+ *
+ * While streaming, the lick count is sent as a decimal number
+ * followed by '\n' whenever it has changed, at most every
+ * STREAMINTERVAL ms, and the counter is reset.
  */
 
 /* extern "C" void __cxa_pure_virtual() {} */
@@ -41,11 +47,14 @@ static const int bcpin = 4;
 static const int piezopin = A0;
 
 static const int BAUDRATE = 19200;
+static const unsigned long STREAMINTERVAL = 10; /* ms */
 int bcstatus = LOW;
 int lickcounter = 0;
 int lickpiezosum = 0;
 int lickstatus = LOW;
 int prevstatus = LOW;
+int streaming = 0;
+unsigned long laststream = 0;
 
 // The setup() method runs once, when the sketch starts
 
@@ -81,6 +90,12 @@ void loop()
       //Serial.println(lickcounter);
   }
   prevstatus = lickstatus;
+  if (streaming && lickcounter != 0 && millis()-laststream >= STREAMINTERVAL) {
+      Serial.print(lickcounter);
+      Serial.write('\n');
+      lickcounter = 0;
+      laststream = millis();
+  }
   // lickpiezosum += analogRead(piezopin);
   // Wait for request before doing stuff:
   if ( Serial.available()) {
@@ -131,6 +146,16 @@ void loop()
         lickcounter = 0;
         break;
       }
+      case 's': {
+        streaming = 1;
+        lickcounter = 0;
+        laststream = millis();
+        break;
+      }
+      case 'x': {
+        streaming = 0;
+        break;
+      }
       case 'a': {
         // transmit lick pin status:
         Serial.write(lickpiezosum);
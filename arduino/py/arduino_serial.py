@@ -32,6 +32,7 @@ import fcntl
 import os
 import sys
 import time
+import select
 import getopt
 
 
@@ -58,6 +59,9 @@ ISPEED = 4
 OSPEED = 5
 CC = 6
 
+# Largest number of bytes taken from the port per read
+READSIZE = 4096
+
 
 def bps_to_termios_sym(bps):
   return BPS_SYMS[bps]
@@ -91,6 +95,8 @@ class SerialPort:
     attrs[CFLAG] |= termios.CREAD | termios.CLOCAL
     # Turn off software flow control.
     attrs[IFLAG] &= ~(termios.IXON | termios.IXOFF | termios.IXANY)
+    # Pass CR and NL through unchanged, so binary frames stay intact.
+    attrs[IFLAG] &= ~(termios.ICRNL | termios.INLCR | termios.IGNCR | termios.ISTRIP)
 
     # Make raw.
     attrs[LFLAG] &= ~(termios.ICANON | termios.ECHO | termios.ECHOE | termios.ISIG)
@@ -101,25 +107,97 @@ class SerialPort:
     attrs[CC][termios.VTIME] = 20;
     termios.tcsetattr(self.fd, termios.TCSANOW, attrs)
 
-  def read_until(self, until):
-    buf = b""
-    done = False
-    while not done:
+    # Bytes read from the port but not yet returned
+    self.buf = bytearray()
+    # statistics
+    self.nreads = 0
+    self.nbytes = 0
+
+  def fileno(self):
+    return self.fd
+
+  def fill(self, timeout=0):
+    """Moves everything the port has into the buffer, waiting up to
+    timeout seconds (forever if None) for the first byte. Returns
+    the number of bytes read."""
+    if timeout is None or timeout > 0:
+      readable, writable, errors = select.select([self.fd], [], [], timeout)
+      if not readable:
+        return 0
+    nread = 0
+    while True:
       try:
-        n = os.read(self.fd, 1)
+        data = os.read(self.fd, READSIZE)
       except os.error:
-        time.sleep(0.0001)
-        continue
-      if n == b'':
-        time.sleep(0.0001)
-        continue
-      buf = buf + n
-      if n == until:
-        done = True
-    return buf
+        break
+      self.nreads += 1
+      if not len(data):
+        break
+      self.buf += data
+      nread += len(data)
+      if len(data) < READSIZE:
+        break
+    self.nbytes += nread
+    return nread
+
+  def _wait(self, deadline):
+    """Fills the buffer until data arrives or the deadline passes;
+    returns False once the deadline has passed"""
+    if deadline is None:
+      timeout = None
+    else:
+      timeout = deadline - time.time()
+      if timeout <= 0:
+        return False
+    if self.fill(timeout) == 0:
+      # Readable without data: the tty has nothing after all
+      time.sleep(0.0001)
+    return True
+
+  def _take(self, n):
+    data = bytes(self.buf[:n])
+    del self.buf[:n]
+    return data
+
+  def read_until(self, until, timeout=None):
+    """Returns the bytes up to and including until, or b'' if they
+    have not arrived within timeout seconds (wait forever if None).
+    Bytes after until stay in the buffer for the next read."""
+    deadline = None if timeout is None else time.time() + timeout
+    start = 0
+    while True:
+      pos = self.buf.find(until, start)
+      if pos != -1:
+        return self._take(pos + len(until))
+      start = max(0, len(self.buf) - len(until) + 1)
+      if not self._wait(deadline):
+        return b''
+
+  def read_frame(self, n, timeout=None):
+    """Returns exactly n bytes of a binary frame, or b'' if they have
+    not arrived within timeout seconds"""
+    deadline = None if timeout is None else time.time() + timeout
+    while len(self.buf) < n:
+      if not self._wait(deadline):
+        return b''
+    return self._take(n)
+
+  def read_lines(self, until=b'\n', timeout=0):
+    """Returns all complete lines without their terminator; waits up
+    to timeout seconds if there is none in the buffer"""
+    if self.buf.find(until) == -1:
+      self.fill(timeout)
+    lines = bytes(self.buf).split(until)
+    self.buf = bytearray(lines[-1])
+    return lines[:-1]
+
+  def flush_input(self):
+    """Discards everything received so far"""
+    self.fill()
+    del self.buf[:]
 
   def write(self, str):
-    os.write(self.fd, str)
+    return os.write(self.fd, str)
 
   def write_byte(self, byte):
     os.write(self.fd, chr(byte))
@@ -20,26 +20,48 @@ import os
 import socket
 import subprocess
 import time
+import struct
 import numpy as np
 
+# Framed messages as in py/gnoomproto.py: magic, type, flags, length
+HEADER = struct.Struct('<2sBBI')
+HEARTBEAT = 1
+MOUSE = 9
+
 def keep_conn(connlist):
     for conn in connlist:
         if conn is not None:
             try:
-                conn.send(b'1')
+                conn.send(HEADER.pack(b'GN', HEARTBEAT, 0, 0))
             except:
                 sys.stdout.write("BLENDER: Couldn't send signal, will retry...\n")
 
+# Bytes of incomplete frames, per connection
+partial = {}
+
 def read32(conn):
 
-    data1 = b''
+    data1 = partial.get(conn, b'')
     while True:
         try:
-            data1 += conn.recv(32)
+            data = conn.recv(4096)
         except:
             break
-    if len(data1):
-        datanp = np.fromstring(data1, np.float64)
+        if not len(data):
+            break
+        data1 += data
+    payload = b''
+    pos = 0
+    while len(data1) - pos >= HEADER.size:
+        magic, mtype, flags, length = HEADER.unpack_from(data1, pos)
+        if len(data1) - pos < HEADER.size + length:
+            break
+        if mtype == MOUSE:
+            payload += data1[pos+HEADER.size:pos+HEADER.size+length]
+        pos += HEADER.size + length
+    partial[conn] = data1[pos:]
+    if len(payload):
+        datanp = np.frombuffer(payload, np.float64)
         t = datanp[::4]
         dt = datanp[1::4]
         y = datanp[2::4]
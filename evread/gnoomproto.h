@@ -0,0 +1,107 @@
+// This program is free software; you can redistribute it and/or
+// modify it under the terms of the GNU General Public License
+// as published by the Free Software Foundation; either version 2
+// of the License, or (at your option) any later version.
+
+// This program is distributed in the hope that it will be useful,
+// but WITHOUT ANY WARRANTY; without even the implied warranty of
+// MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+// GNU General Public License for more details.
+
+// You should have received a copy of the GNU General Public License
+// along with this program; if not, write to the Free Software
+// Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston, MA  02110-1301, USA.
+
+/*! \file gnoomproto.h
+ *  \brief Framed messages between Blender and its child processes
+ *
+ *  Every message is an 8-byte header (magic "GN", 1-byte type,
+ *  1-byte flags, 4-byte little-endian payload length) followed by
+ *  the payload. Must match py/gnoomproto.py.
+ */
+
+#ifndef GNOOMPROTO_H
+#define GNOOMPROTO_H
+
+#include <string>
+#include <vector>
+#include <utility>
+#include <cstring>
+#include <stdint.h>
+
+namespace gnoomproto {
+
+static const int HEADERSIZE = 8;
+
+enum msgtype {
+    HEARTBEAT = 1,
+    QUIT = 2,
+    CLOSE = 3,
+    BEGIN = 4,
+    STOP = 5,
+    PRIMED = 6,
+    TIMESTAMP = 7,
+    TBS = 8,
+    MOUSE = 9,
+    LICKS = 10,
+    FRAMETIMES = 11
+};
+
+inline std::string pack(int type, const void* payload, uint32_t length) {
+    std::string msg(HEADERSIZE + length, '\0');
+    msg[0] = 'G';
+    msg[1] = 'N';
+    msg[2] = char(type);
+    msg[3] = 0;
+    for (int i = 0; i < 4; ++i) {
+        msg[4+i] = char((length >> (8*i)) & 0xff);
+    }
+    if (length)
+        memcpy(&msg[HEADERSIZE], payload, length);
+    return msg;
+}
+
+inline std::string pack(int type, const std::string& payload) {
+    return pack(type, payload.data(), payload.size());
+}
+
+/* Collects received bytes and hands out complete frames */
+class framereader {
+  public:
+    void feed(const char* data, int n) {
+        if (n > 0)
+            buf.insert(buf.end(), data, data+n);
+    }
+
+    std::vector< std::pair<int, std::string> > frames() {
+        std::vector< std::pair<int, std::string> > found;
+        std::size_t pos = 0;
+        while (buf.size() - pos >= std::size_t(HEADERSIZE)) {
+            if (buf[pos] != 'G' || buf[pos+1] != 'N') {
+                /* lost sync; skip a byte */
+                ++pos;
+                continue;
+            }
+            uint32_t length = 0;
+            for (int i = 0; i < 4; ++i) {
+                length |= uint32_t((unsigned char)buf[pos+4+i]) << (8*i);
+            }
+            if (buf.size() - pos < HEADERSIZE + length)
+                break;
+            found.push_back(std::make_pair(
+                int((unsigned char)buf[pos+2]),
+                std::string(buf.begin()+pos+HEADERSIZE,
+                            buf.begin()+pos+HEADERSIZE+length)));
+            pos += HEADERSIZE + length;
+        }
+        buf.erase(buf.begin(), buf.begin()+pos);
+        return found;
+    }
+
+  private:
+    std::vector<char> buf;
+};
+
+}
+
+#endif
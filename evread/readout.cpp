@@ -37,6 +37,16 @@
 #include <termios.h>
 #include <sys/ioctl.h>
 #include <linux/input.h>
+#ifndef USE_ZMQ
+    #include "gnoomproto.h"
+#endif
+#ifdef USE_SHM
+    #include <cstring>
+    #include <string>
+    #include <stdint.h>
+    #include <sys/mman.h>
+    #include <sys/stat.h>
+#endif
 
 static const double BILLION = 1000000000L;
 static const double TIMEOUT = 4.0;
@@ -59,6 +69,78 @@ void close(const zmq::socket_t& s) {
 }
 #endif
 
+#ifdef USE_SHM
+/* Single-producer/single-consumer sample ring in POSIX shared memory.
+ * The segment is created by Blender; the layout must match
+ * py/shmring.py. The producer never waits: it writes a record and
+ * then publishes the new head. The reader detects overruns from
+ * the head and tail counters.
+ */
+static const uint32_t SHM_MAGIC = 0x42524e47; /* "GNRB" */
+static const uint32_t SHM_VERSION = 1;
+static const int SHM_HEADER = 256;
+
+struct shm_header {
+    uint32_t magic;
+    uint32_t version;
+    uint64_t capacity;
+    uint64_t recsize;
+    char pad0[40];
+    uint64_t head; /* offset 64 */
+    char pad1[56];
+    uint64_t tail; /* offset 128 */
+};
+
+class shm_ring {
+  public:
+    shm_ring() : hdr(NULL), data(NULL), size(0) {}
+    ~shm_ring() {
+        if (hdr != NULL)
+            munmap(hdr, size);
+    }
+
+    bool open(const std::string& name) {
+        int fd = shm_open(name.c_str(), O_RDWR, 0);
+        if (fd == -1) {
+            perror("USBREAD: shm_open");
+            return false;
+        }
+        struct stat st;
+        if (fstat(fd, &st) == -1) {
+            perror("USBREAD: fstat");
+            ::close(fd);
+            return false;
+        }
+        size = st.st_size;
+        void* addr = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_SHARED, fd, 0);
+        ::close(fd);
+        if (addr == MAP_FAILED) {
+            perror("USBREAD: mmap");
+            return false;
+        }
+        hdr = static_cast<shm_header*>(addr);
+        if (hdr->magic != SHM_MAGIC || hdr->version != SHM_VERSION ||
+            hdr->recsize != 4*sizeof(double)) {
+            std::cerr << "USBREAD: " << name << " is not a sample ring" << std::endl;
+            return false;
+        }
+        data = static_cast<char*>(addr) + SHM_HEADER;
+        return true;
+    }
+
+    void push(const double* rec) {
+        uint64_t head = hdr->head;
+        memcpy(data + (head % hdr->capacity) * hdr->recsize, rec, hdr->recsize);
+        __atomic_store_n(&hdr->head, head+1, __ATOMIC_RELEASE);
+    }
+
+  private:
+    shm_header* hdr;
+    char* data;
+    size_t size;
+};
+#endif
+
 int main (int argc, char **argv)
 {
     // parse arguments:
@@ -141,6 +223,15 @@ int main (int argc, char **argv)
         return -1;
     }
     connected = true;
+
+#ifdef USE_SHM
+    /* "start" is followed by the name of the shared-memory ring */
+    shm_ring ring;
+    if (!ring.open(datastr.substr(5, nrec-5))) {
+        close(s);
+        return -1;
+    }
+#endif
     
     std::string ready = "ready";
 #ifdef USE_ZMQ
@@ -177,6 +268,10 @@ int main (int argc, char **argv)
     std::vector<int> readout(2);
 #ifndef STANDALONE
     std::vector<double> buffer;
+#ifndef USE_ZMQ
+    gnoomproto::framereader reader;
+    std::string pending;
+#endif
 #endif
     struct timespec time0, time1, t_disconnect, t_sent, t_loop, t_poll;
     if( clock_gettime( CLOCK_REALTIME, &time0) == -1 ) {
@@ -221,13 +316,23 @@ int main (int argc, char **argv)
         s.recv (&data, ZMQ_NOBLOCK);
         char* cdata = static_cast<char*>(data.data());
         std::string datastr(cdata, nrec);
+        bool heartbeat = (datastr.find("1")!=std::string::npos);
+        bool quit = (datastr.find("quit")!=std::string::npos);
 #else
         std::vector<char> data(BUFSIZE);
         int nrec = recv(s, &data[0], data.size(), 0);
-        std::string datastr(data.begin(), data.end());
+        reader.feed(&data[0], nrec);
+        std::vector< std::pair<int, std::string> > frames = reader.frames();
+        bool heartbeat = false;
+        bool quit = false;
+        for (std::size_t nf = 0; nf < frames.size(); ++nf) {
+            if (frames[nf].first == gnoomproto::HEARTBEAT)
+                heartbeat = true;
+            else if (frames[nf].first == gnoomproto::QUIT)
+                quit = true;
+        }
 #endif
-	// std::cout << datastr << std::endl;
-        if (datastr.find("1")==std::string::npos) {
+        if (!heartbeat) {
             if (connected) {
                 t_disconnect = t_loop;
                 connected = false;
@@ -242,14 +347,15 @@ int main (int argc, char **argv)
             connected = true;
         }
 	/* Explicit termination */
-        if (datastr.find("quit")!=std::string::npos) {
+        if (quit) {
             std::cout << "USBREAD: Game over signal." << std::endl;
-            std::string sclose = "close";
 #ifdef USE_ZMQ         
+            std::string sclose = "close";
             zmq::message_t reply (sclose.size());
             memcpy (reply.data (), sclose.c_str(), sclose.size());
             while (!s.send (reply, ZMQ_NOBLOCK)) {
 #else
+            std::string sclose = gnoomproto::pack(gnoomproto::CLOSE, "close");
             while (send(s, sclose.c_str(), sclose.size(), 0) < 0) {
 #endif
                 perror("USBREAD: client: send");
@@ -296,10 +402,12 @@ int main (int argc, char **argv)
             }
             if (has_data) {
 #ifndef STANDALONE
-                buffer.push_back(dtime1);
-                buffer.push_back(accum);
-                buffer.push_back(double(readout[0]));
-                buffer.push_back(double(readout[1]));
+                double rec[4] = {dtime1, accum, double(readout[0]), double(readout[1])};
+#ifdef USE_SHM
+                ring.push(rec);
+#else
+                buffer.insert(buffer.end(), rec, rec+4);
+#endif
 #else
                 sumx += readout[0];
                 sumy += readout[1];
@@ -312,11 +420,14 @@ int main (int argc, char **argv)
         }
 #ifndef STANDALONE
         if (!has_data) {
-            buffer.push_back(dtime1);
-            buffer.push_back(accum);
-            buffer.push_back(0.0);
-            buffer.push_back(0.0);
+            double rec[4] = {dtime1, accum, 0.0, 0.0};
+#ifdef USE_SHM
+            ring.push(rec);
+#else
+            buffer.insert(buffer.end(), rec, rec+4);
+#endif
         }
+#ifndef USE_SHM
         if (tdiff(time1, t_sent) > 0.01) {
             t_sent = time1;
 #ifdef USE_ZMQ
@@ -324,7 +435,19 @@ int main (int argc, char **argv)
             memcpy (reply.data (), &buffer[0], sizeof(double)*buffer.size());
             if (!s.send (reply, ZMQ_NOBLOCK)) {
 #else
-            if (send(s, &buffer[0], sizeof(double)*buffer.size(), 0) < 0) {
+            /* A frame that was only partly sent has to go out
+             * completely before the next one; samples read meanwhile
+             * stay in buffer for the frame after it */
+            if (pending.empty()) {
+                pending = gnoomproto::pack(gnoomproto::MOUSE, &buffer[0],
+                                           sizeof(double)*buffer.size());
+                buffer.clear();
+            }
+            ssize_t nsent = send(s, pending.data(), pending.size(), 0);
+            if (nsent >= 0) {
+                pending.erase(0, nsent);
+            }
+            if (nsent < 0) {
 #endif
                 if (has_data) {
                     perror("USBREAD: terminating, send failed");
@@ -333,10 +456,13 @@ int main (int argc, char **argv)
                 } else {
                     // perror("USBREAD: send failed; will try again later");
                 }
+#ifdef USE_ZMQ
             } else {
                 buffer.clear();
+#endif
             }
         }
+#endif
 #endif
 
     }
@@ -0,0 +1,102 @@
+"""Poll all child-process connections with a single selector"""
+
+import sys
+import selectors
+import numpy as np
+
+from recvbuffer import RecvBuffer
+import gnoomproto as gp
+
+class Stream(object):
+    def __init__(self, name, conn, recsize, dtype, mtype=None):
+        self.name = name
+        self.conn = conn
+        self.recsize = recsize
+        self.dtype = np.dtype(dtype)
+        self.mtype = mtype
+        if mtype is None:
+            self.rbuf = RecvBuffer(recsize, dtype)
+        else:
+            self.rbuf = gp.FrameReader()
+        self.consumed = True
+        # statistics
+        self.nbytes = 0
+        # frames other than samples on a framed stream; nothing reads
+        # them, so they are only counted
+        self.nmessages = 0
+        self.nrecords = 0
+        self.nready = 0
+
+class ConnHub(object):
+    """Holds the non-blocking child connections that stream samples.
+
+    poll() asks the selector once which connections have data and
+    drains only those into their receive buffers. read() hands out the
+    complete records of one stream and triggers a new poll only when
+    that stream was already read since the last poll, so that a logic
+    tick that reads every stream once polls exactly once.
+    """
+    def __init__(self):
+        self.sel = selectors.DefaultSelector()
+        self.streams = {}
+        self.npolls = 0
+
+    def register(self, name, conn, recsize, dtype=np.float64, mtype=None):
+        """Add a connection; mtype is the sample message type of a
+        framed stream, None for a raw stream of fixed-size records"""
+        st = Stream(name, conn, recsize, dtype, mtype)
+        self.sel.register(conn, selectors.EVENT_READ, st)
+        self.streams[conn] = st
+        return st
+
+    def unregister(self, conn):
+        if conn in self.streams:
+            self.sel.unregister(conn)
+            del self.streams[conn]
+
+    def has(self, conn):
+        return conn in self.streams
+
+    def poll(self, timeout=0):
+        self.npolls += 1
+        for key, mask in self.sel.select(timeout):
+            st = key.data
+            st.nready += 1
+            st.nbytes += st.rbuf.fill(st.conn)
+        for st in self.streams.values():
+            st.consumed = False
+
+    def read(self, conn):
+        st = self.streams[conn]
+        if st.consumed:
+            self.poll()
+        st.consumed = True
+        if st.mtype is None:
+            nrecords = st.rbuf.nrecords
+            data = st.rbuf.take()
+            st.nrecords += st.rbuf.nrecords - nrecords
+        else:
+            frames = st.rbuf.frames()
+            data = gp.payload_array(frames, st.mtype, st.dtype)
+            st.nrecords += data.nbytes // st.recsize
+            st.nmessages += len([ftype for ftype, payload in frames if ftype != st.mtype])
+        return data
+
+    def stats(self):
+        return dict([(st.name, {'bytes': st.nbytes,
+                                'records': st.nrecords,
+                                'messages': st.nmessages,
+                                'ready': st.nready})
+                     for st in self.streams.values()])
+
+    def report(self):
+        sys.stdout.write("BLENDER: %d polls\n" % self.npolls)
+        for st in self.streams.values():
+            sys.stdout.write(
+                "         %s: %d bytes, %d records, %d other messages, data in %d polls\n" % (
+                    st.name, st.nbytes, st.nrecords, st.nmessages, st.nready))
+        sys.stdout.flush()
+
+    def close(self):
+        self.sel.close()
+        self.streams = {}
@@ -0,0 +1,134 @@
+"""Buffered background writer for event files"""
+
+import os
+import sys
+import time
+import threading
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+FLUSH_INTERVAL = 0.5 # s
+MAXQUEUE = 4096 # records
+
+_STOP = object()
+
+class EventWriter(object):
+    """File-like wrapper that hands records to a writer thread.
+
+    write() only puts the record on a bounded queue; the thread
+    collects records into batches and writes and flushes them every
+    flush_interval seconds, or when the writer is closed. flush() is
+    a no-op so that existing callers don't force one syscall per
+    record. close() blocks until every queued record is on disk.
+    """
+    def __init__(self, fn, flush_interval=FLUSH_INTERVAL, maxqueue=MAXQUEUE):
+        self.fn = fn
+        self.name = os.path.basename(fn)
+        self.flush_interval = flush_interval
+        self.f = open(fn, 'wb')
+        self.queue = queue.Queue(maxqueue)
+        self.closed = False
+        self.error = None
+
+        # statistics
+        self.nrecords = 0
+        self.nbytes = 0
+        self.nbatches = 0
+        self.maxdepth = 0
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+        self.tflush_max = 0.0
+
+        self.thread = threading.Thread(target=self._run, name="eventwriter")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError("I/O operation on closed event writer")
+        self.queue.put((time.time(), bytes(data)))
+        depth = self.queue.qsize()
+        if depth > self.maxdepth:
+            self.maxdepth = depth
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def qsize(self):
+        return self.queue.qsize()
+
+    def stats(self):
+        if self.nrecords:
+            latency_mean = self.latency_sum / self.nrecords
+        else:
+            latency_mean = 0.0
+        return {'records': self.nrecords,
+                'bytes': self.nbytes,
+                'batches': self.nbatches,
+                'depth': self.queue.qsize(),
+                'maxdepth': self.maxdepth,
+                'latency_mean': latency_mean,
+                'latency_max': self.latency_max,
+                'tflush_max': self.tflush_max}
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.put(_STOP)
+        self.thread.join()
+        self.f.close()
+        st = self.stats()
+        sys.stdout.write(
+            "BLENDER: {0}: {1} records in {2} writes, max queue depth {3}, "
+            "latency {4:.1f}/{5:.1f} ms (mean/max)\n".format(
+                self.name, st['records'], st['batches'], st['maxdepth'],
+                st['latency_mean']*1e3, st['latency_max']*1e3))
+
+    def _write(self, pending):
+        t0 = time.time()
+        try:
+            self.f.write(b''.join([data for tq, data in pending]))
+            self.f.flush()
+        except (OSError, IOError, ValueError) as err:
+            self.error = err
+            sys.stderr.write("BLENDER: Error writing to %s: %s\n" % (self.name, err))
+            return
+        t1 = time.time()
+        self.nbatches += 1
+        self.nrecords += len(pending)
+        for tq, data in pending:
+            self.nbytes += len(data)
+            self.latency_sum += t1-tq
+        self.latency_max = max(self.latency_max, t1-pending[0][0])
+        self.tflush_max = max(self.tflush_max, t1-t0)
+
+    def _run(self):
+        pending = []
+        tflush = time.time()
+        stop = False
+        while not stop:
+            timeout = max(self.flush_interval - (time.time()-tflush), 0)
+            try:
+                item = self.queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            # Collect everything else that's already waiting
+            while item is not None:
+                if item is _STOP:
+                    stop = True
+                    break
+                pending.append(item)
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    item = None
+            if not pending:
+                tflush = time.time()
+            elif stop or time.time()-tflush >= self.flush_interval:
+                self._write(pending)
+                pending = []
+                tflush = time.time()
@@ -0,0 +1,332 @@
+"""Simulated comedi board for testing nicomedilib without hardware
+
+Implements the calls of the comedi module that nicomedilib uses. A
+device opened for analog input streams interleaved uint32 samples in
+real time through a pipe, so that comedi_fileno, os.read and
+comedi_get_buffer_contents behave like on a real board. Samples are
+dropped (and counted) when the reader lets the pipe fill up, like
+comedi overruns.
+
+nicomedilib uses it instead of comedi when GNOOM_FAKE_COMEDI is set:
+
+    GNOOM_FAKE_COMEDI=1 python3 nicomedi.py
+
+Run it directly to benchmark acquisition, conversion and writing:
+
+    python3 fakecomedi.py [duration in s] [sampling interval in ms]
+"""
+
+import os
+import sys
+import time
+import fcntl
+import ctypes
+import struct
+import termios
+import threading
+import numpy as np
+
+AREF_GROUND = 0
+TRIG_NONE = 1
+TRIG_NOW = 2
+TRIG_INT = 4
+TRIG_EXT = 8
+TRIG_TIMER = 16
+TRIG_COUNT = 32
+TRIG_WAKE_EOS = 32
+INSN_INTTRIG = 0x0c000000 | 6
+COMEDI_INPUT = 0
+COMEDI_OUTPUT = 1
+COMEDI_TO_PHYSICAL = 0
+
+MAXDATA = 65535
+RANGE_MIN = -10.0 # V
+RANGE_MAX = 10.0 # V
+PIPESIZE = 1<<20 # bytes, the default maximum for unprivileged users
+F_SETPIPE_SZ = 1031
+
+FRAME_RATE = 60.0 # Hz
+
+def sine_noise(t):
+    return np.sin(2*np.pi*5.0*t) + 0.05*np.random.randn(len(t))
+
+def noise_spikes(t):
+    v = 0.05*np.random.randn(len(t))
+    v[np.random.rand(len(t)) < 1e-4] += 2.0
+    return v
+
+def frame_trigger(t):
+    return np.where((t*FRAME_RATE) % 1.0 < 0.5, 0.0, 5.0)
+
+# Signal (in V) of each position in the channel list; the frame
+# trigger comes last, as in nicomedi
+SIGNALS = [sine_noise, noise_spikes, frame_trigger]
+
+def configure(signals=None, frame_rate=None):
+    global SIGNALS, FRAME_RATE
+    if signals is not None:
+        SIGNALS = signals
+    if frame_rate is not None:
+        FRAME_RATE = frame_rate
+
+def to_raw(v):
+    raw = np.round((v-RANGE_MIN)/(RANGE_MAX-RANGE_MIN)*MAXDATA)
+    return np.clip(raw, 0, MAXDATA).astype(np.uint32)
+
+class Range(object):
+    def __init__(self, rmin, rmax):
+        self.min = rmin
+        self.max = rmax
+
+class comedi_cmd_struct(object):
+    pass
+
+class comedi_insn_struct(object):
+    pass
+
+class comedi_polynomial_t(object):
+    def __init__(self):
+        self.order = 0
+        self.expansion_origin = 0.0
+        self.coefficients = 0
+        self._coefficients = None
+
+class lsampl_array(list):
+    def __init__(self, n):
+        list.__init__(self, [0]*n)
+
+    def cast(self):
+        return self
+
+def chanlist(n):
+    return [0]*n
+
+def cr_pack(chan, rng, aref):
+    return ((aref & 0x3) << 24) | ((rng & 0xff) << 16) | chan
+
+class Device(object):
+    """One opened subdevice. Subdevice 1 is analog output on the NI
+    boards, its writes are discarded."""
+    def __init__(self, name):
+        self.name = name
+        self.ao = name.endswith("subd1")
+        if self.ao:
+            self.rfd = os.open(os.devnull, os.O_WRONLY)
+            self.wfd = None
+            self.pipesize = PIPESIZE
+        else:
+            self.rfd, self.wfd = os.pipe()
+            try:
+                fcntl.fcntl(self.wfd, F_SETPIPE_SZ, PIPESIZE)
+            except (IOError, OSError):
+                pass
+            self.pipesize = fcntl.fcntl(self.wfd, F_SETPIPE_SZ + 1) # F_GETPIPE_SZ
+            fl = fcntl.fcntl(self.wfd, fcntl.F_GETFL)
+            fcntl.fcntl(self.wfd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        self.thread = None
+        self.running = threading.Event()
+        # statistics
+        self.nscans = 0
+        self.ndropped = 0
+
+    def contents(self):
+        if self.ao:
+            return 0
+        nbytes = struct.unpack('i', fcntl.ioctl(
+            self.rfd, termios.FIONREAD, struct.pack('i', 0)))[0]
+        return nbytes
+
+    def start(self, cmd):
+        self.nchans = cmd.chanlist_len
+        self.dt = cmd.scan_begin_arg * 1e-9
+        self.running.set()
+        self.thread = threading.Thread(target=self.produce)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def produce(self):
+        recsize = 4*self.nchans
+        t0 = time.time()
+        while self.running.is_set():
+            ndue = int((time.time()-t0)/self.dt) - self.nscans - self.ndropped
+            if ndue > 0:
+                nfit = min(ndue, (self.pipesize-self.contents()) // recsize)
+                if nfit > 0:
+                    t = (self.nscans + self.ndropped + np.arange(nfit)) * self.dt
+                    data = np.empty((nfit, self.nchans), dtype=np.uint32)
+                    for nch in range(self.nchans):
+                        data[:, nch] = to_raw(SIGNALS[min(nch, len(SIGNALS)-1)](t))
+                    buf = memoryview(data.tobytes())
+                    while len(buf):
+                        try:
+                            buf = buf[os.write(self.wfd, buf):]
+                        except (IOError, OSError):
+                            time.sleep(1e-4)
+                    self.nscans += nfit
+                self.ndropped += ndue - max(nfit, 0)
+            time.sleep(1e-3)
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+def comedi_loglevel(level):
+    return 0
+
+def comedi_errno():
+    return 0
+
+def comedi_strerror(errno):
+    return "simulated comedi error %d" % errno
+
+def comedi_open(devname):
+    return Device(devname)
+
+def comedi_close(dev):
+    dev.stop()
+    os.close(dev.rfd)
+    if dev.wfd is not None:
+        os.close(dev.wfd)
+    return 0
+
+def comedi_get_board_name(dev):
+    return "fake-%s" % os.path.basename(dev.name)
+
+def comedi_fileno(dev):
+    return dev.rfd
+
+def comedi_parse_calibration_file(path):
+    return object()
+
+def comedi_cleanup_calibration(calib):
+    pass
+
+def comedi_get_softcal_converter(subdev, chan, rng, direction, calib, poly):
+    # Linear conversion of the full range
+    coeffs = (ctypes.c_double * 2)(RANGE_MIN, (RANGE_MAX-RANGE_MIN)/MAXDATA)
+    poly.order = 1
+    poly.expansion_origin = 0.0
+    poly._coefficients = coeffs
+    poly.coefficients = ctypes.addressof(coeffs)
+    return 0
+
+def comedi_to_physical(data, poly):
+    coeffs = poly._coefficients
+    x = data - poly.expansion_origin
+    return sum([coeffs[i] * x**i for i in range(poly.order+1)])
+
+def comedi_get_maxdata(dev, subdev, chan):
+    return MAXDATA
+
+def comedi_get_range(dev, subdev, chan, rng):
+    return Range(RANGE_MIN, RANGE_MAX)
+
+def comedi_get_max_buffer_size(dev, subdev):
+    return dev.pipesize
+
+def comedi_get_buffer_size(dev, subdev):
+    return dev.pipesize
+
+def comedi_get_buffer_contents(dev, subdev):
+    return dev.contents()
+
+def comedi_command_test(dev, cmd):
+    return 0
+
+def comedi_command(dev, cmd):
+    # A real board waits for the external trigger; start right away
+    if not dev.ao:
+        dev.start(cmd)
+    return 0
+
+def comedi_cancel(dev, subdev):
+    dev.stop()
+    return 0
+
+def comedi_do_insn(dev, insn):
+    return 1
+
+def comedi_dio_config(dev, subdev, chan, io):
+    return 1
+
+def comedi_dio_write(dev, subdev, chan, state):
+    return 1
+
+if __name__ == "__main__":
+    os.environ['GNOOM_FAKE_COMEDI'] = '1'
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import tempfile
+    import nicomedilib as ncl
+    import fakecomedi
+
+    duration = 5.0
+    dt = 0.02 # ms
+    if len(sys.argv) > 1:
+        duration = float(sys.argv[1])
+    if len(sys.argv) > 2:
+        dt = float(sys.argv[2])
+
+    dev, fd, name = ncl.open_dev("/dev/comedi0_subd0")
+    aichIC = ncl.nichannel(dev, 0, 0, fd, 0, calibrate=True)
+    aichEC = ncl.nichannel(dev, 7, 0, fd, 0, calibrate=True)
+    aichFR = ncl.nichannel(dev, 15, 0, fd, 0, calibrate=True)
+    cmdai = ncl.init_comedi_ai(aichFR, aichIC, aichEC, dt)
+
+    tmpdir = tempfile.mkdtemp(prefix="fakecomedi")
+    trunk = os.path.join(tmpdir, "bench")
+    ftmpIC = open(trunk + "_IC.bin", 'w+b')
+    ftmpEC = open(trunk + "_EC.bin", 'w+b')
+    ftmpFR = open(trunk + "_FR.bin", 'w+b')
+    h5w = ncl.open_h5stream(trunk + ".h5", dt, "ms", ["mV", "mV"])
+    edges = ncl.EdgeWriter(trunk + "_edge.bin")
+
+    # Acquisition and writing in real time
+    ncl.record(aichIC, cmdai)
+    acq = ncl.Acquisition(aichIC, aichEC, aichFR, 1.0, 1.0)
+    acq.start()
+    t0 = time.time()
+    twrite = 0
+    while time.time()-t0 < duration:
+        time.sleep(0.01)
+        tw = time.time()
+        ncl.write_blocks(acq, ftmpIC, ftmpEC, ftmpFR, h5w, edges)
+        acq.plotblocks.clear()
+        twrite += time.time()-tw
+    fakecomedi.comedi_cancel(dev, 0)
+
+    # What stop does before synchronizing
+    tstop = time.time()
+    acq.stop()
+    ncl.write_blocks(acq, ftmpIC, ftmpEC, ftmpFR, h5w, edges)
+    for f in [ftmpIC, ftmpEC, ftmpFR]:
+        f.close()
+    if h5w is not None:
+        h5w.close()
+    edges.close()
+    tstop = time.time()-tstop
+
+    # Conversion alone on one second of data
+    nscans = int(1e3/dt)
+    raw = np.empty((nscans, 3), dtype=np.uint32)
+    for nch in range(3):
+        raw[:, nch] = to_raw(SIGNALS[nch](np.arange(nscans)*dt*1e-3))
+    databstr = raw.tobytes()
+    tconv = time.time()
+    ncl.databstr2np(databstr, [1.0, 1.0], [aichIC, aichEC, aichFR])
+    tconv = time.time()-tconv
+
+    sys.stdout.write("\n")
+    acq.report()
+    sys.stdout.write(
+        "FAKECOMEDI: %d scans produced, %d dropped, %d frame edges\n" % (
+            dev.nscans, dev.ndropped, edges.nedges))
+    sys.stdout.write(
+        "FAKECOMEDI: writing %.1f ms per s of data, stop %.1f ms, "
+        "databstr2np %.1f Mscans/s\n" % (
+            twrite*1e3/duration, tstop*1e3, nscans/tconv*1e-6))
+    ncl.shutdown(aichIC)
+    for fn in os.listdir(tmpdir):
+        os.remove(os.path.join(tmpdir, fn))
+    os.rmdir(tmpdir)
@@ -5,26 +5,55 @@ import time
 import sys
 import os
 import socket
+import selectors
 import subprocess
 import numpy as np
 import settings
 import gnoomutils as gu
 import gnoomio as gio
+from recvbuffer import RecvBuffer
+import gnoomproto as gp
 if settings.usezmq:
     import zmq
 
+# Connections to children that use the framed protocol in gnoomproto,
+# mapped to the message type of their sample stream (None if they
+# only exchange control messages)
+framed_conns = {}
+
+def encode_msg(conn, msg):
+    if conn in framed_conns:
+        return gp.encode_command(msg)
+    return msg.encode('latin-1')
+
 def safe_send(conn, msg, errmsg, usezmq=False):
-    sent = False
-    while not sent:
+    # A command that can't be encoded raises ValueError. Only a full
+    # socket buffer is retried; any other error is reported and the
+    # message dropped.
+    if usezmq:
+        data = msg.encode('latin-1')
+        retry = zmq.Again
+    else:
+        data = encode_msg(conn, msg)
+        retry = BlockingIOError
+    reported = False
+    while len(data):
         try:
             if usezmq:
-                conn.send(msg.encode('latin-1'), flags=zmq.NOBLOCK)
-            else:
-                conn.send(msg.encode('latin-1'))
-            sent = True
-        except:
+                conn.send(data, flags=zmq.NOBLOCK)
+                break
+            data = data[conn.send(data):]
+        except retry:
+            if not reported:
+                sys.stdout.write(errmsg)
+                sys.stdout.flush()
+                reported = True
+        except OSError as err:
             sys.stdout.write(errmsg)
+            sys.stderr.write("BLENDER: Send failed: %s\n" % err)
             sys.stdout.flush()
+            return False
+    return True
 
 def safe_recv(conn, usezmq=False):
     recv = False
@@ -65,24 +94,68 @@ def keep_conn(connlist):
                     if hasattr(conn, "send_string"):
                         conn.send(b'1', flags=zmq.NOBLOCK)
                     else:
-                        conn.send(b'1')
+                        conn.send(encode_msg(conn, '1'))
                 except:
                     sys.stdout.write(
                         "BLENDER: Couldn't send signal to {0}, will retry...\n".format(connname))
 
-def read32(conn, usezmq=False):
+# One receive buffer per connection, created on first use
+recvbuffers = {}
 
-    data1 = b''
+def get_recvbuffer(conn, recsize, dtype=np.float64):
+    if conn not in recvbuffers:
+        recvbuffers[conn] = RecvBuffer(recsize, dtype)
+    return recvbuffers[conn]
+
+framereaders = {}
+pending_frames = {}
+
+def read_frames(conn):
+    if conn not in framereaders:
+        framereaders[conn] = gp.FrameReader()
+    return framereaders[conn].read(conn)
+
+def wait_msg(conn, mtype, timeout=None):
+    # Block until a frame of type mtype arrives; other frames are kept
+    # for later calls
+    pending = pending_frames.setdefault(conn, [])
+    start = time.time()
     while True:
-        try:
-            if usezmq:
-                data1 += conn.recv(flags=zmq.NOBLOCK)
-            else:
-                data1 += conn.recv(32)
-        except:
-            break
-    if len(data1):
-        datanp = np.fromstring(data1, np.float64)
+        for nf, (ftype, payload) in enumerate(pending):
+            if ftype == mtype:
+                del pending[nf]
+                return payload
+        frames = read_frames(conn)
+        pending.extend([(ftype, bytes(payload)) for ftype, payload in frames])
+        if not len(frames):
+            if timeout is not None and time.time()-start > timeout:
+                return None
+            time.sleep(1e-4)
+
+def read_records(conn, recsize, dtype=np.float64):
+    # Connections registered with the hub are drained by its per-tick
+    # poll; anything else is read directly
+    hub = GameLogic.Object.get('connhub')
+    if hub is not None and hub.has(conn):
+        return hub.read(conn)
+    if conn in framed_conns:
+        return gp.payload_array(read_frames(conn), framed_conns[conn], dtype)
+    return get_recvbuffer(conn, recsize, dtype).read(conn)
+
+def read32(conn, usezmq=False):
+    # Records are [t, dt, y, x] as float64; any partial record is kept
+    # in the buffer until the next tick
+    if usezmq:
+        rbuf = get_recvbuffer(conn, 32)
+        while True:
+            try:
+                rbuf.feed(conn.recv(flags=zmq.NOBLOCK))
+            except:
+                break
+        datanp = rbuf.take()
+    else:
+        datanp = read_records(conn, 32)
+    if len(datanp):
         t = datanp[::4]
         dt = datanp[1::4]
         y = datanp[2::4]
@@ -93,41 +166,28 @@ def read32(conn, usezmq=False):
     return t,dt,x,y
 
 def parse_frametimes(conn):
-    data1 = b''
-    while True:
-        try:
-            data1 += conn.recv(8)
-        except:
-            break
-    if len(data1):
-        datanp = np.fromstring(data1, np.float64)
-    else:
-        datanp = np.array([], dtype = np.float64)
-    return datanp
-
-def parse_ephystimes(conn):
+    return read_records(conn, 8)
+
+def parse_ephystimes(conn, timeout=None):
+    # Returns None if no time arrived within timeout seconds
+    if conn in framed_conns:
+        payload = wait_msg(conn, gp.TIMESTAMP, timeout)
+        if payload is None:
+            return None
+        return np.frombuffer(payload, np.float64)
+    start = time.time()
     recv = False
     while not recv:
         try:
             data = conn.recv(8)
             recv = True
         except:
-            pass
+            if timeout is not None and time.time()-start > timeout:
+                return None
     return np.fromstring(data, np.float64)
 
 def parse_licksensor(conn):
-    data1 = b''
-    while True:
-        try:
-            data1 += conn.recv(16)
-        except:
-            break
-    if len(data1):
-        datanp = np.fromstring(data1, np.float64)
-        datanp = datanp.reshape((int(datanp.shape[0]/2), 2))
-    else:
-        datanp = np.array([], dtype = np.float64)
-    return datanp
+    return read_records(conn, 16).reshape((-1, 2))
 
 def parse_imgsensor(conn):
     data1 = b''
@@ -144,7 +204,8 @@ def parse_imgsensor(conn):
     return datanp
 
 
-def spawn_process(procname, cmd='', shell=False, system=False, start=True, addenv=None, usezmq=False):
+def spawn_process(procname, cmd='', shell=False, system=False, start=True, addenv=None, usezmq=False,
+                  framed=False, stream=None, accept=True):
     if usezmq:
         s = settings.ZMQCONTEXT.socket(zmq.REP)
     else:
@@ -184,10 +245,144 @@ def spawn_process(procname, cmd='', shell=False, system=False, start=True, adden
         conn, addr = s, None
     else:
         s.listen(1)
-        conn, addr = s.accept()
+        if accept:
+            conn, addr = s.accept()
+            if framed:
+                framed_conns[conn] = stream
+        else:
+            # start_children accepts the connection later
+            conn, addr = None, None
 
     return s, conn, addr, proc
 
+# Seconds a child may take from launch to its 'ready'
+STARTUP_TIMEOUT = 30.0
+# Seconds a failed child gets to exit before it is killed
+CHILD_EXIT_TIMEOUT = 2.0
+
+class ChildStart(object):
+    """A child process that was launched but has not finished its
+    handshake: once it connects, it is sent hello (if not None) and is
+    ready when it answers b'ready'."""
+    def __init__(self, name, s, proc, hello, framed=False, stream=None,
+                 timeout=STARTUP_TIMEOUT):
+        self.name = name
+        self.s = s
+        self.proc = proc
+        self.hello = hello
+        self.framed = framed
+        self.stream = stream
+        self.conn = None
+        self.reply = b''
+        self.t0 = time.time()
+        self.deadline = self.t0 + timeout
+        self.tready = None
+        self.done = False
+
+    def fail(self, reason):
+        sys.stdout.write("BLENDER: %s failed to start: %s\n" % (self.name, reason))
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        # A child that comes up late must not keep its device
+        self.s.close()
+        if isinstance(self.proc, subprocess.Popen) and self.proc.poll() is None:
+            self.proc.terminate()
+            try:
+                self.proc.wait(CHILD_EXIT_TIMEOUT)
+            except subprocess.TimeoutExpired:
+                self.proc.kill()
+                self.proc.wait()
+        self.done = True
+
+def launch_child(name, procname, cmd, hello, timeout=STARTUP_TIMEOUT, **kwargs):
+    """Start a child without waiting for it to connect"""
+    s, conn, addr, proc = spawn_process(procname, cmd, accept=False, **kwargs)
+    return ChildStart(name, s, proc, hello, kwargs.get('framed', False),
+                      kwargs.get('stream'), timeout)
+
+def start_children(children):
+    """Complete the handshakes of all launched children concurrently.
+
+    Returns a dict that maps the children's names to their non-blocking
+    connections, or to None for children that did not get ready before
+    their deadline.
+    """
+    sel = selectors.DefaultSelector()
+    for child in children:
+        child.s.setblocking(0)
+        sel.register(child.s, selectors.EVENT_READ, child)
+    t0 = time.time()
+    waiting = list(children)
+    while len(waiting):
+        now = time.time()
+        for child in waiting:
+            reason = None
+            if now > child.deadline:
+                reason = "no answer after %.1f s" % (now-child.t0)
+            elif isinstance(child.proc, subprocess.Popen) and \
+                 child.proc.poll() is not None:
+                reason = "exited with code %d" % child.proc.returncode
+            if reason is not None:
+                sel.unregister(child.s if child.conn is None else child.conn)
+                child.fail(reason)
+        waiting = [child for child in waiting if not child.done]
+        if not len(waiting):
+            break
+        timeout = min([child.deadline for child in waiting]) - now
+        for key, mask in sel.select(min(max(timeout, 0), 0.1)):
+            child = key.data
+            if child.done:
+                continue
+            if child.conn is None:
+                try:
+                    conn, addr = child.s.accept()
+                except (socket.error, OSError):
+                    continue
+                conn.setblocking(1)
+                if child.hello is not None:
+                    conn.sendall(child.hello)
+                conn.setblocking(0)
+                child.conn = conn
+                sel.unregister(child.s)
+                if child.hello is None:
+                    child.tready = time.time()
+                    child.done = True
+                else:
+                    sel.register(conn, selectors.EVENT_READ, child)
+                continue
+            # Only take the bytes of 'ready' so that no sample that
+            # follows it gets lost
+            try:
+                data = child.conn.recv(len(b'ready') - len(child.reply))
+            except (socket.error, OSError):
+                continue
+            if not len(data):
+                sel.unregister(child.conn)
+                child.fail("connection closed during handshake")
+                continue
+            child.reply += data
+            if len(child.reply) == len(b'ready'):
+                sel.unregister(child.conn)
+                child.done = True
+                if child.reply == b'ready':
+                    child.tready = time.time()
+                else:
+                    child.fail("unexpected answer %r" % child.reply)
+    sel.close()
+
+    conns = {}
+    for child in children:
+        if child.tready is not None:
+            sys.stdout.write("BLENDER: %s ready after %.2f s\n" % (
+                child.name, child.tready-child.t0))
+            if child.framed:
+                framed_conns[child.conn] = child.stream
+        conns[child.name] = child.conn
+    sys.stdout.write("BLENDER: Started %d children in %.2f s\n" % (
+        len(children), time.time()-t0))
+    return conns
+
 def spawn_process_net(hostname):
     s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     s.settimeout(0.1)
@@ -199,14 +394,32 @@ def spawn_process_net(hostname):
         conn, addr = None, None
     return s, conn, addr
 
+def read_ring(ring):
+    datanp, nlost = ring.read()
+    if nlost:
+        sys.stdout.write("BLENDER: Lost %d mouse samples\n" % nlost)
+    if len(datanp):
+        t = datanp[:, 0]
+        dt = datanp[:, 1]
+        y = datanp[:, 2]
+        x = datanp[:, 3]
+    else:
+        t, dt, x, y = np.array([time.time()]),np.array([0]),np.array([0]),np.array([0])
+
+    return t,dt,x,y
+
 def read_optical_sensor():
-    if GameLogic.Object['m1conn'] is not None:
+    if GameLogic.Object.get('m1ring') is not None:
+        t1, dt1, x1, y1 = read_ring(GameLogic.Object['m1ring'])
+    elif GameLogic.Object['m1conn'] is not None:
         # get mouse movement
         t1, dt1, x1, y1 = read32(GameLogic.Object['m1conn'], usezmq=settings.usezmq)
     else:
         t1, dt1, x1, y1 = np.array([0,]), np.array([0,]), np.array([0,]), np.array([0,])
 
-    if GameLogic.Object['m2conn'] is not None:
+    if GameLogic.Object.get('m2ring') is not None:
+        t2, dt2, x2, y2 = read_ring(GameLogic.Object['m2ring'])
+    elif GameLogic.Object['m2conn'] is not None:
         t2, dt2, x2, y2 = read32(GameLogic.Object['m2conn'], usezmq=settings.usezmq)
     else:
         t2, dt2, x2, y2 = np.array([0,]), np.array([0,]), np.array([0,]), np.array([0,])
@@ -255,25 +468,18 @@ def zeroPump():
         cyl.localPosition = [0, GameLogic.Object['rewpos'][0] * settings.reward_pos_linear, cyl.localPosition[2]]
     
 def runPump(pumppy, reward=True, buzz=True):
+    # Only queues the commands; the pump driver thread sends them
     if pumppy is not None:
-        try:
-            if reward:
-                sys.stdout.write("BLENDER: Running reward pump\n")
-                tpump0 = time.time()
-                pumppy.write(b"RUN\r")
-                if time.time()-tpump0 > 0.01:
-                    sys.stdout.write("BLENDER: Took {0:.3f}s to run pump\n".format(
-                       (time.time()-tpump0)))
-            if buzz:
-                pumppy.write(b"BUZ 1 2\r")
-        except:
-            sys.stdout.write('BLENDER: Pump not found\n')
-                                                                                                           
+        if reward:
+            sys.stdout.write("BLENDER: Running reward pump\n")
+            pumppy.reward(buzz=buzz)
+        elif buzz:
+            pumppy.buzz()
+
 def setPumpVolume(pumppy, vol):
     svol = "%05.2f" % vol
     sys.stdout.write( "BLENDER: Setting pump volume to %s ul...\n" % svol )
-    pumppy.write(bytearray("VOL UL\r\n", 'ascii'))
-    pumppy.write(bytearray("VOL %s\r\n" % svol, 'ascii'))
+    pumppy.set_volume(vol)
 
 
 
@@ -309,22 +515,35 @@ def valve_command(arduino, cmd, kb=None):
         else:
            dt = time1 -  GameLogic.Object['time0']
         print("%ss " % (gu.time2str(dt))+ str(kb))
-        executed = False
-        while not executed:
-            try:
-                arduino.write(cmd)
-                executed = True
-                gio.write_valve(cmd)
-            except BlockingIOError:
-                sys.stderr.write("GNOOMUTILS: Couldn't write to arduino\n")
+        write_arduino_nonblocking(arduino, cmd)
+        gio.write_valve(cmd)
+
+# Bytes that the arduino port couldn't take yet, by port; they go out
+# before later commands, at the latest on the next tick
+arduino_pending = {}
+
+def flush_arduino(arduino):
+    """Send what earlier commands left; True once all has gone"""
+    if arduino is None:
+        return True
+    flush_output = getattr(arduino, 'flush_output', None)
+    if flush_output is not None:
+        # serialbroker.BrokerPort keeps its own remainder
+        flush_output()
+    pending = arduino_pending.get(arduino)
+    if not pending:
+        return True
+    try:
+        nwritten = arduino.write(bytes(pending))
+    except BlockingIOError:
+        return False
+    del pending[:nwritten]
+    return not len(pending)
 
 def write_arduino_nonblocking(arduino, cmd):
-    while True:
-        try:
-            arduino.write(cmd)
-            break
-        except BlockingIOError:
-            pass    
+    # Never waits for a full port buffer
+    arduino_pending.setdefault(arduino, bytearray()).extend(cmd)
+    flush_arduino(arduino)
 
 # convert 2 unsigned char to a signed int
 def u2s(u, d):
@@ -0,0 +1,186 @@
+"""Self-describing stream files for training and recording sessions
+
+The legacy files (.move, .events, .position, _loom, _lick) are defined
+only by the code that writes them. In the structured format every file
+starts with
+
+    8 bytes  magic b'GNOOMSTR'
+    uint16   format version
+    uint16   reserved (0)
+    uint32   length of the JSON header that follows
+
+and a JSON header naming the stream and describing its records as a
+numpy dtype. The header is padded with spaces so that the records start
+at a multiple of 64 bytes. The records all have the same size, so that a
+stream can be used as a numpy.memmap without parsing:
+
+    import gnoomfile
+    events = gnoomfile.load("train_0001.events")
+    licks = events['t'][events['code'] == b'LI']
+
+Times are float64 seconds since the start of the session.
+
+gnoomio writes the structured format if settings.session_format is
+"structured"; the default is "legacy".
+"""
+
+import os
+import json
+import time
+import struct
+import numpy as np
+
+MAGIC = b'GNOOMSTR'
+VERSION = 1
+PREAMBLE = struct.Struct('<8sHHI')
+ALIGN = 64
+
+EVENTCODESIZE = 8
+
+DTYPES = {
+    # one record per logic tick; x and y are the sums of the samples
+    'move': np.dtype([('t', '<f8'), ('n1', '<u4'), ('n2', '<u4'),
+                      ('x1', '<f4'), ('y1', '<f4'), ('x2', '<f4'), ('y2', '<f4')]),
+    # one record per logic tick
+    'position': np.dtype([('t', '<f8'), ('translation', '<f8', (3,)),
+                          ('position', '<f8', (3,)), ('orientation', '<f8', (9,))]),
+    'events': np.dtype([('t', '<f8'), ('code', 'S%d' % EVENTCODESIZE)]),
+    # piezo lick amplitudes
+    'lick': np.dtype([('t', '<f8'), ('amplitude', '<f8')]),
+    # looming stimulus position and size
+    'loom': np.dtype([('position', '<f8', (3,)), ('scale', '<f8', (3,))]),
+}
+
+def dtype_to_json(dtype):
+    fields = []
+    for name in dtype.names:
+        fdtype, offset = dtype.fields[name][:2]
+        if fdtype.subdtype is not None:
+            fields.append([name, fdtype.subdtype[0].str, list(fdtype.subdtype[1])])
+        else:
+            fields.append([name, fdtype.str])
+    return fields
+
+def dtype_from_json(fields):
+    return np.dtype([tuple(field[:2]) + ((tuple(field[2]),) if len(field) > 2 else ())
+                     for field in fields])
+
+def header(stream, meta=None):
+    """Bytes that start a structured file of one stream"""
+    info = {'stream': stream,
+            'dtype': dtype_to_json(DTYPES[stream]),
+            'created': time.strftime("%Y-%m-%dT%H:%M:%S"),
+            'meta': meta if meta is not None else {}}
+    text = json.dumps(info).encode('utf-8')
+    size = PREAMBLE.size + len(text) + 1
+    text += b' ' * (-size % ALIGN) + b'\n'
+    return PREAMBLE.pack(MAGIC, VERSION, 0, len(text)) + text
+
+def read_header(fn):
+    """Returns the header info and the offset of the first record, or
+    (None, 0) for a legacy file"""
+    with open(fn, 'rb') as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size:
+            return None, 0
+        magic, version, reserved, length = PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            return None, 0
+        if version > VERSION:
+            raise ValueError("%s: format version %d is newer than %d" % (fn, version, VERSION))
+        info = json.loads(f.read(length).decode('utf-8'))
+    info['version'] = version
+    info['dtype'] = dtype_from_json(info['dtype'])
+    return info, PREAMBLE.size + length
+
+def is_structured(fn):
+    return read_header(fn)[0] is not None
+
+def load(fn, mode='r'):
+    """Memory-map the records of a structured file. A record that was
+    only partly written when the session ended is left out."""
+    info, offset = read_header(fn)
+    if info is None:
+        raise ValueError("%s is not a structured gnoom file" % fn)
+    nrecords = (os.path.getsize(fn) - offset) // info['dtype'].itemsize
+    if nrecords == 0:
+        return np.empty((0,), dtype=info['dtype'])
+    return np.memmap(fn, dtype=info['dtype'], mode=mode, offset=offset, shape=(nrecords,))
+
+def load_session(trunk):
+    """Memory-map all structured streams of a training session, e.g.
+    trunk = ".../train_0001"; streams that don't exist are skipped"""
+    streams = {}
+    for stream, fn in [('move', trunk + ".move"), ('events', trunk + ".events"),
+                       ('position', trunk + ".position"), ('loom', trunk + "_loom"),
+                       ('lick', trunk + "_lick")]:
+        if os.path.exists(fn) and is_structured(fn):
+            streams[stream] = load(fn)
+    return streams
+
+class LegacyFormat(object):
+    """Record packing of the original files"""
+    name = "legacy"
+
+    def header(self, stream, meta=None):
+        return b''
+
+    def move(self, t, n1, n2, sum1=None, sum2=None):
+        data = np.array([t, n1, n2], dtype=np.float32).tobytes()
+        if n1:
+            data += np.array(sum1, dtype=np.float32).tobytes()
+        if n2:
+            data += np.array(sum2, dtype=np.float32).tobytes()
+        return data
+
+    def position(self, t, translation, position, orientation):
+        return np.array(list(translation) + list(position) + list(orientation),
+                        dtype=np.float64).tobytes()
+
+    def event(self, t, code):
+        return np.array([t,], dtype=np.float32).tobytes() + code
+
+    def lick(self, t, amplitude):
+        return np.array([t,], dtype=np.float32).tobytes() + \
+            np.array([amplitude], dtype=np.float64).tobytes()
+
+    def loom(self, position, scale):
+        return np.array(list(position) + list(scale), dtype=np.float64).tobytes()
+
+class StructuredFormat(object):
+    """Record packing of the self-describing files"""
+    name = "structured"
+
+    def header(self, stream, meta=None):
+        return header(stream, meta)
+
+    def _pack(self, stream, *values):
+        rec = np.zeros((1,), dtype=DTYPES[stream])
+        rec[0] = values
+        return rec.tobytes()
+
+    def move(self, t, n1, n2, sum1=None, sum2=None):
+        if not n1:
+            sum1 = (0, 0)
+        if not n2:
+            sum2 = (0, 0)
+        return self._pack('move', t, n1, n2, sum1[0], sum1[1], sum2[0], sum2[1])
+
+    def position(self, t, translation, position, orientation):
+        return self._pack('position', t, translation, position, orientation)
+
+    def event(self, t, code):
+        if len(code) > EVENTCODESIZE:
+            raise ValueError("Event code %r is longer than %d bytes" % (code, EVENTCODESIZE))
+        return self._pack('events', t, code)
+
+    def lick(self, t, amplitude):
+        return self._pack('lick', t, amplitude)
+
+    def loom(self, position, scale):
+        return self._pack('loom', position, scale)
+
+FORMATS = {"legacy": LegacyFormat(), "structured": StructuredFormat()}
+
+def get_format(name):
+    return FORMATS[name]
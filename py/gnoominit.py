@@ -1,11 +1,15 @@
 import os
 import sys
+import atexit
 import time
 import numpy as np
 import bge.logic as GameLogic
 import settings
 import nicomedilib as ncl
 import arduino_serial
+import serialbroker
+import pumpdriver
+import gnoomread
 import serial
 import xinput
 import random
@@ -14,9 +18,12 @@ import copy
 from PIL import Image
 
 import gnoomcomm as gc
+import gnoomproto as gp
 import gnoomio as gio
 import gnoomutils as gu
 import chooseWalls
+import connhub
+import shmring
 
 if settings.gratings:
     import chooseWalls
@@ -58,7 +65,11 @@ def init():
     # open arduino and pump
 
     try:
-        arduino = arduino_serial.SerialPort(settings.arduino_port, 19200)
+        if getattr(settings, 'serial_broker', False):
+            # Shared with the lick readers through a broker process
+            arduino = serialbroker.open_port(settings.arduino_port, 19200)
+        else:
+            arduino = arduino_serial.SerialPort(settings.arduino_port, 19200)
         sys.stdout.write("BLENDER: Successfully opened arduino on {0}\n".format(settings.arduino_port))
     except OSError:
         sys.stdout.write("BLENDER: Failed to open arduino\n")
@@ -73,7 +84,11 @@ def init():
         arduino.write(b'f')
 
     try:
-        pumppy = serial.Serial(settings.pump_port, 19200, timeout=1)
+        # Commands go to the pump from a thread, so that rewards never
+        # wait for the serial port
+        pumppy = pumpdriver.PumpDriver(serial.Serial(settings.pump_port, 19200, timeout=1))
+        pumppy.start()
+        atexit.register(pumppy.stop)
         sys.stdout.write("BLENDER: Successfully opened pump\n")
         gc.setPumpVolume(pumppy, settings.reward_volume)
     except:
@@ -86,18 +101,14 @@ def init():
             print("BLENDER: Could not find " + fn_pos)
             settings.replay_track = None
         else:
-            sys.path.append(os.path.expanduser("~/../cs/py2p/tools"))
-            import training
             print("BLENDER: Reading replay track from " + fn_pos)
-            GameLogic.Object['replay_pos'] = training.read_pos(
-                fn_pos, 1e9, False, meters=False)
+            GameLogic.Object['replay_pos'] = gnoomread.read_pos(fn_pos)
             posy = GameLogic.Object['replay_pos'][1]
-            replay_time, _, _, _, _ = training.read_move(
+            replay_time, _, _, _, _ = gnoomread.read_move(
                 settings.replay_track + ".move")
-            evlist, timeev = training.read_events(
-                settings.replay_track + ".events", teleport_times=None)
-            GameLogic.Object['replay_rewards'] = np.array([
-                ev.time for ev in evlist if ev.evcode == b'RE'])
+            evtimes, evcodes = gnoomread.read_events(
+                settings.replay_track + ".events")
+            GameLogic.Object['replay_rewards'] = evtimes[evcodes == b'RE']
             GameLogic.Object['replay_rewards'] = np.sort(GameLogic.Object['replay_rewards'])
             if settings.replay_rewards_shuffle:
                 intervals = np.diff([0] + GameLogic.Object['replay_rewards'].tolist())
@@ -208,10 +219,21 @@ def init():
     GameLogic.Object['lapRotated'] = False
 
     blenderpath = GameLogic.expandPath('//')
+
+    use_shm = settings.cpp and settings.readlib == "xinput" and \
+        not settings.usezmq and getattr(settings, 'mouse_shm', False)
+    
+    # All children are launched first and finish their handshakes
+    # together, so that startup takes as long as the slowest child
+    children = []
+    zmqmice = []
     
+    mousecmds = []
+    mousekw = {}
     if not settings.cpp:
-        s1, conn1, addr1, p1 = gc.spawn_process("\0mouse0socket", ['python3', '%s/py/usbclient.py' % blenderpath, '0'])
-        s2, conn2, addr2, p2 = gc.spawn_process("\0mouse1socket", ['python3', '%s/py/usbclient.py' % blenderpath, '1'])
+        mousecmds = [
+            ('m1', "\0mouse0socket", ['python3', '%s/py/usbclient.py' % blenderpath, '0']),
+            ('m2', "\0mouse1socket", ['python3', '%s/py/usbclient.py' % blenderpath, '1'])]
     else:
         if settings.readlib=="xinput":
             mice = xinput.find_mice(model=settings.mouse)
@@ -220,34 +242,46 @@ def init():
                 xinput.switch_mode(mouse)
             if settings.usezmq:
                 procname = 'readout_zmq'
+            elif use_shm:
+                procname = 'readout_shm'
             else:
                 procname = 'readout'
+            mousekw = dict(usezmq=settings.usezmq, framed=True, stream=gp.MOUSE)
             if len(mice)>=1:
-                s1, conn1, addr1, p1 = \
-                    gc.spawn_process(
-                        "\0mouse0socket", 
-                        [('%s/cpp/generic-ev/' % blenderpath) + procname, '%d' % mice[0].evno, '0'],
-                        usezmq=settings.usezmq)
-            else:
-                s1, conn1, addr1, p1 = None, None, None, None
+                mousecmds.append(
+                    ('m1', "\0mouse0socket", 
+                     [('%s/cpp/generic-ev/' % blenderpath) + procname, '%d' % mice[0].evno, '0']))
             if len(mice)>=3:
-                s2, conn2, addr2, p2 = \
-                    gc.spawn_process(
-                        "\0mouse1socket", 
-                        [('%s/cpp/generic-ev/readout' % blenderpath) + procname, '%d' % mice[2].evno, '1'],
-                        usezmq=settings.usezmq)
-            else:
-                s2, conn2, addr2, p2 = None, None, None, None
+                mousecmds.append(
+                    ('m2', "\0mouse1socket", 
+                     [('%s/cpp/generic-ev/readout' % blenderpath) + procname, '%d' % mice[2].evno, '1']))
         elif settings.readlib=="libusb":
-            s1, conn1, addr1, p1 = \
-                gc.spawn_process("\0mouse1socket", 
-                              ['%s/cpp/g500-usb/readout' % blenderpath, '1'])
-            s2, conn2, addr2, p2 = \
-                gc.spawn_process("\0mouse0socket", 
-                              ['%s/cpp/g500-usb/readout' % blenderpath, '0'])
-        else:    
-            s1, conn1, addr1, p1, s2, conn2, add2, p2 = \
-                None, None, None, None, None, None, None, None
+            mousecmds = [
+                ('m1', "\0mouse1socket", ['%s/cpp/g500-usb/readout' % blenderpath, '1']),
+                ('m2', "\0mouse0socket", ['%s/cpp/g500-usb/readout' % blenderpath, '0'])]
+
+    GameLogic.Object['m1conn'] = None
+    GameLogic.Object['m2conn'] = None
+    GameLogic.Object['m1ring'] = None
+    GameLogic.Object['m2ring'] = None
+    for mkey, sockname, cmd in mousecmds:
+        if not settings.cpp:
+            hello = None
+        elif use_shm:
+            # Samples go through a shared-memory ring; the socket
+            # is only used for control messages
+            ring = shmring.ShmRing(
+                "gnoom-mouse%d-%d" % (int(mkey[1])-1, os.getpid()), create=True)
+            atexit.register(ring.close)
+            GameLogic.Object[mkey + 'ring'] = ring
+            hello = b'start' + ring.name.encode('latin-1')
+        else:
+            hello = b'start'
+        if settings.usezmq:
+            s, conn, addr, p = gc.spawn_process(sockname, cmd, **mousekw)
+            zmqmice.append((mkey, conn, hello))
+        else:
+            children.append(gc.launch_child(mkey + 'conn', sockname, cmd, hello, **mousekw))
 
     if settings.has_fw:
         if not settings.fw_local:
@@ -255,93 +289,96 @@ def init():
             sfw, connfw, addrfw = gc.spawn_process_net(GameLogic.Object['fwip'])
             if connfw is None:
                 settings.has_fw = False
+            else:
+                connfw.send(GameLogic.Object['fw_trunk'].encode('latin-1'))
+                gc.recv_ready(connfw)
+                connfw.setblocking(0)
+                GameLogic.Object['fwconn'] = connfw
         else:
-            sys.stdout.write("BLENDER: Starting fw... ")
-            sys.stdout.flush()
-            sfw, connfw, addrfw, pfw = \
-                gc.spawn_process("\0fwsocket", ['%s/cpp/dc1394/dc1394' % blenderpath,], #MC2015
-                              system=False, addenv={"SDL_VIDEO_WINDOW_POS":"\"1280,480\""})
-            print("done")
-
-        connfw.send(GameLogic.Object['fw_trunk'].encode('latin-1'))
-        gc.recv_ready(connfw)
-        connfw.setblocking(0)
-        GameLogic.Object['fwconn'] = connfw
-
-    GameLogic.Object['has_fw'] = settings.has_fw
+            print("BLENDER: Starting fw")
+            children.append(gc.launch_child(
+                'fwconn', "\0fwsocket", ['%s/cpp/dc1394/dc1394' % blenderpath,], #MC2015
+                GameLogic.Object['fw_trunk'].encode('latin-1'),
+                system=False, addenv={"SDL_VIDEO_WINDOW_POS":"\"1280,480\""}))
 
     if settings.has_usb3:
-        sys.stdout.write("BLENDER: Starting usb3... ")
-        sys.stdout.flush()
-        susb3, connusb3, addrusb3, pusb3 = \
-            gc.spawn_process(
-                "\0" + settings.usb3_pupil,
-                ['{0}/cpp/usb3/arv-camera-test'.format(blenderpath),
-                 '-n', settings.usb3_pupil], #MC2015
-                system=False, addenv={"SDL_VIDEO_WINDOW_POS":"\"1280,480\""})
-        print("done")
-        print("Sending usb3 file name " + GameLogic.Object['fw_trunk'])
-        connusb3.send(GameLogic.Object['fw_trunk'].encode('latin-1'))
-        gc.recv_ready(connusb3)
-        connusb3.setblocking(0)
-        GameLogic.Object['usb3conn'] = connusb3
+        print("BLENDER: Starting usb3, file name " + GameLogic.Object['fw_trunk'])
+        children.append(gc.launch_child(
+            'usb3conn', "\0" + settings.usb3_pupil,
+            ['{0}/cpp/usb3/arv-camera-test'.format(blenderpath),
+             '-n', settings.usb3_pupil], #MC2015
+            GameLogic.Object['fw_trunk'].encode('latin-1'),
+            system=False, addenv={"SDL_VIDEO_WINDOW_POS":"\"1280,480\""}))
         if settings.usb3_body is not None:
-            s2usb3, conn2usb3, addr2usb3, p2usb3 = \
-                gc.spawn_process(
-                    "\0" + settings.usb3_body,
-                    ['{0}/cpp/usb3/arv-camera-test'.format(blenderpath),
-                     '-n', settings.usb3_body], #MC2015
-                    system=False, addenv={"SDL_VIDEO_WINDOW_POS":"\"1280,480\""})
-            print("done")
-            print("Sending usb3 file name " + GameLogic.Object['fw_trunk'] + 'body')
-            conn2usb3.send((GameLogic.Object['fw_trunk'] + 'body').encode('latin-1'))
-            gc.recv_ready(conn2usb3)
-            conn2usb3.setblocking(0)
-            GameLogic.Object['usb3conn2'] = conn2usb3
+            print("BLENDER: Starting usb3, file name " + GameLogic.Object['fw_trunk'] + 'body')
+            children.append(gc.launch_child(
+                'usb3conn2', "\0" + settings.usb3_body,
+                ['{0}/cpp/usb3/arv-camera-test'.format(blenderpath),
+                 '-n', settings.usb3_body], #MC2015
+                (GameLogic.Object['fw_trunk'] + 'body').encode('latin-1'),
+                system=False, addenv={"SDL_VIDEO_WINDOW_POS":"\"1280,480\""}))
 
-    GameLogic.Object['has_usb3'] = settings.has_usb3
-    
     if settings.has_comedi and ncl.has_comedi:
-        scomedi, conncomedi, addrcomedi, pcomedi = \
-            gc.spawn_process("\0comedisocket", ['python3', '%s/py/nicomedi.py' % blenderpath,])
-
-        conncomedi.send(blenderpath.encode('latin-1'))
-        gc.recv_ready(conncomedi)
-        conncomedi.setblocking(0)
-        GameLogic.Object['comediconn'] = conncomedi
+        children.append(gc.launch_child(
+            'comediconn', "\0comedisocket", ['python3', '%s/py/nicomedi.py' % blenderpath,],
+            blenderpath.encode('latin-1'), framed=True))
 
     if settings.has_licksensor:
-        slick, connlick, addrlick, plick = \
-            gc.spawn_process("\0licksocket", ['python3', '%s/py/licksensor.py' % blenderpath,])
-
-        connlick.send(blenderpath.encode('latin-1'))
-        gc.recv_ready(connlick)
-        connlick.setblocking(0)
-        GameLogic.Object['lickconn'] = connlick
+        lickcmd = ['python3', '%s/py/licksensor.py' % blenderpath,]
+        # The arduino pushes lick counts instead of being polled
+        if getattr(settings, 'licksensor_stream', False):
+            lickcmd.append('--stream')
+        if getattr(settings, 'serial_broker', False):
+            lickcmd.append('--broker')
+        children.append(gc.launch_child(
+            'lickconn', "\0licksocket", lickcmd,
+            blenderpath.encode('latin-1'), framed=True, stream=gp.LICKS))
 
     if settings.has_licksensor_piezo:
-        slickpiezo, connlickpiezo, addrlickpiezo, plickpiezo = \
-            gc.spawn_process("\0lickpiezosocket", ['python3', '%s/py/licksensorpiezo.py' % blenderpath,])
-
-        connlickpiezo.send(blenderpath.encode('latin-1'))
-        gc.recv_ready(connlickpiezo)
-        connlickpiezo.setblocking(0)
-        GameLogic.Object['lickpiezoconn'] = connlickpiezo
-
-    if settings.cpp:
-        for mconn in [conn1, conn2]:
-            if mconn is not None:
-                mconn.send(b'start')
-                gc.recv_ready(mconn, usezmq=settings.usezmq)
-                if not settings.usezmq:
-                    mconn.setblocking(0)
- 
-    if len(mice):
-        GameLogic.Object['m1conn'] = conn1
-        GameLogic.Object['m2conn'] = conn2
-    else:
-        GameLogic.Object['m1conn'] = None
-        GameLogic.Object['m2conn'] = None
+        lickpiezocmd = ['python3', '%s/py/licksensorpiezo.py' % blenderpath,]
+        if getattr(settings, 'serial_broker', False):
+            lickpiezocmd.append('--broker')
+            if settings.has_licksensor:
+                # The broker has one listener per device
+                sys.stdout.write("BLENDER: Warning: with serial_broker, only one of the "
+                                 "lick sensors receives the arduino's replies\n")
+        children.append(gc.launch_child(
+            'lickpiezoconn', "\0lickpiezosocket", lickpiezocmd,
+            blenderpath.encode('latin-1'), framed=True, stream=gp.LICKS))
+
+    for connkey, conn in gc.start_children(children).items():
+        if conn is not None:
+            GameLogic.Object[connkey] = conn
+    # Devices whose child did not come up are switched off
+    for connkey, setting in [('fwconn', 'has_fw'), ('usb3conn', 'has_usb3'),
+                             ('comediconn', 'has_comedi'), ('lickconn', 'has_licksensor'),
+                             ('lickpiezoconn', 'has_licksensor_piezo')]:
+        if getattr(settings, setting) and GameLogic.Object.get(connkey) is None:
+            setattr(settings, setting, False)
+
+    for mkey, mconn, hello in zmqmice:
+        mconn.send(hello)
+        gc.recv_ready(mconn, usezmq=True)
+        GameLogic.Object[mkey + 'conn'] = mconn
+
+    GameLogic.Object['has_fw'] = settings.has_fw
+    GameLogic.Object['has_usb3'] = settings.has_usb3
+
+    # Streaming connections are drained with one poll per logic tick
+    hub = connhub.ConnHub()
+    if not settings.usezmq:
+        for mkey in ['m1', 'm2']:
+            if GameLogic.Object[mkey + 'conn'] is not None and \
+               GameLogic.Object[mkey + 'ring'] is None:
+                conn = GameLogic.Object[mkey + 'conn']
+                hub.register(mkey, conn, 32, mtype=gc.framed_conns.get(conn))
+    for connkey, recsize in [('lickconn', 16), ('lickpiezoconn', 16),
+                             ('fwconn', 8), ('usb3conn', 8), ('usb3conn2', 8)]:
+        if GameLogic.Object.get(connkey) is not None:
+            conn = GameLogic.Object[connkey]
+            hub.register(connkey[:-4], conn, recsize, mtype=gc.framed_conns.get(conn))
+    GameLogic.Object['connhub'] = hub
+    atexit.register(hub.report)
 
     GameLogic.Object['tmprec'] = False
     GameLogic.Object['trainrec'] = False
@@ -350,6 +387,11 @@ def init():
     GameLogic.Object['WallTouchTicksCounter'] = None
     GameLogic.Object['OdorTicksCounter'] = None  
     
+    gio.set_session_format()
+    # Files of the first sessions are opened in the background
+    gio.prepare_sessions()
+    atexit.register(gio.close_sessions)
+
     GameLogic.Object['piezolicks'] = 0
     GameLogic.Object['piezoframes'] = 0
     GameLogic.Object['piezoframepause'] = 0
@@ -9,11 +9,28 @@ import numpy as np
 
 import settings
 import cues
+import eventwriter
+import recordwriter
+import gnoomfile
+import offload
+import sessionindex
+import sessionmanager
 import gnoomutils as gu
 import gnoomcomm as gc
+import gnoomproto as gp
+import nicomedilib as ncl
 
 gGid_vr_users=1001
 
+# Reused by write_record_file for the records of every tick
+recblock = recordwriter.RecordBlock()
+
+# Opens session files ahead of time and closes them in the background
+sessions = sessionmanager.SessionManager()
+
+# s that comedi may take to prime its channels
+EPHYS_TIMEOUT = 10.0
+
 
 def write_header(fnheader, fnmov, fnephys, ephysstart, ephysstop):
     hf = open(fnheader, 'w')
@@ -34,6 +51,10 @@ def write_settings(fngain):
     hf.write("gain_rot_ave_1: %.8f\n" % settings.gain_rot_ave_1)
     hf.close()
     
+def make_dir(path, description):
+    if sessionindex.ensure_dir(path, gGid_vr_users): # set grp to vr-users
+        print("BLENDER: Data directory for %s was created:" % description, path)
+
 def create_data_dir():
     if 'win32' in sys.platform:
         return
@@ -46,47 +67,17 @@ def create_data_dir():
 
     today = datetime.date.today()
 
-    # check year
     year_dir = "%d/" % (today.year)
-    if os.path.isdir("%s%s" % (path,year_dir)):
-        print("BLENDER: Data directory for this year exists:", "%s%s" % (path,year_dir))
-    else:
-        os.umask(0)
-        os.mkdir("%s%s" % (path,year_dir), 0o775)
-        os.chown("%s%s" % (path,year_dir), -1, gGid_vr_users) # set grp to vr_users
-        print("BLENDER: Data directory for this year was created:", "%s%s" % (path,year_dir))
-
-    # check month
+    make_dir("%s%s" % (path,year_dir), "this year")
     month_dir = "%s%d-%02d/" % (year_dir,today.year,today.month)
-    if os.path.isdir("%s%s" % (path,month_dir)):
-        print("BLENDER: Data directory for this month exists:", "%s%s" % (path,month_dir))
-    else:
-        os.umask(0)
-        os.mkdir("%s%s" % (path,month_dir), 0o775)
-        os.chown("%s%s" % (path,month_dir), -1, gGid_vr_users) # set grp to vr-users
-        print("BLENDER: Data directory for this month was created:", "%s%s" % (path,month_dir))
-
-    # check day
+    make_dir("%s%s" % (path,month_dir), "this month")
     day_dir = "%s%d-%02d-%02d/" \
          % (month_dir, today.year, today.month, today.day)
-    if os.path.isdir("%s%s" % (path,day_dir)):
-        print("BLENDER: Data directory for today exists:", "%s%s" % (path,day_dir))
-    else:
-        os.umask(0)
-        os.mkdir("%s%s" % (path,day_dir), 0o775)
-        os.chown("%s%s" % (path,day_dir), -1, gGid_vr_users) # set grp to vr-users
-        print("BLENDER: Data directory for today was created:", "%s%s" % (path,day_dir))
-
-    # check day
+    make_dir("%s%s" % (path,day_dir), "today")
     user_dir = "%s/%s/" \
          % (day_dir, settings.experimenter)
-    if os.path.isdir("%s%s" % (path,user_dir)):
-        print("BLENDER: Data directory for today exists:", "%s%s" % (path,user_dir))
-    else:
-        os.umask(0)
-        os.mkdir("%s%s" % (path,user_dir), 0o775)
-        os.chown("%s%s" % (path,user_dir), -1, gGid_vr_users) # set grp to vr-users
-        print("BLENDER: Data directory for today was created:", "%s%s" % (path,user_dir))
+    make_dir("%s%s" % (path,user_dir), settings.experimenter)
+    print("BLENDER: Data directory:", "%s%s" % (path,user_dir))
 
     GameLogic.Object['day_dir'] = "%s%s" % (path, user_dir)
     GameLogic.Object['data_trunk'] = "%s%s%d%02d%02d" \
@@ -94,47 +85,63 @@ def create_data_dir():
     GameLogic.Object['fw_trunk'] = "%s%d%02d%02d" \
         % (user_dir, today.year, today.month, today.day)
 
-def create_train_dir(animal):
+def train_paths(animal):
+    """Directory and file trunk of today's training sessions; the
+    directory is created if necessary"""
     if os.uname()[0] == "Darwin":
         path = "/Users/%s/data/training" % os.getlogin()
     else:
         # path = "/home/%s/data/" % os.getlogin()
         path = "%s/training" % settings.gPath
 
-    if os.path.isdir("%s/%s" % (path,animal)):
-        print("BLENDER: Data directory for this animal exists:", "%s/%s" % (path,animal))
-    else:
-        os.umask(0)
-        os.mkdir("%s/%s" % (path,animal), 0o775)
-        os.chown("%s/%s" % (path,animal), -1, gGid_vr_users) # set grp to vr-users
-        print("BLENDER: Data directory for this animal was created:", "%s/%s" % (path,animal))
+    make_dir("%s/%s" % (path,animal), "this animal")
 
     today = datetime.date.today()
 
-    GameLogic.Object['train_dir'] = "%s/%s" % (path, animal)
-    GameLogic.Object['train_trunk'] = "%s/%s/2p%d%02d%02d" \
+    return "%s/%s" % (path, animal), "%s/%s/2p%d%02d%02d" \
         % (path, animal, today.year, today.month, today.day)
 
+def create_train_dir(animal):
+    GameLogic.Object['train_dir'], GameLogic.Object['train_trunk'] = train_paths(animal)
+
 def get_next_filename(wildcard = "pck"):
-    no = 0
-    while True:
-        next_file = "%s_%04d.%s" \
-            % (GameLogic.Object['data_trunk'], no, wildcard)
-        if not os.path.isfile(next_file):
-            fw_file = "%s_%04d.%s" \
-                % (GameLogic.Object['fw_trunk'], no, wildcard)
-            return next_file, fw_file
-        no += 1
+    # Numbers after the highest one in use; the file is created here
+    next_file, no = sessionindex.get_index(GameLogic.Object['data_trunk']).create(wildcard)
+    fw_file = "%s_%04d.%s" \
+        % (GameLogic.Object['fw_trunk'], no, wildcard)
+    return next_file, fw_file
 
 def get_next_trainname(wildcard = "bin"):
-    no = 0
-    while True:
-        next_file = "%s_%04d.%s" \
-            % (GameLogic.Object['train_trunk'], no, wildcard)
-        if not os.path.isfile(next_file):
-            return next_file
-        no += 1
+    return sessionindex.get_index(GameLogic.Object['train_trunk']).create(wildcard)[0]
         
+def write_event_record(dt, ev_code):
+    # Time followed by the event code, queued as a single record
+    GameLogic.Object['event_file'].write(
+        GameLogic.Object['session_format'].event(dt, ev_code))
+
+def open_event_file(fn):
+    return eventwriter.EventWriter(
+        fn, flush_interval=getattr(settings, 'event_flush_interval', eventwriter.FLUSH_INTERVAL))
+
+def set_session_format():
+    # Fixed for the whole session, so that all its files match
+    GameLogic.Object['session_format'] = gnoomfile.get_format(
+        getattr(settings, 'session_format', 'legacy'))
+
+def open_stream(fn, stream, events=False, fmt=None):
+    """Open the file of one stream and write its header, if the
+    session format has one"""
+    if fmt is None:
+        fmt = GameLogic.Object['session_format']
+    if events:
+        f = open_event_file(fn)
+    else:
+        f = open(fn, 'wb')
+    header = fmt.header(stream)
+    if len(header):
+        f.write(header)
+    return f
+
 def write_reward(newy, reward_success=True):
     if GameLogic.Object['train_open'] or GameLogic.Object['file_open']:
         time1 = time.time()
@@ -142,18 +149,19 @@ def write_reward(newy, reward_success=True):
             dt = time1 -  GameLogic.Object['train_tstart']
         else:
             dt = time1 -  GameLogic.Object['time0']
+        if reward_success:
+            ev_code = b'RE'
+        else:
+            ev_code = b'RF'
         try:
-            GameLogic.Object['event_file'].write(np.array([dt,], dtype=np.float32).tostring())
+            write_event_record(dt, ev_code)
         except ValueError:
             sys.stderr.write("BLENDER: Error - writing to closed reward file\n")
             return
         if reward_success:
             sys.stdout.write("%s Reward %d; position: %d\n" % (gu.time2str(dt), GameLogic.Object['rewcount'], newy))
-            GameLogic.Object['event_file'].write(b'RE')
         else:
             sys.stdout.write("%s No reward %d; position: %d\n" % (gu.time2str(dt), GameLogic.Object['rewfail'], newy))
-            GameLogic.Object['event_file'].write(b'RF')
-        GameLogic.Object['event_file'].flush()
 
 #        if GameLogic.Object['file_open']:
 #            pickle.dump(("reward", newx, newy),
@@ -162,6 +170,7 @@ def write_reward(newy, reward_success=True):
 
 def write_licks(licks):
     if GameLogic.Object['train_open'] or GameLogic.Object['file_open']:
+        records = []
         for nlick in range(licks.shape[0]):
             if licks[nlick, 1] > 0:
                 time1 = licks[nlick, 0]
@@ -171,24 +180,24 @@ def write_licks(licks):
                    dt = time1 -  GameLogic.Object['time0']
                 
                 for nl in range(int(np.round(licks[nlick, 1]))):
-                    GameLogic.Object['event_file'].write(np.array([dt,], dtype=np.float32).tostring())
+                    records.append(GameLogic.Object['session_format'].event(dt, b'LI'))
                     sys.stdout.write("%s lick\n" % (gu.time2str(dt)))
-                    GameLogic.Object['event_file'].write(b'LI')
-                    GameLogic.Object['event_file'].flush()
+        if len(records):
+            GameLogic.Object['event_file'].write(b''.join(records))
 
 def write_licks_piezo(licks):
     if GameLogic.Object['train_open'] or GameLogic.Object['file_open']:
         if licks.shape[0] > 0:
             if np.any(licks[:, 1]):
+                records = []
                 for nlick in range(licks.shape[0]):
                     time1 = licks[nlick, 0]
                     if GameLogic.Object['train_open']:
                         dt = time1 -  GameLogic.Object['train_tstart']
                     else:
                         dt = time1 -  GameLogic.Object['time0']
-                    GameLogic.Object['current_lickfile'].write(np.array([dt,], dtype=np.float32).tostring())
-                    GameLogic.Object['current_lickfile'].write(np.array([licks[nlick, 1]], dtype=np.float64).tostring())
-                    GameLogic.Object['current_lickfile'].flush()
+                    records.append(GameLogic.Object['session_format'].lick(dt, licks[nlick, 1]))
+                GameLogic.Object['current_lickfile'].write(b''.join(records))
 
 def write_valve(cmd):
     if GameLogic.Object['train_open'] or GameLogic.Object['file_open']:
@@ -198,9 +207,7 @@ def write_valve(cmd):
         else:
            dt = time1 -  GameLogic.Object['time0']
 
-        GameLogic.Object['event_file'].write(np.array([dt,], dtype=np.float32).tostring())
-        GameLogic.Object['event_file'].write(b'V' + cmd)
-        GameLogic.Object['event_file'].flush()
+        write_event_record(dt, b'V' + cmd)
 
 def write_puff():
     if GameLogic.Object['train_open'] or GameLogic.Object['file_open']:
@@ -210,10 +217,8 @@ def write_puff():
         else:
            dt = time1 -  GameLogic.Object['time0']
 
-        GameLogic.Object['event_file'].write(np.array([dt,], dtype=np.float32).tostring())
+        write_event_record(dt, b'AP')
         sys.stdout.write("%s Airpuff %d\n" % (gu.time2str(dt), GameLogic.Object['puffcount']))
-        GameLogic.Object['event_file'].write(b'AP')
-        GameLogic.Object['event_file'].flush()
 
 def save_event(ev_code):
     if GameLogic.Object['train_open'] or GameLogic.Object['file_open']:
@@ -223,10 +228,8 @@ def save_event(ev_code):
         else:
            dt = time1 -  GameLogic.Object['time0']
 
-        GameLogic.Object['event_file'].write(np.array([dt,], dtype=np.float32).tostring())
+        write_event_record(dt, ev_code.encode('utf_8'))
         sys.stdout.write("%s Saved event %s\n" % (gu.time2str(dt),ev_code))
-        GameLogic.Object['event_file'].write(ev_code.encode('utf_8'))
-        GameLogic.Object['event_file'].flush()
 
 def write_training_file(move, xtranslate, ytranslate, zrotate):
     # get controller
@@ -278,40 +281,130 @@ def write_training_file(move, xtranslate, ytranslate, zrotate):
         frametimefw = np.array([0,])
     sys.stdout.write("%s\r" % (gu.time2str(dt)))
 
-    GameLogic.Object['train_file'].write(np.array([dt,
-        len(move[0]), len(move[2])], dtype=np.float32).tostring())
+    fmt = GameLogic.Object['session_format']
     # 0:x1, 1:y1, 2:x2, 3:y2, 4:t1, 5:t2, 6:dt1, 7:dt2
-    GameLogic.Object['train_file'].flush()
+    sum1, sum2 = None, None
     if len(move[0]):
-        GameLogic.Object['train_file'].write(np.array([
-            move[0].sum(), move[1].sum()], dtype=np.float32).tostring())
+        sum1 = (move[0].sum(), move[1].sum())
     if len(move[2]):
-        GameLogic.Object['train_file'].write(np.array([
-            move[2].sum(), move[3].sum()], dtype=np.float32).tostring())
-    if len(move[0]) or len(move[2]):
-        GameLogic.Object['train_file'].flush()
-    GameLogic.Object['pos_file'].write(np.array([ 
-                xtranslate, ytranslate, zrotate, 
-                own.position[0], own.position[1], own.position[2],
-                own.orientation[0][0], own.orientation[0][1], own.orientation[0][2], 
-                own.orientation[1][0], own.orientation[1][1], own.orientation[1][2], 
-                own.orientation[2][0], own.orientation[1][2], own.orientation[2][2],
-                ], dtype=np.float64).tostring())
+        sum2 = (move[2].sum(), move[3].sum())
+    GameLogic.Object['train_file'].write(
+        fmt.move(dt, len(move[0]), len(move[2]), sum1, sum2))
+    GameLogic.Object['train_file'].flush()
+    GameLogic.Object['pos_file'].write(fmt.position(dt,
+                [xtranslate, ytranslate, zrotate],
+                [own.position[0], own.position[1], own.position[2]],
+                [own.orientation[0][0], own.orientation[0][1], own.orientation[0][2],
+                 own.orientation[1][0], own.orientation[1][1], own.orientation[1][2],
+                 own.orientation[2][0], own.orientation[1][2], own.orientation[2][2]]))
     GameLogic.Object['pos_file'].flush()
     
+def _add_stream(session, key, fn, stream, events=False):
+    session['files'][key] = open_stream(fn, stream, events, session['format'])
+    session['paths'].append(fn)
+
+def prepare_training():
+    """Create and open the files of the next training session; runs on
+    the session worker"""
+    train_dir, train_trunk = train_paths(settings.gAnimal)
+    fn = sessionindex.get_index(train_trunk).create("move")[0]
+    session = {'kind': 'train', 'fn': fn, 'date': datetime.date.today(),
+               'train_dir': train_dir, 'train_trunk': train_trunk,
+               'format': GameLogic.Object['session_format'], 'files': {}, 'paths': []}
+    _add_stream(session, 'train_file', fn, 'move')
+    _add_stream(session, 'event_file', fn[:-4] + "events", 'events', events=True)
+    _add_stream(session, 'pos_file', fn[:-4] + "position", 'position')
+    if settings.looming:
+        _add_stream(session, 'current_loomfile', fn[:-5] + "_loom", 'loom')
+    if settings.has_licksensor_piezo:
+        _add_stream(session, 'current_lickfile', fn[:-5] + "_lick", 'lick', events=True)
+    return session
+
+def prepare_record():
+    """Create and open the files of the next recording; runs on the
+    session worker"""
+    fn, fnfw = get_next_filename("bin")
+    session = {'kind': 'record', 'fn': fn, 'fnfw': fnfw, 'date': datetime.date.today(),
+               'format': GameLogic.Object['session_format'],
+               'files': {'current_file': open(fn, 'wb')}, 'paths': [fn],
+               'ephysstart': None}
+    if settings.looming:
+        _add_stream(session, 'current_loomfile', fn[:-4] + "_loom", 'loom')
+    if settings.has_licksensor_piezo:
+        _add_stream(session, 'current_lickfile', fn[:-4] + "_lick", 'lick', events=True)
+    _add_stream(session, 'event_file', fn[:-4] + "_events", 'events', events=True)
+    return session
+
+def close_session_files(session):
+    for f in session['files'].values():
+        f.close()
+
+def remove_session(session):
+    # Prepared but never started; its files are still empty
+    close_session_files(session)
+    for fn in session['paths']:
+        if os.path.exists(fn):
+            os.remove(fn)
+
+def take_session(kind, prepare):
+    session = sessions.take(kind, prepare)
+    if session['date'] != datetime.date.today():
+        # Prepared before midnight
+        remove_session(session)
+        session = prepare()
+    if getattr(settings, 'session_prepare', True):
+        sessions.prepare(kind, prepare)
+    # Switch to the files of the new session
+    GameLogic.Object['session_format'] = session['format']
+    GameLogic.Object.update(session['files'])
+    GameLogic.Object['current_session'] = session
+    return session
+
+def prepare_sessions():
+    """Open the files of the first training session and recording in the
+    background; called once at startup"""
+    if 'win32' in sys.platform or not getattr(settings, 'session_prepare', True):
+        return
+    sessions.prepare('train', prepare_training)
+    if 'data_trunk' in GameLogic.Object.keys():
+        sessions.prepare('record', prepare_record)
+
+def close_sessions():
+    """Remove the files of sessions that were prepared but not started
+    and finish all background work"""
+    sessions.discard('train', remove_session)
+    sessions.discard('record', remove_session)
+    sessions.stop()
+
+def write_session_files(session, blenderpath, walls, tstart=None):
+    # Runs on the session worker
+    fn = session['fn']
+    # Transfers of earlier sessions slow down while this one runs
+    offload.set_live(True)
+    if session['kind'] == 'train':
+        t0file = open(fn[:-4] + "t0", "wb")
+        t0file.write(np.array([tstart], dtype=np.float64))
+        t0file.close()
+    else:
+        write_settings(fn[:-4] + "_settings.txt")
+
+    # Copy current settings:
+    shutil.copyfile('%s/py/settings.py' % blenderpath, fn[:-4] + "_settings.py")
+    if walls is not None:
+        cues.write_gratings(walls)
+
+def finish_training(session):
+    # Runs on the session worker
+    close_session_files(session)
+    offload.set_live(False)
+
 def stop_training_file():
-    GameLogic.Object['train_file'].close()
-    GameLogic.Object['event_file'].close()
-    GameLogic.Object['pos_file'].close()
+    GameLogic.Object['train_open'] = False
     if settings.looming:
-        GameLogic.Object['current_loomfile'].close()
         GameLogic.Object['loomcounter'] = 0
         GameLogic.Object['loom_first_trial'] = 0
-    if settings.has_licksensor_piezo:
-        GameLogic.Object['current_lickfile'].close()
     train_tend = time.time()-GameLogic.Object['train_tstart']
     sys.stdout.write("BLENDER: Closing file; recorded %s of training\n" % (gu.time2str(train_tend)))
-    GameLogic.Object['train_open'] = False
     if GameLogic.Object['has_fw']:
         gc.safe_send(GameLogic.Object['fwconn'], 'stop', '')
     if GameLogic.Object['has_usb3']:
@@ -322,28 +415,20 @@ def stop_training_file():
     if arduino is not None:
         gc.write_arduino_nonblocking(arduino, b'd')
     GameLogic.Object['bcstatus']=False
+    # The event writers drain their queues while they are closed
+    sessions.submit("closing training files", finish_training,
+                    GameLogic.Object['current_session'])
     
 def start_training_file():
-    # Start recordings
-    create_train_dir(settings.gAnimal)
-    fn = get_next_trainname("move")
-    fn_events = fn[:-4] + "events"
-    fn_pos = fn[:-4] + "position"
-    fn_t0 = fn[:-4] + "t0"
+    # Start recordings; the files were opened in the background
+    session = take_session('train', prepare_training)
+    fn = session['fn']
+    GameLogic.Object['train_dir'] = session['train_dir']
+    GameLogic.Object['train_trunk'] = session['train_trunk']
     
     sys.stdout.write("BLENDER: Writing training to:\n") 
     sys.stdout.write("         %s\n" % fn)
-    sys.stdout.write("         %s\n" % fn_events)
-    GameLogic.Object['train_file'] = open(fn, 'wb')
-    GameLogic.Object['event_file'] = open(fn_events, 'wb')
-    GameLogic.Object['pos_file'] = open(fn_pos, 'wb')
-
-    if settings.looming:
-        GameLogic.Object['current_loomfile'] = open(
-            fn[:-5] + "_loom", 'wb')
-    if settings.has_licksensor_piezo:
-        GameLogic.Object['current_lickfile'] = open(
-            fn[:-5] + "_lick", 'wb')
+    sys.stdout.write("         %s\n" % (fn[:-4] + "events"))
     GameLogic.Object['current_fwfile'] = fn[:-4] + "avi"
     if GameLogic.Object['has_fw']:
         gc.safe_send(GameLogic.Object['fwconn'], "begin%send" % GameLogic.Object['current_fwfile'],
@@ -358,21 +443,18 @@ def start_training_file():
     GameLogic.Object['train_tstart'] = time.time()
     GameLogic.Object['train_open'] = True
 
-    t0file = open(fn_t0, "wb")
-    t0file.write(np.array([GameLogic.Object['train_tstart']], dtype=np.float64))
-    t0file.close()
-
-    # Copy current settings:
-    fn_settings_py = fn[:-4] + "_settings.py"
-    blenderpath = GameLogic.expandPath('//')
-    shutil.copyfile('%s/py/settings.py' % blenderpath, fn_settings_py)
-
-    cues.write_gratings(GameLogic.Object["current_walls"])
+    sessions.submit("writing training files", write_session_files, session,
+                    GameLogic.expandPath('//'), GameLogic.Object["current_walls"],
+                    GameLogic.Object['train_tstart'])
     
     # line break for printing time:
     sys.stdout.write("\n")
 
 def write_record_file(move, xtranslate, ytranslate, zrotate):
+    if not sessions.armed.is_set():
+        # Electrophysiology is still priming; nothing is recorded
+        # before its trigger
+        return
     time1 = time.time()
     dt = time1 -  GameLogic.Object['time0']
     arduino = GameLogic.Object['arduino']
@@ -401,31 +483,82 @@ def write_record_file(move, xtranslate, ytranslate, zrotate):
             frametimefw = np.concatenate((frametimefw, frametimefw2))
     else:
         frametimefw = np.array([0,])
-    GameLogic.Object['current_file'].write(np.array([dt, 
-        xtranslate, ytranslate, zrotate, 
+    # 0:x1, 1:y1, 2:x2, 3:y2, 4:t1, 5:t2, 6:dt1, 7:dt2
+    recblock.write(GameLogic.Object['current_file'], [dt,
+        xtranslate, ytranslate, zrotate,
         own.position[0], own.position[1], own.position[2],
         time1,
-        own.orientation[0][0], own.orientation[0][1], own.orientation[0][2], 
-        own.orientation[1][0], own.orientation[1][1], own.orientation[1][2], 
-        own.orientation[2][0], own.orientation[1][2], own.orientation[2][2],
-        len(move[0]), len(move[2]), len(frametimefw)], dtype=np.float64).tostring())
-    # 0:x1, 1:y1, 2:x2, 3:y2, 4:t1, 5:t2, 6:dt1, 7:dt2
-    GameLogic.Object['current_file'].flush()
-    for nm in range(len(move[0])):
-        GameLogic.Object['current_file'].write(np.array([
-            move[0][nm], move[1][nm], move[4][nm], move[6][nm]], dtype=np.float64).tostring())
-    for nm in range(len(move[2])):
-        GameLogic.Object['current_file'].write(np.array([
-            move[2][nm], move[3][nm], move[5][nm], move[7][nm]], dtype=np.float64).tostring())
-    if (len(move[0]) or len(move[2])):
-        GameLogic.Object['current_file'].flush()
-    if len(frametimefw) > 0:
-        GameLogic.Object['current_file'].write(frametimefw.tostring())
-        GameLogic.Object['current_file'].flush()
+        own.orientation[0][0], own.orientation[0][1], own.orientation[0][2],
+        own.orientation[1][0], own.orientation[1][1], own.orientation[1][2],
+        own.orientation[2][0], own.orientation[1][2], own.orientation[2][2]],
+        move, frametimefw)
+
+def ephys_time(conn, what):
+    """Time of the last ephys start or stop relative to time0; the local
+    time if comedi doesn't send it within EPHYS_TIMEOUT"""
+    times = gc.parse_ephystimes(conn, EPHYS_TIMEOUT)
+    if times is None:
+        sys.stderr.write("BLENDER: No electrophysiology %s time after %.0f s; "
+                         "using local time\n" % (what, EPHYS_TIMEOUT))
+        return time.time()-GameLogic.Object['time0']
+    return (times-GameLogic.Object['time0'])[0]
+
+def start_ephys(session):
+    # Runs on the session worker, so that the game loop keeps running
+    # while comedi primes its channels
+    conn = GameLogic.Object['comediconn']
+    try:
+        gc.safe_send(conn, "begin%send" % session['ephysfile'],
+                     "BLENDER: Couldn't start electrophysiology; resource unavailable\n")
+
+        # Wait for comedi to initialize the channels before triggering
+        if gc.wait_msg(conn, gp.PRIMED, timeout=EPHYS_TIMEOUT) is None:
+            sys.stderr.write("BLENDER: Electrophysiology not primed after %.0f s; "
+                             "recording without it\n" % EPHYS_TIMEOUT)
+            session['ephysstart'] = time.time()-GameLogic.Object['time0']
+            return
+        ncl.set_trig(GameLogic.Object['outtrigch'], 1)
+
+        # get ephys start time:
+        session['ephysstart'] = ephys_time(conn, "start")
+    except Exception as err:
+        sys.stderr.write("BLENDER: Starting electrophysiology failed: %s\n" % err)
+    finally:
+        # Records are written from the next tick, whatever happened
+        sessions.armed.set()
+        if session.get('ephysstart') is None:
+            session['ephysstart'] = time.time()-GameLogic.Object['time0']
+        GameLogic.Object['ephysstart'] = session['ephysstart']
+
+def finish_record(session, ephysstop):
+    # Runs on the session worker
+    if ephysstop is None:
+        conn = GameLogic.Object['comediconn']
+        try:
+            gc.safe_send(conn, 'stop', '')
+            ncl.set_trig(GameLogic.Object['outtrigch'], 0)
+            ncl.set_trig(GameLogic.Object['outfrch'], 0)
+
+            # get ephys end time:
+            ephysstop = ephys_time(conn, "stop")
+        except Exception as err:
+            sys.stderr.write("BLENDER: Stopping electrophysiology failed: %s\n" % err)
+            ephysstop = time.time()-GameLogic.Object['time0']
+
+    close_session_files(session)
+    offload.set_live(False)
+
+    write_header(session['movfile'][:-4]+"_header.txt",
+                    session['movfile'],
+                    session['ephysfile'],
+                    session['ephysstart'], ephysstop)
 
 def stop_record_file():
     arduino = GameLogic.Object['arduino']
 
+    print("BLENDER: Closing file")
+    GameLogic.Object['file_open'] = False
+
     # Close video and ephys acquisition
     if GameLogic.Object['has_fw']:
         gc.safe_send(GameLogic.Object['fwconn'], 'stop', '')
@@ -435,54 +568,32 @@ def stop_record_file():
             gc.safe_send(GameLogic.Object['usb3conn2'], 'stop', '')
     GameLogic.Object['bcstatus']=False
     if settings.has_comedi and ncl.has_comedi:
-        gc.safe_send(GameLogic.Object['comediconn'], 'stop', '')
-        ncl.set_trig(GameLogic.Object['outtrigch'], 0)
-        ncl.set_trig(GameLogic.Object['outfrch'], 0)
-    
-        # get ephys end time:
-        ephysstop = (parse_ephystimes(GameLogic.Object['comediconn'])-GameLogic.Object['time0'])[0]
+        # finish_record stops comedi and asks for the end time
+        ephysstop = None
     else:
         # TODO: get correct intan ephys end time
         ephysstop = time.time()-GameLogic.Object['time0']
     if arduino is not None:
         gc.write_arduino_nonblocking(arduino, b'd')
 
-    GameLogic.Object['event_file'].close()
-    GameLogic.Object['current_file'].close()
     if settings.looming:
-        GameLogic.Object['current_loomfile'].close()
         GameLogic.Object['loomcounter'] = 0
         GameLogic.Object['loom_first_trial'] = 0
-    if settings.has_licksensor_piezo:
-        GameLogic.Object['current_lickfile'].close()
-    print("BLENDER: Closing file")
-    GameLogic.Object['file_open'] = False
-
-    write_header(GameLogic.Object['current_movfile'][:-4]+"_header.txt", 
-                    GameLogic.Object['current_movfile'], 
-                    GameLogic.Object['current_ephysfile'],
-                    GameLogic.Object['ephysstart'], ephysstop)
+    sessions.submit("closing recording", finish_record,
+                    GameLogic.Object['current_session'], ephysstop)
                     
 def start_record_file():
-    # Start recordings
-    fn, fnfw = get_next_filename("bin")
+    # Start recordings; the files were opened in the background
+    session = take_session('record', prepare_record)
+    fn = session['fn']
     sys.stdout.write("BLENDER: Writing to:\n") 
     sys.stdout.write("         %s\n" % fn)
-    GameLogic.Object['file_open'] = True
-    GameLogic.Object['current_file'] = open(fn, 'wb')
-    GameLogic.Object['current_movfile'] = fn[:-3] + "avi"
-    if settings.looming:
-        GameLogic.Object['current_loomfile'] = open(
-            fn[:-4] + "_loom", 'wb')
-    if settings.has_licksensor_piezo:
-        GameLogic.Object['current_lickfile'] = open(
-            fn[:-4] + "_lick", 'wb')
-    GameLogic.Object['current_fwfile'] = fnfw[:-3] + "avi"
-    GameLogic.Object['current_ephysfile'] = fn[:-3] + "h5"
+    session['movfile'] = fn[:-3] + "avi"
+    session['ephysfile'] = fn[:-3] + "h5"
+    GameLogic.Object['current_movfile'] = session['movfile']
+    GameLogic.Object['current_fwfile'] = session['fnfw'][:-3] + "avi"
+    GameLogic.Object['current_ephysfile'] = session['ephysfile']
     GameLogic.Object['current_settingsfile'] = fn[:-4] + "_settings.txt"
-    write_settings(GameLogic.Object['current_settingsfile'])
-    fn_events = fn[:-4] + "_events"
-    GameLogic.Object['event_file'] = open(fn_events, 'wb')
 
     sys.stdout.write("         %s\n" % GameLogic.Object['current_movfile'])
     sys.stdout.write("         %s\n" % GameLogic.Object['current_ephysfile'])
@@ -498,41 +609,24 @@ def start_record_file():
                       "BLENDER: Couldn't start video; resource unavailable\n")
 
     if settings.has_comedi and ncl.has_comedi:
-        gc.safe_send(GameLogic.Object['comediconn'], "begin%send" % GameLogic.Object['current_ephysfile'],
-                  "BLENDER: Couldn't start electrophysiology; resource unavailable\n")
-
-        # Wait for comedi to initialize the channels before triggering
-        datadec = ""
-        while datadec.find('primed')==-1:
-            try:
-                data = GameLogic.Object['comediconn'].recv(1024)
-                datadec = data.decode('latin-1')
-                print(data)
-            except:
-                pass
-        print("found")
-        ncl.set_trig(outtrigch, 1)
-
-        # get ephys start time:
-        GameLogic.Object['ephysstart'] = (parse_ephystimes(GameLogic.Object['comediconn'])-GameLogic.Object['time0'])[0]
+        # write_record_file waits until start_ephys has triggered
+        sessions.armed.clear()
+        sessions.submit("starting electrophysiology", start_ephys, session)
     else:
         # TODO: get correct intan ephys start time
-        GameLogic.Object['ephysstart'] = time.time()-GameLogic.Object['time0']
+        session['ephysstart'] = time.time()-GameLogic.Object['time0']
+        GameLogic.Object['ephysstart'] = session['ephysstart']
+    GameLogic.Object['file_open'] = True
         
-    # Copy current settings:
-    fn_settings_py = fn[:-4] + "_settings.py"
-    blenderpath = GameLogic.expandPath('//')
-    shutil.copyfile('%s/py/settings.py' % blenderpath, fn_settings_py)
+    walls = None
     if "current_walls" in GameLogic.Object.keys():
-        cues.write_gratings(GameLogic.Object["current_walls"])
+        walls = GameLogic.Object["current_walls"]
+    sessions.submit("writing recording files", write_session_files, session,
+                    GameLogic.expandPath('//'), walls)
     
 def write_looming(circle):
     if 'win32' not in sys.platform:
-        GameLogic.Object['current_loomfile'].write(np.array([
-            circle.worldPosition[0],
-            circle.worldPosition[1],
-            circle.worldPosition[2],
-            circle.localScale.x,
-            circle.localScale.y,
-            circle.localScale.z], dtype=np.float64).tobytes())
+        GameLogic.Object['current_loomfile'].write(GameLogic.Object['session_format'].loom(
+            [circle.worldPosition[0], circle.worldPosition[1], circle.worldPosition[2]],
+            [circle.localScale.x, circle.localScale.y, circle.localScale.z]))
         GameLogic.Object['current_loomfile'].flush()
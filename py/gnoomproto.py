@@ -0,0 +1,135 @@
+"""Framed messages between Blender and its child processes
+
+Every message is an 8-byte header followed by the payload:
+
+    2 bytes  magic b'GN'
+    1 byte   message type
+    1 byte   flags (unused, 0)
+    4 bytes  payload length, little-endian
+
+Framing starts after the initial handshake, in which the child
+receives its start-up string and answers b'ready'. The constants must
+match evread/gnoomproto.h.
+"""
+
+import sys
+import time
+import struct
+import numpy as np
+
+from recvbuffer import RecvBuffer
+
+MAGIC = b'GN'
+HEADER = struct.Struct('<2sBBI')
+HEADERSIZE = HEADER.size
+
+HEARTBEAT = 1   # no payload
+QUIT = 2        # no payload
+CLOSE = 3       # b'close', so that old-style waits still match
+BEGIN = 4       # file name
+STOP = 5        # no payload
+PRIMED = 6      # no payload
+TIMESTAMP = 7   # float64
+TBS = 8         # 1-byte pulse kind, int32 amplitude, float64 send time
+MOUSE = 9       # float64 records [t, dt, x, y]
+LICKS = 10      # float64 records [t, licks]
+FRAMETIMES = 11 # float64
+
+NAMES = {HEARTBEAT: 'heartbeat', QUIT: 'quit', CLOSE: 'close', BEGIN: 'begin',
+         STOP: 'stop', PRIMED: 'primed', TIMESTAMP: 'timestamp', TBS: 'tbs',
+         MOUSE: 'mouse', LICKS: 'licks', FRAMETIMES: 'frametimes'}
+
+TBSPAYLOAD = struct.Struct('<cid')
+
+def pack(mtype, payload=b''):
+    return HEADER.pack(MAGIC, mtype, 0, len(payload)) + bytes(payload)
+
+def pack_str(mtype, s):
+    return pack(mtype, s.encode('latin-1'))
+
+def pack_array(mtype, arr):
+    return pack(mtype, np.ascontiguousarray(arr).tobytes())
+
+def pack_tbs(kind, amp, tsend=None):
+    # The send time lets the receiver measure trigger-to-output latency
+    if tsend is None:
+        tsend = time.time()
+    return pack(TBS, TBSPAYLOAD.pack(kind.encode('latin-1'), amp, tsend))
+
+def unpack_tbs(payload):
+    kind, amp, tsend = TBSPAYLOAD.unpack(bytes(payload))
+    return kind.decode('latin-1'), amp, tsend
+
+def send(conn, mtype, payload=b''):
+    conn.sendall(pack(mtype, payload))
+
+def encode_command(msg):
+    """Translate one of Blender's command strings into a frame"""
+    if msg == '1':
+        return pack(HEARTBEAT)
+    elif msg == 'quit':
+        return pack(QUIT)
+    elif msg == 'stop':
+        return pack(STOP)
+    elif msg.startswith('begintbs') and msg.endswith('send'):
+        return pack_tbs(msg[8], int(msg[9:-4]))
+    elif msg.startswith('begin') and msg.endswith('end'):
+        return pack_str(BEGIN, msg[5:-3])
+    raise ValueError("Unknown command %r" % msg)
+
+class FrameReader(RecvBuffer):
+    """Receive buffer that splits its contents into frames.
+
+    Payloads are memoryviews into the buffer and are only valid until
+    the next fill() or feed().
+    """
+    def __init__(self, bufsize=65536):
+        RecvBuffer.__init__(self, 1, np.uint8, bufsize)
+        self.nframes = 0
+        self.nerrors = 0
+
+    def frames(self):
+        frames = []
+        while self.end - self.start >= HEADERSIZE:
+            magic, mtype, flags, length = HEADER.unpack_from(self.buf, self.start)
+            if magic != MAGIC:
+                # Lost sync; skip ahead to the next magic
+                self.nerrors += 1
+                nextmagic = self.buf.find(MAGIC, self.start+1, self.end)
+                if nextmagic == -1:
+                    self.start = self.end - 1
+                    break
+                self.start = nextmagic
+                continue
+            if self.end - self.start < HEADERSIZE + length:
+                break
+            p0 = self.start + HEADERSIZE
+            frames.append((mtype, self.view[p0:p0+length]))
+            self.start = p0 + length
+        self.nframes += len(frames)
+        return frames
+
+    def read(self, conn):
+        self.fill(conn)
+        return self.frames()
+
+def payload_array(frames, mtype, dtype=np.float64):
+    """Concatenate the payloads of all frames of one type"""
+    payloads = [payload for ftype, payload in frames if ftype == mtype]
+    if len(payloads) == 1:
+        return np.frombuffer(payloads[0], dtype=dtype)
+    return np.frombuffer(b''.join(payloads), dtype=dtype)
+
+def has_frame(frames, mtype):
+    for ftype, payload in frames:
+        if ftype == mtype:
+            return True
+    return False
+
+def get_frame(frames, mtype):
+    """Payload of the last frame of one type, or None"""
+    found = None
+    for ftype, payload in frames:
+        if ftype == mtype:
+            found = payload
+    return found
@@ -0,0 +1,315 @@
+"""Read the files that gnoomio writes
+
+Readers for the legacy training files:
+
+    .position  15 float64 per tick: translation, position, orientation
+    .move      per tick float32 t, n1, n2, then the float32 sums x1, y1
+               if n1 > 0 and x2, y2 if n2 > 0
+    .events    float32 time followed by a 2-byte event code
+    _lick      float32 time followed by a float64 piezo amplitude
+    _loom      6 float64: position and scale of the looming stimulus
+    .t0        float64 start time of the session
+
+Every reader returns numpy arrays without a Python loop over records,
+and also accepts files in the structured format of gnoomfile.
+
+Run it directly to benchmark the readers on generated files:
+
+    python3 gnoomread.py [hours]
+"""
+
+import os
+import sys
+import numpy as np
+
+import gnoomfile
+
+POSSIZE = 15
+MOVEHEADER = 3
+EVENTSIZE = 6
+LICKSIZE = 12
+LOOMSIZE = 6
+# Longest .move record (floats)
+MAXMOVE = MOVEHEADER + 4
+# Floats per block when splitting .move into record starts
+MOVEBLOCK = 4096
+
+def _structured(fn):
+    if gnoomfile.is_structured(fn):
+        return gnoomfile.load(fn)
+    return None
+
+def _fromfile(fn, dtype, recsize):
+    """All complete records of a file of fixed-size records"""
+    data = np.fromfile(fn, dtype=dtype)
+    nrec = len(data) // recsize
+    return data[:nrec*recsize].reshape((nrec, recsize))
+
+def read_t0(fn):
+    return np.fromfile(fn, dtype=np.float64)[0]
+
+def read_pos(fn):
+    """x, y and z position of the player at every tick"""
+    rec = _structured(fn)
+    if rec is not None:
+        return rec['position'].T
+    return _fromfile(fn, np.float64, POSSIZE)[:, 3:6].T
+
+def read_pos_all(fn):
+    """translation (n, 3), position (n, 3) and orientation (n, 9)"""
+    rec = _structured(fn)
+    if rec is not None:
+        return rec['translation'], rec['position'], rec['orientation']
+    data = _fromfile(fn, np.float64, POSSIZE)
+    return data[:, 0:3], data[:, 3:6], data[:, 6:15]
+
+def move_starts(data, blocksize=MOVEBLOCK):
+    """Offsets of the .move records in data (float32).
+
+    The length of a record depends on its own n1 and n2, so the
+    records form a chain. The data is split into blocks. The chains
+    from all MAXMOVE possible entry offsets of every block are followed
+    together, one record per step. The blocks are then linked, and the
+    chain through each block is followed once more from its actual
+    entry offset.
+    """
+    n = len(data)
+    end = n + MAXMOVE # beyond any record
+    nxt = np.full((end + 1,), end, dtype=np.int64)
+    m = max(n - 2, 0)
+    nxt[:m] = np.arange(m) + MOVEHEADER + 2*(data[1:m+1] > 0) + 2*(data[2:m+2] > 0)
+    # An incomplete last record has no successor
+    nxt[:n][nxt[:n] > n] = end
+
+    nblocks = (n + blocksize - 1) // blocksize
+    if nblocks == 0:
+        return np.empty((0,), dtype=np.int64)
+    blockends = np.minimum((np.arange(nblocks) + 1) * blocksize, n)
+    blockstarts = np.arange(nblocks) * blocksize
+    pos = (blockstarts[:, None] + np.arange(MAXMOVE)[None, :]).ravel()
+    limits = np.repeat(blockends, MAXMOVE)
+    active = np.nonzero(pos < limits)[0]
+    while len(active):
+        pos[active] = nxt[pos[active]]
+        active = active[pos[active] < limits[active]]
+    exits = (pos - limits).reshape((nblocks, MAXMOVE)).tolist()
+
+    # Entry offset of every block, following the chain from offset 0
+    offsets = np.empty((nblocks,), dtype=np.int64)
+    offset = 0
+    for nb in range(nblocks):
+        offsets[nb] = offset
+        if offset < MAXMOVE:
+            offset = exits[nb][offset]
+
+    pos = blockstarts + offsets
+    steps = []
+    while True:
+        active = pos < blockends
+        if not active.any():
+            break
+        steps.append(np.where(active, pos, -1))
+        pos = np.where(active, nxt[np.minimum(pos, end)], pos)
+    if not len(steps):
+        return np.empty((0,), dtype=np.int64)
+    starts = np.array(steps).T.ravel()
+    starts = starts[starts >= 0]
+    # Drop the incomplete last record
+    return starts[nxt[starts] <= n]
+
+def read_move(fn):
+    """time, n1, n2 and the sums of the samples of mouse 1 and 2 (n, 2)
+    at every tick; sums are 0 where a mouse had no samples"""
+    rec = _structured(fn)
+    if rec is not None:
+        return (rec['t'], rec['n1'].astype(np.int64), rec['n2'].astype(np.int64),
+                np.column_stack([rec['x1'], rec['y1']]),
+                np.column_stack([rec['x2'], rec['y2']]))
+    data = np.fromfile(fn, dtype=np.float32)
+    starts = move_starts(data)
+    t = data[starts].astype(np.float64)
+    n1 = data[starts+1].astype(np.int64)
+    n2 = data[starts+2].astype(np.int64)
+    sum1 = np.zeros((len(starts), 2), dtype=np.float32)
+    sum2 = np.zeros((len(starts), 2), dtype=np.float32)
+    has1 = n1 > 0
+    has2 = n2 > 0
+    p1 = starts[has1] + MOVEHEADER
+    sum1[has1, 0] = data[p1]
+    sum1[has1, 1] = data[p1+1]
+    p2 = starts[has2] + MOVEHEADER + 2*has1[has2]
+    sum2[has2, 0] = data[p2]
+    sum2[has2, 1] = data[p2+1]
+    return t, n1, n2, sum1, sum2
+
+def _valid_events(t, codes):
+    printable = (codes >= 0x20) & (codes < 0x7f)
+    return np.isfinite(t) & (t >= 0) & printable.all(axis=1)
+
+def read_events(fn):
+    """Times and codes (as 'S2' bytes) of all events.
+
+    All events are 6 bytes long. If some records don't look like
+    events (a code that isn't printable, or a time that isn't a
+    finite positive number), the file is scanned byte by byte past the
+    bad data instead."""
+    rec = _structured(fn)
+    if rec is not None:
+        return rec['t'], rec['code']
+    raw = np.fromfile(fn, dtype=np.uint8)
+    nrec = len(raw) // EVENTSIZE
+    recs = raw[:nrec*EVENTSIZE].reshape((nrec, EVENTSIZE))
+    t = recs[:, :4].copy().view('<f4').ravel()
+    valid = _valid_events(t, recs[:, 4:])
+    if valid.all() and len(raw) == nrec*EVENTSIZE:
+        return t.astype(np.float64), recs[:, 4:].copy().view('S2').ravel()
+    return scan_events(raw)
+
+def scan_events(raw):
+    """Events in raw bytes that may contain garbage or truncated records"""
+    n = len(raw) - EVENTSIZE + 1
+    if n <= 0:
+        return np.empty((0,), dtype=np.float64), np.empty((0,), dtype='S2')
+    # Check a candidate record at every byte offset at once
+    idx = np.arange(n)
+    t = np.ascontiguousarray(raw[idx[:, None] + np.arange(4)]).view('<f4').ravel()
+    codes = raw[idx[:, None] + np.arange(4, EVENTSIZE)]
+    valid = _valid_events(t, codes).tolist()
+    starts = []
+    pos = 0
+    nskipped = 0
+    while pos < n:
+        if valid[pos]:
+            starts.append(pos)
+            pos += EVENTSIZE
+        else:
+            pos += 1
+            nskipped += 1
+    if nskipped:
+        sys.stderr.write("GNOOMREAD: Skipped %d bytes that aren't events\n" % nskipped)
+    starts = np.array(starts, dtype=np.int64)
+    return (t[starts].astype(np.float64),
+            np.ascontiguousarray(codes[starts]).view('S2').ravel())
+
+def read_licks_piezo(fn):
+    """Times and amplitudes from a piezo _lick file"""
+    rec = _structured(fn)
+    if rec is not None:
+        return rec['t'], rec['amplitude']
+    raw = np.fromfile(fn, dtype=np.uint8)
+    nrec = len(raw) // LICKSIZE
+    recs = raw[:nrec*LICKSIZE].reshape((nrec, LICKSIZE))
+    return (recs[:, :4].copy().view('<f4').ravel().astype(np.float64),
+            recs[:, 4:].copy().view('<f8').ravel())
+
+def read_loom(fn):
+    """Position (n, 3) and scale (n, 3) of the looming stimulus"""
+    rec = _structured(fn)
+    if rec is not None:
+        return rec['position'], rec['scale']
+    data = _fromfile(fn, np.float64, LOOMSIZE)
+    return data[:, :3], data[:, 3:]
+
+def _read_move_loop(fn):
+    """Record-by-record reference for the benchmark"""
+    data = np.fromfile(fn, dtype=np.float32).tolist()
+    t, n1, n2, sum1, sum2 = [], [], [], [], []
+    pos = 0
+    while pos + MOVEHEADER <= len(data):
+        nrec = MOVEHEADER + 2*(data[pos+1] > 0) + 2*(data[pos+2] > 0)
+        if pos + nrec > len(data):
+            break
+        t.append(data[pos])
+        n1.append(data[pos+1])
+        n2.append(data[pos+2])
+        p = pos + MOVEHEADER
+        if data[pos+1] > 0:
+            sum1.append(data[p:p+2])
+            p += 2
+        else:
+            sum1.append([0, 0])
+        if data[pos+2] > 0:
+            sum2.append(data[p:p+2])
+        else:
+            sum2.append([0, 0])
+        pos += nrec
+    return (np.array(t), np.array(n1, dtype=np.int64), np.array(n2, dtype=np.int64),
+            np.array(sum1, dtype=np.float32), np.array(sum2, dtype=np.float32))
+
+def _read_events_loop(fn):
+    """Record-by-record reference for the benchmark"""
+    t, codes = [], []
+    with open(fn, 'rb') as f:
+        while True:
+            rec = f.read(EVENTSIZE)
+            if len(rec) < EVENTSIZE:
+                break
+            t.append(np.frombuffer(rec[:4], dtype=np.float32)[0])
+            codes.append(rec[4:])
+    return np.array(t, dtype=np.float64), np.array(codes, dtype='S2')
+
+if __name__ == "__main__":
+    import time
+    import tempfile
+
+    hours = 3.0
+    if len(sys.argv) > 1:
+        hours = float(sys.argv[1])
+    nticks = int(hours * 3600 * 100)
+    nevents = int(hours * 3600 * 2)
+
+    tmpdir = tempfile.mkdtemp(prefix="gnoomread")
+    trunk = os.path.join(tmpdir, "train_0001")
+
+    # Ticks at 100 Hz; mouse 1 moves most of the time, mouse 2 rarely
+    t = np.arange(nticks) * 0.01
+    n1 = np.where(np.random.rand(nticks) < 0.7, np.random.randint(1, 9, nticks), 0)
+    n2 = np.where(np.random.rand(nticks) < 0.3, np.random.randint(1, 9, nticks), 0)
+    sums = np.random.randint(-50, 50, (nticks, 4)).astype(np.float32)
+    reclen = MOVEHEADER + 2*(n1 > 0) + 2*(n2 > 0)
+    starts = np.concatenate([[0], np.cumsum(reclen)[:-1]])
+    move = np.zeros((reclen.sum(),), dtype=np.float32)
+    move[starts] = t
+    move[starts+1] = n1
+    move[starts+2] = n2
+    p1 = starts[n1 > 0] + MOVEHEADER
+    move[p1] = sums[n1 > 0, 0]
+    move[p1+1] = sums[n1 > 0, 1]
+    p2 = starts[n2 > 0] + MOVEHEADER + 2*(n1[n2 > 0] > 0)
+    move[p2] = sums[n2 > 0, 2]
+    move[p2+1] = sums[n2 > 0, 3]
+    move.tofile(trunk + ".move")
+    np.random.randn(nticks, POSSIZE).tofile(trunk + ".position")
+    ev = np.zeros((nevents, EVENTSIZE), dtype=np.uint8)
+    ev[:, :4] = np.sort(np.random.rand(nevents) * nticks * 0.01).astype(
+        np.float32).view(np.uint8).reshape((nevents, 4))
+    ev[:, 4:] = np.array([b'R', b'E'], dtype='S1').view(np.uint8)
+    ev[::3, 4:] = np.array([b'L', b'I'], dtype='S1').view(np.uint8)
+    ev.tofile(trunk + ".events")
+
+    def bench(name, func, fn):
+        t0 = time.time()
+        result = func(fn)
+        dt = time.time()-t0
+        sys.stdout.write("GNOOMREAD: %-22s %8.1f ms\n" % (name, dt*1e3))
+        return result
+
+    sys.stdout.write("GNOOMREAD: %.1f h, %d ticks, %d events, %.0f MB\n" % (
+        hours, nticks, nevents,
+        sum([os.path.getsize(trunk + ext) for ext in [".move", ".position", ".events"]])*1e-6))
+    bench("read_pos", read_pos, trunk + ".position")
+    fast = bench("read_move", read_move, trunk + ".move")
+    slow = bench("read_move by record", _read_move_loop, trunk + ".move")
+    same = all([np.array_equal(a, b) for a, b in zip(fast, slow)])
+    fast = bench("read_events", read_events, trunk + ".events")
+    slow = bench("read_events by record", _read_events_loop, trunk + ".events")
+    same &= all([np.array_equal(a, b) for a, b in zip(fast, slow)])
+    with open(trunk + ".events", 'ab') as f:
+        f.write(b'\xff\xff\xff')
+        f.write(ev[:100].tobytes())
+    bench("read_events with scan", read_events, trunk + ".events")
+    sys.stdout.write("GNOOMREAD: results %s\n" % ("identical" if same else "DIFFER"))
+
+    for fn in os.listdir(tmpdir):
+        os.remove(os.path.join(tmpdir, fn))
+    os.rmdir(tmpdir)
@@ -451,9 +451,7 @@ def airpuff(side):
         time1 = time.time()
         dt = time1 -  GameLogic.Object['train_tstart']
         # sys.stdout.write("%s %s collision %d\n" % (time2str(dt), side, state))
-        GameLogic.Object['event_file'].write(np.array([dt,], dtype=np.float32).tostring())
-        GameLogic.Object['event_file'].write(ev_code)
-        GameLogic.Object['event_file'].flush()
+        gio.write_event_record(dt, ev_code)
 
     if side=='left':
         if GameLogic.Object['WallTouchTicksCounter'] is not None:
@@ -556,6 +554,9 @@ def collision():
             own.localPosition = [xpos, np.sign(ypos)*GameLogic.Object['boundy'], zpos]
 
 def move_player(move):
+    # Commands that the arduino couldn't take in an earlier tick
+    gc.flush_arduino(GameLogic.Object.get('arduino'))
+
     if GameLogic.Object['isRotating']:
         return 0, 0, 0
 
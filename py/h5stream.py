@@ -0,0 +1,99 @@
+"""Write comedi recordings to HDF5 while they are being acquired
+
+The file has the layout that stfio writes, so that Stimfit and stfio
+read it like a converted recording:
+
+    /description        table: channels, date, time
+    /comment            string
+    /channels/ch<i>     channel name
+    /<name>/description table: n_sections
+    /<name>/section_0/data         float32 samples
+    /<name>/section_0/description  table: dt, xunits, yunits
+
+The data sets are chunked and extendable; append() adds the samples of
+each read, so stopping a recording only has to close the file.
+"""
+
+import sys
+import time
+import numpy as np
+
+try:
+    import h5py
+    has_h5py = True
+except ImportError:
+    has_h5py = False
+
+CHUNKSIZE = 65536 # samples
+STRSIZE = 128
+
+def _strtype():
+    return 'S%d' % STRSIZE
+
+def _table(group, name, fields, values):
+    dtype = np.dtype(fields)
+    table = np.zeros(1, dtype=dtype)
+    for field, value in zip(dtype.names, values):
+        table[field] = value
+    group.create_dataset(name, data=table)
+
+class H5Stream(object):
+    def __init__(self, fn, dt, xunits, yunits, chunksize=CHUNKSIZE, comment="",
+                 resume=None):
+        """resume is the number of samples to keep when appending to an
+        existing file, None to create a new one"""
+        if not has_h5py:
+            raise ImportError("h5py is required for streaming HDF5 output")
+        self.fn = fn
+        if resume is not None:
+            self.f = h5py.File(fn, 'r+')
+            self.data = [self.f["ch%d/section_0/data" % nch] for nch in range(len(yunits))]
+            for ds in self.data:
+                ds.resize((resume,))
+            self.nsamples = resume
+            return
+        self.f = h5py.File(fn, 'w')
+        self.nsamples = 0
+        tstart = time.localtime()
+        _table(self.f, 'description',
+               [('channels', np.int32), ('date', _strtype()), ('time', _strtype())],
+               [len(yunits), time.strftime("%Y-%m-%d", tstart),
+                time.strftime("%H:%M:%S", tstart)])
+        self.f.create_dataset('comment', data=np.bytes_(comment))
+        channels = self.f.create_group('channels')
+        self.data = []
+        for nch, yunit in enumerate(yunits):
+            name = "ch%d" % nch
+            channels.create_dataset(name, data=np.bytes_(name))
+            chgroup = self.f.create_group(name)
+            _table(chgroup, 'description', [('n_sections', np.int32)], [1])
+            section = chgroup.create_group('section_0')
+            _table(section, 'description',
+                   [('dt', np.float64), ('xunits', _strtype()), ('yunits', _strtype())],
+                   [dt, xunits, yunit])
+            self.data.append(section.create_dataset(
+                'data', shape=(0,), maxshape=(None,), dtype=np.float32,
+                chunks=(chunksize,)))
+
+    def append(self, *chunks):
+        """Append one block of samples per channel"""
+        n = len(chunks[0])
+        if n == 0:
+            return
+        for ds, chunk in zip(self.data, chunks):
+            ds.resize((self.nsamples+n,))
+            ds[self.nsamples:] = chunk
+        self.nsamples += n
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        if self.f is None:
+            return
+        self.f.flush()
+        self.f.close()
+        self.f = None
+        sys.stdout.write("NICOMEDI: Wrote %d samples per channel to %s\n" % (
+            self.nsamples, self.fn))
+        sys.stdout.flush()
@@ -18,14 +18,24 @@
 import sys
 import os
 import socket
+import select
 import time
 
 import numpy as np
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../arduino/py")
 import arduino_serial
+import serialbroker
+import gnoomproto as gp
 
 TIMEOUT = 2.0
+# Longest wait for the arduino's reply (s)
+READ_TIMEOUT = 0.1
+# Streaming mode: forward licks at most this often (s); Blender reads
+# them once per logic tick anyway
+BATCH_INTERVAL = 0.01
+# Longest wait in select (s), so that a missing heartbeat is noticed
+MAX_WAIT = 0.1
 
 def init_socket(sockno):
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
@@ -47,9 +57,106 @@ def init_socket(sockno):
 
     return s, blenderpath, connected
 
+def parse_stream(lines):
+    """Decimal counts pushed by the arduino, one per line"""
+    counts = []
+    for line in lines:
+        try:
+            counts.append(int(line))
+        except ValueError:
+            sys.stderr.write("LICKSENSOR: Skipping {0}\n".format(line))
+    return counts
+
+def send_pending(sock, outbuf):
+    """Send as much of outbuf as the socket takes; the rest stays for
+    the next pass, so that no frame is cut short"""
+    try:
+        nsent = sock.send(outbuf)
+    except BlockingIOError:
+        nsent = 0
+    del outbuf[:nsent]
+
+def stream(arduino, socklick, reader, connected):
+    """Let the arduino push lick counts and forward them in batches.
+    Sleeps in select until the arduino or Blender has something to
+    say, instead of asking the arduino in a busy loop."""
+    # Discard anything left over from a previous session
+    arduino.flush_input()
+    arduino.write(b's')
+    sys.stdout.write("LICKSENSOR: Streaming\n")
+
+    pending = []
+    outbuf = bytearray()
+    tsent = 0
+    nwakeups, nsamples, nmessages = 0, 0, 0
+    t_disconnect = time.time()
+    while True:
+        if len(outbuf):
+            # Blender is behind; try the rest of the frame again later
+            timeout = BATCH_INTERVAL
+        elif len(pending):
+            timeout = max(0, min(tsent + BATCH_INTERVAL - time.time(), MAX_WAIT))
+        else:
+            timeout = MAX_WAIT
+        readable, writable, errors = select.select([socklick, arduino], [], [], timeout)
+        nwakeups += 1
+
+        if arduino in readable:
+            if arduino.fill() == 0:
+                # Readable without data: the port or its broker has gone
+                sys.stdout.write("LICKSENSOR: Lost the arduino\n")
+                break
+            counts = parse_stream(arduino.read_lines())
+            tread = time.time()
+            pending.extend([(tread, count) for count in counts])
+
+        frames = []
+        if socklick in readable:
+            frames = reader.read(socklick)
+        # No sensible update from blender in a long time, terminate process
+        if not gp.has_frame(frames, gp.HEARTBEAT):
+            if connected:
+                t_disconnect = time.time()
+            connected = False
+            if time.time()-t_disconnect > TIMEOUT:
+                break
+        else:
+            connected = True
+
+        # Explicit quit signal
+        if gp.has_frame(frames, gp.QUIT):
+            sys.stdout.write("LICKSENSOR: Game over signal received\n")
+            socklick.send(gp.pack(gp.CLOSE, b'close'))
+            break
+
+        # A frame that was only partly sent goes out completely before
+        # the next one; samples read meanwhile wait in pending
+        if not len(outbuf) and len(pending) and time.time()-tsent >= BATCH_INTERVAL:
+            outbuf += gp.pack_array(gp.LICKS, np.array(pending, dtype=np.float64))
+            nsamples += len(pending)
+            nmessages += 1
+            pending = []
+            tsent = time.time()
+        if len(outbuf):
+            send_pending(socklick, outbuf)
+
+    try:
+        arduino.write(b'x')
+    except OSError:
+        # Full, or gone
+        pass
+    sys.stdout.write(
+        "LICKSENSOR: {0} lick samples in {1} messages, {2} wakeups\n".format(
+        nsamples, nmessages, nwakeups))
+
 if __name__=="__main__":
-    if len(sys.argv) > 1:
-        sockno = int(sys.argv[1])
+    # --stream: the arduino pushes lick counts (needs the current firmware)
+    # --broker: share the port with Blender through serialbroker
+    streaming = '--stream' in sys.argv
+    broker = '--broker' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg not in ['--stream', '--broker']]
+    if len(args) > 0:
+        sockno = int(args[0])
     else:
         sockno = 0
 
@@ -72,27 +179,31 @@ if __name__=="__main__":
         arduino_port = "/dev/tty.usbserial-A6006klF"
 
     try:
-        arduino = arduino_serial.SerialPort(arduino_port, 19200)
+        if broker:
+            arduino = serialbroker.open_port(arduino_port, 19200, listen=True)
+        else:
+            arduino = arduino_serial.SerialPort(arduino_port, 19200)
         sys.stdout.write("LICKSENSOR: Successfully opened arduino\n")
     except OSError:
         sys.stdout.write("LICKSENSOR: Failed to open arduino\n")
         arduino = None
 
-    datadec = ""
+    reader = gp.FrameReader()
 
+    if streaming and arduino is not None:
+        stream(arduino, socklick, reader, connected)
+        loop = False
+    else:
+        loop = True
+
+    outbuf = bytearray()
     time0 = time.time()
-    while True:
+    while loop:
         time1 = time.time()
-        datadec = ""
-        try:
-            data = socklick.recv(1024)
-            datadec = data.decode('latin-1')
-            has_data = True
-        except:
-            has_data = False
+        frames = reader.read(socklick)
 
         # No sensible update from blender in a long time, terminate process
-        if (not has_data) or (has_data and datadec.find('1') == -1):
+        if not gp.has_frame(frames, gp.HEARTBEAT):
             if connected:
                 t_disconnect = time.time()
             connected = False
@@ -102,16 +213,17 @@ if __name__=="__main__":
             connected=True
             
         # Explicit quit signal
-        if has_data and datadec.find('quit')!=-1:
+        if gp.has_frame(frames, gp.QUIT):
             sys.stdout.write("LICKSENSOR: Game over signal received\n")
-            socklick.send(b'close')
+            socklick.send(gp.pack(gp.CLOSE, b'close'))
             break
             
         if arduino is not None:
             try:
                 arduino.write('w'.encode('latin1'))
-                lickcounter = arduino.read_until(b'\n')
-                int_lickcounter = np.fromstring(lickcounter[:-1], dtype=np.int8)
+                # One count byte and '\n'; a count of 10 looks like '\n'
+                lickcounter = arduino.read_frame(2, timeout=READ_TIMEOUT)
+                int_lickcounter = np.frombuffer(lickcounter[:-1], dtype=np.int8)
                 if int_lickcounter.shape[0] == 0:
                     int_lickcounter = [0]
             except BlockingIOError:
@@ -119,10 +231,9 @@ if __name__=="__main__":
                 int_lickcounter = [0]
         else:
             int_lickcounter = [0]
-        try:
-            socklick.send(np.array([time.time(), int_lickcounter[0]], dtype=np.float64).tostring()) 
-        except BlockingIOError:
-            pass
+        outbuf += gp.pack_array(
+            gp.LICKS, np.array([time.time(), int_lickcounter[0]], dtype=np.float64))
+        send_pending(socklick, outbuf)
 
     socklick.close()
     sys.stdout.write("LICKSENSOR: Closing\n")
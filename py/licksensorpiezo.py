@@ -23,8 +23,12 @@ import numpy as np
 
 sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../arduino/py")
 import arduino_serial
+import serialbroker
+import gnoomproto as gp
 
 TIMEOUT = 2.0
+# Longest wait for the arduino's reply (s)
+READ_TIMEOUT = 0.1
 
 if 'linux' in sys.platform:
     arduino_port = None
@@ -63,36 +67,36 @@ def init_socket(sockno):
     return s, blenderpath, connected
 
 if __name__=="__main__":
-    if len(sys.argv) > 1:
-        sockno = int(sys.argv[1])
+    # --broker: share the port with Blender through serialbroker
+    broker = '--broker' in sys.argv
+    args = [arg for arg in sys.argv[1:] if arg != '--broker']
+    if len(args) > 0:
+        sockno = int(args[0])
     else:
         sockno = 0
 
     socklick, blenderpath, connected = init_socket(sockno)
 
     try:
-        arduino = arduino_serial.SerialPort(arduino_port, 19200)
+        if broker:
+            arduino = serialbroker.open_port(arduino_port, 19200, listen=True)
+        else:
+            arduino = arduino_serial.SerialPort(arduino_port, 19200)
         sys.stdout.write("LICKPIEZOSENSOR: Successfully opened arduino\n")
     except OSError:
         sys.stdout.write("LICKPIEZOSENSOR: Failed to open arduino\n")
         arduino = None
  
-    datadec = ""
+    reader = gp.FrameReader()
 
     time0 = time.time()
     blocking = False
     while True:
         time1 = time.time()
-        datadec = ""
-        try:
-            data = socklick.recv(1024)
-            datadec = data.decode('latin-1')
-            has_data = True
-        except:
-            has_data = False
+        frames = reader.read(socklick)
 
         # No sensible update from blender in a long time, terminate process
-        if (not has_data) or (has_data and datadec.find('1') == -1):
+        if not gp.has_frame(frames, gp.HEARTBEAT):
             if connected:
                 t_disconnect = time.time()
             connected = False
@@ -102,9 +106,9 @@ if __name__=="__main__":
             connected=True
             
         # Explicit quit signal
-        if has_data and datadec.find('quit')!=-1:
+        if gp.has_frame(frames, gp.QUIT):
             sys.stdout.write("LICKPIEZOSENSOR: Game over signal received\n")
-            socklick.send(b'close')
+            socklick.send(gp.pack(gp.CLOSE, b'close'))
             break
             
         if arduino is not None:
@@ -113,8 +117,8 @@ if __name__=="__main__":
                 if blocking:
                     sys.stderr.write("LICKPIEZOSENSOR: arduino unblocked\n")
                     blocking = False
-                lickcounter = arduino.read_until(b'\n')
-                int_lickcounter = np.fromstring(lickcounter[:-1], dtype=np.uint8)
+                lickcounter = arduino.read_until(b'\n', timeout=READ_TIMEOUT)
+                int_lickcounter = np.frombuffer(lickcounter[:-1], dtype=np.uint8)
                 if int_lickcounter.shape[0] == 1:
                     int_lickcounter = [int_lickcounter[0]]
                 elif int_lickcounter.shape[0] > 2:
@@ -130,7 +134,8 @@ if __name__=="__main__":
         else:
             int_lickcounter = [0]
         try:
-            socklick.send(np.array([time.time(), int_lickcounter[0]], dtype=np.float64).tostring()) 
+            socklick.send(gp.pack_array(
+                gp.LICKS, np.array([time.time(), int_lickcounter[0]], dtype=np.float64)))
         except BlockingIOError:
             pass
         except BrokenPipeError:
@@ -5,6 +5,7 @@ import sys
 import time
 
 from nicomedilib import *
+import gnoomproto as gp
 
 gAisubdev = 0
 gAisubdevname = "/dev/comedi0_subd0"
@@ -35,7 +36,7 @@ if __name__=="__main__":
     if len(sys.argv) > 1:
         sockno = int(sys.argv[1])
 
-    tbsw = np.ones((gPulselengthN), dtype=np.uint16) * 32768
+    waveforms = WaveformLibrary(gDt, gPulselength)
 
     if has_comedi:
         c.comedi_loglevel(3)
@@ -95,145 +96,110 @@ if __name__=="__main__":
           pass
     connfr.setblocking(0)
 
+    # Until the scope reports its width, bins are gPlot_sample samples
+    scope = Scope(connic, connec, connfr, gDt*1e-3, gPlot_sample)
+
+    reader = gp.FrameReader()
     recording = False
     time0 = time.time()
     time1 = time0
     timer = time0
-    databstr_old = b''
+    acq = None
+    h5w = None
+    edges = None
     while True:
         time1 = time.time()
         if recording:
             if time.time()-timer > 0.01:
-                databstr_old = \
-                    read_buffer(aichIC, aichEC, aichFR, gCc_gain, gEC_gain, 
-                                connic, connec, connfr, gPlot_sample, ftmpIC, ftmpEC, ftmpFR, databstr_old)
+                write_blocks(acq, ftmpIC, ftmpEC, ftmpFR, h5w, edges)
+                plot_blocks(acq, scope)
                 # print(time.time()-timer)
                 timer = time.time()    
         else:
-            try:
-                connic.sendall(b"alive")
-            except:
-                pass
-        datadec = ""
-        try:
-            data = s.recv(1024)
-            datadec = data.decode('latin-1')
-            has_data = True
-        except:
-            has_data = False
-        if not recording:
-            time.sleep(1e-4)
+            scope.alive()
+            scope.poll()
+        frames = reader.read(s)
+        # Also while recording, so that the acquisition thread gets the GIL
+        time.sleep(1e-4)
 
         # No sensible update from blender in a long time, terminate process
-        if (not has_data) or (has_data and datadec.find('1') == -1 and datadec.find('h5') == -1):
+        if not (gp.has_frame(frames, gp.HEARTBEAT) or gp.has_frame(frames, gp.BEGIN)):
             if connected:
                 t_disconnect = time.time()
             connected = False
             if time.time()-t_disconnect > 0.5:
                 if recording:
-                    stop(aichIC, aichEC, aichFR, gDt, "ms", "mV", "mV", gCc_gain, gEC_gain,
+                    stop(aichIC, gDt, "ms", "mV", "mV",
                          fn, ftmpIC, fntmpIC, ftmpEC, fntmpEC, ftmpFR, fntmpFR, entmp, s,
-                         connic, connec, connfr, gPlot_sample, databstr_old)
-                    databstr_old = b''
-                disconnect(connic)
+                         scope, acq, h5w, edges)
+                disconnect(scope)
                 break
         else:
             connected=True
  
         # Current pulses ============================================================
-        if has_data and datadec.find('begintbs1') != -1:
-            tbs_amp = int(datadec[
-                datadec.find('tbs1')+4:datadec.find('tbs1')+10])
-            for theta in range(0, int(gPulselength), 200):
-                tbsw[int(float(theta)/gDt):int(float(theta+100)/gDt)] = 32768+tbs_amp
-
-            sys.stdout.write("NICOMEDI: Pulse signal received\n")
-            write_comedi_ao(aochAO, cmdao, tbsw)
-            pulse_start = time.time()
-        
-        elif has_data and datadec.find('begintbst') != -1:
-            tbs_amp = int(datadec[
-                datadec.find('tbst')+4:datadec.find('tbst')+10])
-            tbsw[int(float(0)/gDt):int(float(100)/gDt)] = 32768+tbs_amp
-
-            sys.stdout.write("NICOMEDI: Pulse signal received\n")
-            write_comedi_ao(aochAO, cmdao, tbsw)
-            pulse_start = time.time()
-        
-        elif has_data and datadec.find('begintbs2') != -1:
-            tbs_amp = int(datadec[
-                datadec.find('tbs2')+4:datadec.find('tbs2')+10])
-            
-            for theta in range(0, int(gPulselength), 200):
-                for many in range(0, 100, 10):
-                    tbsw[int(float(theta+many)/gDt):int((theta+many+2.0)/gDt)] = 32768+tbs_amp #2ms pulse
+        tbs = gp.get_frame(frames, gp.TBS)
+        if tbs is not None:
+            tbs_kind, tbs_amp, tbs_tsend = gp.unpack_tbs(tbs)
+        else:
+            tbs_kind = None
 
-            sys.stdout.write("NICOMEDI: Pulse signal received\n")
-            write_comedi_ao(aochAO, cmdao, tbsw)
-            pulse_start = time.time()
-  
-        elif has_data and datadec.find('begintbse') != -1:
-            tbs_amp = int(datadec[
-                datadec.find('tbse')+4:datadec.find('tbse')+10])
-            for many in range(0, 100, 10):
-                tbsw[int(float(many)/gDt):int((many+2.0)/gDt)] = 32768 + tbs_amp #2ms pulse
+        if tbs_kind in TBS_PATTERNS:
+            tbuild = time.time()
+            tbsw = waveforms.get(tbs_kind, tbs_amp)
+            tbuild = time.time()-tbuild
 
             sys.stdout.write("NICOMEDI: Pulse signal received\n")
-            write_comedi_ao(aochAO, cmdao, tbsw)
+            ttrig = write_comedi_ao(aochAO, cmdao, tbsw)
             pulse_start = time.time()
+            sys.stdout.write(
+                "NICOMEDI: Pulse %s%+d started %.1f ms after the trigger "
+                "(waveform %.2f ms)\n" % (
+                    tbs_kind, tbs_amp, (ttrig-tbs_tsend)*1e3, tbuild*1e3))
         
         if time.time()-pulse_start > gPulselength*1e-3 and pulse_start > 0:
             print("NICOMEDI: stopping pulse")
             c.comedi_cancel(aochAO.dev, aochAO.subdev)
             cmdao = make_cmd_ao(aochAO.subdev, gDt, chlistao, 1, gPulselengthN)
-            tbsw[:] = 32768
             pulse_start = 0
         # ============================================================================
 
         # Explicit quit signal
-        if has_data and datadec.find('quit')!=-1:
+        if gp.has_frame(frames, gp.QUIT):
             sys.stdout.write("NICOMEDI: Game over signal received\n")
             if recording:
-                stop(aichIC, aichEC, aichFR, gDt, "ms", "mV", "mV", gCc_gain, gEC_gain,
+                stop(aichIC, gDt, "ms", "mV", "mV",
                      fn, ftmpIC, fntmpIC, ftmpEC, fntmpEC, ftmpFR, fntmpFR, entmp, s,
-                     connic, connec, connfr, gPlot_sample, databstr_old)
-                databstr_old = b''
-            disconnect(connic)
-            s.send(b'close')
+                     scope, acq, h5w, edges)
+            disconnect(scope)
+            s.send(gp.pack(gp.CLOSE, b'close'))
             break
             
         # Stop the recording
-        elif has_data and datadec.find('stop') != -1 and recording:
-            stop(aichIC, aichEC, aichFR, gDt, "ms", "mV", "mV", gCc_gain, gEC_gain,
+        elif gp.has_frame(frames, gp.STOP) and recording:
+            stop(aichIC, gDt, "ms", "mV", "mV",
                  fn, ftmpIC, fntmpIC, ftmpEC, fntmpEC, ftmpFR, fntmpFR, entmp, s,
-                 connic, connec, connfr, gPlot_sample, databstr_old)
-            databstr_old = b''
+                 scope, acq, h5w, edges)
             recording = False
 
         # Start the recording
-        if has_data and datadec.find('h5') != -1 and \
-                datadec.find('stop') == -1:
+        begin = gp.get_frame(frames, gp.BEGIN)
+        if begin is not None and not gp.has_frame(frames, gp.STOP):
             if not recording:
                 record(aichIC, cmdai, s)
                 sys.stdout.write("NICOMEDI: Starting acquisition\n")
                 sent = False
                 while not sent:
                     try:
-                        s.send(b"primed")
+                        s.send(gp.pack(gp.PRIMED))
                         sent = True
                     except:
                         pass
-                sent = False
                 # time stamp for first sample
-                s.send(np.array([time.time(),], dtype=np.float64).tostring()) 
+                s.send(gp.pack_array(gp.TIMESTAMP, np.array([time.time(),], dtype=np.float64)))
                 if gPlot:
-                    while not sent:
-                        try:
-                            connic.sendall(b"begin")
-                            sent = True
-                        except:
-                            pass
-                fn = datadec[datadec.find("begin")+5:datadec.find("end")]
+                    scope.begin()
+                fn = bytes(begin).decode('latin-1')
                 # send filename to plotting process:
                 fntmpIC = fn[:-3] + "_IC.bin"
                 fntmpEC = fn[:-3] + "_EC.bin"
@@ -243,6 +209,13 @@ if __name__=="__main__":
                 ftmpIC = open(fntmpIC, 'w+b')
                 ftmpEC = open(fntmpEC, 'w+b')
                 ftmpFR = open(fntmpFR, 'w+b')
+                # Samples go straight into the hdf5 file if h5py is available
+                h5w = open_h5stream(fn, gDt, "ms", ["mV", "mV"])
+                # Frame edges are found while the recording runs
+                edges = EdgeWriter(entmp)
+                # AI is drained on its own thread from here on
+                acq = Acquisition(aichIC, aichEC, aichFR, gCc_gain, gEC_gain)
+                acq.start()
                 recording = True
             connected=True
 
@@ -9,20 +9,44 @@ import socket
 import subprocess
 import select
 import struct
-import settings
 import ctypes
+import threading
+import collections
 
 import numpy as np
 
 try:
-    import comedi as c
+    import settings
+except ImportError:
+    # Acquisition runs without it, e.g. in the fakecomedi benchmark;
+    # settings are read with getattr and a default
+    settings = None
+
+import gnoomproto as gp
+import h5stream
+import offload
+import scopestream
+from recvbuffer import RecvBuffer
+
+if os.environ.get('GNOOM_FAKE_COMEDI'):
+    # Simulated board for testing without hardware, see fakecomedi.py
+    import fakecomedi as c
     has_comedi = True
     aref_ground = c.AREF_GROUND
-    import stfio
-except:
-    sys.stderr.write("NICOMEDI: Failed to import comedi\n")
-    has_comedi = False
-    aref_ground = None
+    try:
+        import stfio
+    except ImportError:
+        stfio = None
+else:
+    try:
+        import comedi as c
+        has_comedi = True
+        aref_ground = c.AREF_GROUND
+        import stfio
+    except:
+        sys.stderr.write("NICOMEDI: Failed to import comedi\n")
+        has_comedi = False
+        aref_ground = None
 
 gPlot = True
 READBUFFER = 12
@@ -212,10 +236,62 @@ def byte_convert(waveform):
     a string of 2-byte numbers. The string returned is the correct format
     for writing to the comedi data buffer for DAC operations.
     '''
-    data = []
-    for i in range(len(waveform)):
-        data.append(struct.pack('H',waveform[i]))
-    return b''.join(data)
+    return np.asarray(waveform, dtype=np.uint16).tobytes()
+
+# Pulse patterns: onsets (ms) as a function of the pulse length, and
+# the duration of each pulse (ms)
+TBS_PATTERNS = {
+    # theta bursts: 100 ms steps every 200 ms
+    '1': (lambda pulselength: np.arange(0, int(pulselength), 200), 100.0),
+    # single 100 ms test step
+    't': (lambda pulselength: np.array([0]), 100.0),
+    # theta bursts of 2 ms pulses at 100 Hz
+    '2': (lambda pulselength: (np.arange(0, int(pulselength), 200)[:, np.newaxis] +
+                               np.arange(0, 100, 10)[np.newaxis, :]).ravel(), 2.0),
+    # single burst of 2 ms pulses at 100 Hz
+    'e': (lambda pulselength: np.arange(0, 100, 10), 2.0),
+}
+
+def tbs_waveform(kind, amp, dt, pulselength, baseline=32768):
+    """uint16 AO waveform of one pulse pattern"""
+    onsets, duration = TBS_PATTERNS[kind]
+    onsets = onsets(pulselength).astype(np.float64)
+    n = int(pulselength/dt)
+    starts = np.minimum((onsets/dt).astype(int), n)
+    ends = np.minimum(((onsets+duration)/dt).astype(int), n)
+    # +1 where a pulse starts and -1 where it ends
+    steps = np.zeros((n+1,), dtype=int)
+    np.add.at(steps, starts, 1)
+    np.add.at(steps, ends, -1)
+    waveform = np.empty((n,), dtype=np.uint16)
+    waveform[:] = baseline
+    waveform[np.cumsum(steps[:-1]) > 0] = baseline + amp
+    return waveform
+
+class WaveformLibrary(object):
+    """Pulse waveforms, built once per (kind, amplitude) and kept in
+    an LRU cache"""
+    def __init__(self, dt, pulselength, maxsize=32):
+        self.dt = dt
+        self.pulselength = pulselength
+        self.maxsize = maxsize
+        self.cache = collections.OrderedDict()
+        self.nhits = 0
+        self.nmisses = 0
+
+    def get(self, kind, amp):
+        key = (kind, amp)
+        if key in self.cache:
+            waveform = self.cache.pop(key)
+            self.nhits += 1
+        else:
+            waveform = tbs_waveform(kind, amp, self.dt, self.pulselength)
+            waveform.flags.writeable = False
+            self.nmisses += 1
+            if len(self.cache) >= self.maxsize:
+                self.cache.popitem(last=False)
+        self.cache[key] = waveform
+        return waveform
 
 def cpoly(data, channel):
     """
@@ -229,32 +305,126 @@ def cpoly(data, channel):
                        data-channel.convpoly_expansion_origin)**i
                    for i in range(channel.convpoly_order+1)], axis=0)
        
+class ChannelLayout(object):
+    """Interleaved samples of the channels in one comedi AI command.
+
+    The calibration polynomials of all channels are stacked into one
+    coefficient table when the layout is created, so that converting a
+    block is a reshape to (nsamples, nchans) and one Horner evaluation.
+    Channels without calibration use the linear range conversion.
+    """
+    def __init__(self, channels, sampletype=np.uint32):
+        self.nchans = len(channels)
+        self.sampletype = np.dtype(sampletype)
+        self.recsize = self.nchans * self.sampletype.itemsize
+        polys = []
+        origins = []
+        for channel in channels:
+            if channel.convpoly is not None:
+                polys.append(channel.convpoly_coefficients)
+                origins.append(channel.convpoly_expansion_origin)
+            else:
+                polys.append(np.array([
+                    channel.prange.min,
+                    (channel.prange.max-channel.prange.min)/float(channel.maxdata)]))
+                origins.append(0.0)
+        order = max([len(poly) for poly in polys]) - 1
+        # coefficients[i, nch] multiplies (d-d_o)^i of channel nch
+        self.coefficients = np.zeros((order+1, self.nchans))
+        for nch, poly in enumerate(polys):
+            self.coefficients[:len(poly), nch] = poly
+        self.origins = np.array(origins, dtype=np.float64)
+
+    def nrecords(self, nbytes):
+        return nbytes // self.recsize
+
+    def convert(self, databstr):
+        """Physical values of all complete records as an (nsamples, nchans) array"""
+        # databstr may be bytes or an array view into a receive buffer
+        raw = np.frombuffer(databstr, self.sampletype)
+        nrec = len(raw) // self.nchans
+        x = raw[:nrec*self.nchans].reshape((nrec, self.nchans)) - self.origins
+        y = np.empty_like(x)
+        y[:] = self.coefficients[-1]
+        for coeff in self.coefficients[-2::-1]:
+            y *= x
+            y += coeff
+        return y
+
+# One layout per channel list, built on first use
+layouts = {}
+
+def get_layout(channels):
+    key = tuple([id(channel) for channel in channels])
+    if key not in layouts:
+        layouts[key] = ChannelLayout(channels)
+    return layouts[key]
+
 def databstr2np(databstr, gains, channels):
-    str2np = np.fromstring(databstr, np.uint32)
+    """Scaled analog channels as float32 and the last (frame) channel
+    as int8, or a single float32 array for a single channel"""
+    data = get_layout(channels).convert(databstr)
     if len(channels)==1:
-        return np.array([c.comedi_to_physical(int(pt), channels[0].convpoly) \
-                             for pt in str2np],
-                        dtype=np.float32)/gains[0]
+        return data[:, 0].astype(np.float32)/gains[0]
     else:
-        arr1 = cpoly(str2np[0::3], channels[0]).astype(np.float32)/gains[0]
-        arr2 = cpoly(str2np[1::3], channels[1]).astype(np.float32)/gains[1]
-        arr3 = cpoly(str2np[2::3], channels[2]).astype(np.int)
-        frames = (arr3 > 2.5).astype(np.int8)
-#        arr1 = np.array([
-#            c.comedi_to_physical(int(pt), channels[0].convpoly)
-#            for pt in str2np[::3]], dtype=np.float32)/gains[0]
-#        arr2 = np.array([
-#            c.comedi_to_physical(int(pt), channels[1].convpoly)
-#            for pt in str2np[1::3]], dtype=np.float32)/gains[1]
-#        frames2 = np.array([
-#            int(c.comedi_to_physical(int(pt), channels[2].convpoly) > 2.5)
-#            for pt in str2np[2::3]], dtype=np.int8)
-#        print("SUM", np.sum(frames2-frames), "SUM")
-        return arr1, arr2, frames
+        analog = [data[:, nch].astype(np.float32)/gains[nch]
+                  for nch in range(len(channels)-1)]
+        frames = (data[:, -1].astype(int) > 2.5).astype(np.int8)
+        return tuple(analog) + (frames,)
 
 def find_edges(frames):
     return np.where(np.diff(frames)!=0)[0]
 
+class EdgeWriter(object):
+    """Finds frame transitions block by block and appends them to the
+    edge file as int32 sample indices.
+
+    The last sample of each block is kept, so that the file ends up
+    identical to find_edges over the whole frame trace. nedges and
+    last_edge can be read while the recording runs.
+    """
+    def __init__(self, fn, nsamples=0, nedges=0, last=None):
+        """nsamples, nedges and last (the last frame sample) continue an
+        existing edge file, e.g. when a rescue resumes"""
+        self.fn = fn
+        if nsamples:
+            self.f = open(fn, 'r+b')
+            self.f.truncate(4*nedges)
+            self.f.seek(0, os.SEEK_END)
+        else:
+            self.f = open(fn, 'wb')
+        self.last = last
+        self.nsamples = nsamples
+        self.nedges = nedges
+        self.last_edge = None
+
+    def feed(self, frames):
+        if not len(frames):
+            return np.empty((0,), dtype=np.int32)
+        if self.last is None:
+            if frames[0] != 0:
+                sys.stdout.write("NICOMEDI: Warning: first frame isn't 0\n")
+            edges = find_edges(frames) + self.nsamples
+        else:
+            joined = np.empty((len(frames)+1,), dtype=frames.dtype)
+            joined[0] = self.last
+            joined[1:] = frames
+            edges = find_edges(joined) + (self.nsamples-1)
+        self.last = frames[-1]
+        self.nsamples += len(frames)
+        edges = edges.astype(np.int32)
+        if len(edges):
+            self.f.write(edges.tobytes())
+            self.nedges += len(edges)
+            self.last_edge = edges[-1]
+        return edges
+
+    def flush(self):
+        self.f.flush()
+
+    def close(self):
+        self.f.close()
+
 def init_comedi_ai(aichFR, aichIC, aichEC, dt):
 
     sys.stdout.write("NICOMEDI: Initializing analog inputs... ")
@@ -309,7 +479,9 @@ def scale_ao_700b_cc(current):
     return input16
 
 def write_comedi_ao(aochAO, cmdao, waveform, chunksize=1024):
-    data = byte_convert(waveform) # waveform.tobytes()
+    """Returns the time of the internal trigger that starts the output"""
+    # Written straight from the waveform's memory
+    data = memoryview(np.ascontiguousarray(waveform, dtype=np.uint16)).cast('B')
     err = c.comedi_command(aochAO.dev, cmdao)
     if err < 0:
        comedi_errcheck()
@@ -322,6 +494,7 @@ def write_comedi_ao(aochAO, cmdao, waveform, chunksize=1024):
     ret = 0
     while ret == 0:
         ret = intn_trig(aochAO)
+    ttrig = time.time()
     print('NICOMEDI: Internal trigger')
     if m < len(data):
         n=m
@@ -343,7 +516,8 @@ def write_comedi_ao(aochAO, cmdao, waveform, chunksize=1024):
             else: m = 0
             if m == 0:
                 break
-    
+    return ttrig
+
 def set_dig_io(ch, mode):
     if mode=='out':
         io = c.COMEDI_OUTPUT
@@ -429,24 +603,18 @@ def init_socket(sockno):
 
     return s, blenderpath
 
-def disconnect(conn):
+def disconnect(scope):
     sys.stdout.write('NICOMEDI: Received termination signal... ')
     sys.stdout.flush()
-    while True:
-        try:
-            conn.sendall(b"quit")
-            break
-        except:
-            pass
-    datawx = ""
-    while datawx.find('close') == -1:
-        try:
-            datawxraw = conn.recv(1024)
-            datawx = datawxraw.decode('latin-1')
-            sys.stdout.write('received %s from wxplot... ' % datawx)
-            sys.stdout.flush()
-        except:
-            pass                        
+    scope.control(scopestream.QUIT)
+    closed = False
+    while not closed:
+        scope.flush()
+        for kind, t0, dtbin, env in scope.reader.read(scope.conns[0]):
+            if kind == scopestream.CLOSE:
+                sys.stdout.write('received close from wxplot... ')
+                sys.stdout.flush()
+                closed = True
     sys.stdout.write('nicomedi done\n')
 
 def record(aich, cmd, s=None):
@@ -457,14 +625,14 @@ def record(aich, cmd, s=None):
     if ret != 0:
         comedi_errcheck()
 
-def stop(aichIC, aichEC, aichFR, dt, xunits, yunitsIC, yunitsEC, gainIC, gainEC,
+def stop(aichIC, dt, xunits, yunitsIC, yunitsEC,
          fn, ftmpIC, fntmpIC, ftmpEC, fntmpEC, ftmpFR, fntmpFR, entmp, s,
-         connic, connec, connfr, plot_sample, databstr_old):
+         scope, acq, h5w=None, edges=None):
 
     # Close device:
     ret = c.comedi_cancel(aichIC.dev, aichIC.subdev)
     # time stamp for last sample
-    s.send(np.array([time.time(),], dtype=np.float64).tostring()) 
+    s.send(gp.pack_array(gp.TIMESTAMP, np.array([time.time(),], dtype=np.float64)))
     if ret != 0:
         comedi_errcheck()
 
@@ -472,67 +640,57 @@ def stop(aichIC, aichEC, aichFR, dt, xunits, yunitsIC, yunitsEC, gainIC, gainEC,
     # ret = c.comedi_poll(aich.dev, aich.subdev)
     # if ret < 0:
     #     comedi_errcheck()
-    read_buffer(aichIC, aichEC, aichFR, gainIC, gainEC, connic, connec, connfr, plot_sample,
-                ftmpIC, ftmpEC, ftmpFR, databstr_old)
+    acq.stop()
+    write_blocks(acq, ftmpIC, ftmpEC, ftmpFR, h5w, edges)
+    plot_blocks(acq, scope)
+    acq.report()
     ftmpIC.close()
     ftmpEC.close()
     ftmpFR.close()
 
-    # Scale temporary file:
-    sys.stdout.write("NICOMEDI: Saving to file: Reading temp file...\n")
-    sys.stdout.flush()
-    ftmpIC = open(fntmpIC, 'rb')
-    ftmpEC = open(fntmpEC, 'rb')
-    ftmpFR = open(fntmpFR, 'rb')
-    databstrIC = ftmpIC.read()
-    databstrEC = ftmpEC.read()
-    databstrFR = ftmpFR.read()
-    sys.stdout.write("NICOMEDI: Saving to file: Processing data...\n")
-    sys.stdout.flush()
-    datalistIC = np.fromstring(databstrIC, np.float32)
-    datalistEC = np.fromstring(databstrEC, np.float32)
-    frames = np.fromstring(databstrFR, np.int8)
-    # Write to hdf5:
-    sys.stdout.write("NICOMEDI: Saving to file: Converting to hdf5...\n")
-    sys.stdout.flush()
-    chlist = [stfio.Channel([stfio.Section(np.array(datalistIC, dtype=np.float)),]),
-              stfio.Channel([stfio.Section(np.array(datalistEC, dtype=np.float)),])]
-    chlist[0].yunits = yunitsIC
-    chlist[1].yunits = yunitsEC
-    rec = stfio.Recording(chlist)
-    rec.dt = dt # set sampling interval
-    rec.xunits = xunits # set time units
-    sys.stdout.write("NICOMEDI: Saving to file: Writing hdf5 to %s..." % fn)
-    sys.stdout.flush()
-    if sys.version_info >= (3,):
-        rec.write(fn)
+    if h5w is not None:
+        # Samples are already in the hdf5 file
+        h5w.close()
+        nsamples = h5w.nsamples
     else:
-        rec.write(fn.encode('latin-1'))
-    sys.stdout.write("done\n")
-    sys.stdout.flush()
+        nsamples = convert_h5(dt, xunits, [yunitsIC, yunitsEC], fn,
+                              [fntmpIC, fntmpEC])
 
     # Write frame transition times
-    if frames[0] != 0:
-        sys.stdout.write("NICOMEDI: Warning: first frame isn't 0\n")
-    edges = find_edges(frames)
-    etmp = open(entmp, 'wb')
-    etmp.write(edges.astype(np.int32).tostring())
-    etmp.close()
-
-    # Close and delete temp file:
-    ftmpIC.close()
-    ftmpEC.close()
-    ftmpFR.close()
+    if edges is not None:
+        # Edges were written during acquisition
+        edges.close()
+    else:
+        frames = np.fromfile(fntmpFR, np.int8)
+        if frames[0] != 0:
+            sys.stdout.write("NICOMEDI: Warning: first frame isn't 0\n")
+        etmp = open(entmp, 'wb')
+        etmp.write(find_edges(frames).astype(np.int32).tostring())
+        etmp.close()
+
     # Do not remove temp files, CSH 2013-10-11
     # os.remove(fntmpIC)
     # os.remove(fntmpEC)
     # os.remove(fntmpFR)
     sys.stdout.write("\nNICOMEDI: Stopping acquisition, read %d samples\n" \
-                     % len(datalistIC))
+                     % nsamples)
     sys.stdout.flush()
     
-    sys.stdout.write("NICOMEDI: Synchronizing in background\n")
     locald = os.path.dirname(fn)
+    if getattr(settings, 'offload_daemon', True):
+        # Copied, verified and retried by the offload daemon; a second
+        # directory can stand in for the share. The share must be
+        # mounted, otherwise the job fails and is retried.
+        dstroot = getattr(settings, 'offload_dir', None)
+        mount = dstroot is None
+        if mount:
+            dstroot = settings.net_data_dir_mnt
+        sys.stdout.write("NICOMEDI: Queueing %s for transfer\n" % locald)
+        offload.enqueue(locald, locald.replace(settings.local_data_dir, dstroot),
+                        root=dstroot, mount=mount)
+        return
+
+    sys.stdout.write("NICOMEDI: Synchronizing in background\n")
     netd = os.path.dirname(locald.replace(settings.local_data_dir, settings.net_data_dir_mnt)) + '/'
     if not os.path.exists(netd):
         args = ["/usr/local/bin/sync_rackstation.sh"]
@@ -540,149 +698,72 @@ def stop(aichIC, aichEC, aichFR, dt, xunits, yunitsIC, yunitsEC, gainIC, gainEC,
         netd = os.path.dirname(locald.replace(settings.local_data_dir, settings.net_data_dir)) + """/'"""
         args = ["/usr/bin/rsync", "-a", locald, netd]
     subprocess.Popen(args)
-    
-def rescue1ch(filetrnk, xunits="ms", yunits="mV", dt=0.02):
-    sys.stdout.write("NICOMEDI: Rescuing file: Reading temp files...\n")
-    sys.stdout.flush()
 
-    fntmp = filetrnk + "_tmp.bin"
-    fntmp2 = filetrnk + "_tmp2.bin"
-    entmp = filetrnk + "_edge.bin"
-    fn = filetrnk + ".h5"
+def open_h5stream(fn, dt, xunits, yunits):
+    """Streaming hdf5 writer for a new recording, or None if the
+    recording is converted from the temp files when it stops"""
+    if not h5stream.has_h5py or not getattr(settings, 'comedi_h5stream', True):
+        return None
+    return h5stream.H5Stream(fn, dt, xunits, yunits)
 
-    ftmp = open(fntmp, 'rb')
-    ftmp2 = open(fntmp2, 'rb')
-    databstr = ftmp.read()
-    databstr2 = ftmp2.read()
-    sys.stdout.write("NICOMEDI: Saving to file: Processing data...\n")
+def convert_h5(dt, xunits, yunits, fn, fntmps):
+    """Convert the temp files of a recording to hdf5 with stfio"""
+    # Scale temporary file:
+    sys.stdout.write("NICOMEDI: Saving to file: Reading temp file...\n")
     sys.stdout.flush()
-    datalist = np.fromstring(databstr, np.float32)
-    frames = np.fromstring(databstr2, np.int8)
+    datalists = [np.fromfile(fntmp, np.float32) for fntmp in fntmps]
     # Write to hdf5:
     sys.stdout.write("NICOMEDI: Saving to file: Converting to hdf5...\n")
     sys.stdout.flush()
-    chlist = [stfio.Channel([stfio.Section(np.array(datalist, dtype=np.float)),]),]
-    chlist[0].yunits = yunits
+    chlist = [stfio.Channel([stfio.Section(np.array(datalist, dtype=np.float)),])
+              for datalist in datalists]
+    for channel, yunit in zip(chlist, yunits):
+        channel.yunits = yunit
     rec = stfio.Recording(chlist)
     rec.dt = dt # set sampling interval
     rec.xunits = xunits # set time units
-    sys.stdout.write("NICOMEDI: Saving to file: Writing hdf5...")
+    sys.stdout.write("NICOMEDI: Saving to file: Writing hdf5 to %s..." % fn)
     sys.stdout.flush()
-    rec.write(fn)
+    if sys.version_info >= (3,):
+        rec.write(fn)
+    else:
+        rec.write(fn.encode('latin-1'))
     sys.stdout.write("done\n")
     sys.stdout.flush()
 
-    # Write frame transition times
-    if frames[0] != 0:
-        sys.stdout.write("NICOMEDI: Warning: first frame isn't 0\n")
-    edges = find_edges(frames)
-    etmp = open(entmp, 'wb')
-    etmp.write(edges.astype(np.int32).tostring())
-    etmp.close()
-
-    # Close and delete temp file:
-    ftmp.close()
-    ftmp2.close()
-    os.remove(fntmp)
-    os.remove(fntmp2)
-    sys.stdout.write("\nNICOMEDI: Stopping acquisition, read %d samples\n" \
-                     % len(datalist))
-    sys.stdout.flush()
-
-def rescue2ch(filetrnk, xunits="ms", yunitsIC="mV", yunitsEC="mV", dt=0.02):
-    sys.stdout.write("NICOMEDI: Rescuing file: Reading temp files...\n")
-    sys.stdout.flush()
+    return len(datalists[0])
     
-    fntmpIC = filetrnk + "_IC.bin"
-    fntmpEC = filetrnk + "_EC.bin"
-    fntmpFR = filetrnk + "_FR.bin"
-    entmp =   filetrnk + "_edge.bin"
-    fn =      filetrnk + ".h5"
-
-    ftmpIC = open(fntmpIC, 'rb')
-    ftmpEC = open(fntmpEC, 'rb')
-    ftmpFR = open(fntmpFR, 'rb')
+# The rescue functions live in nirescue, which imports this module
 
-    databstrIC = ftmpIC.read()
-    databstrEC = ftmpEC.read()
-    databstrFR = ftmpFR.read()
-
-    sys.stdout.write("NICOMEDI: Saving to file: Processing data...\n")
-    sys.stdout.flush()
-    datalistIC = np.fromstring(databstrIC, np.float32)
-    datalistEC = np.fromstring(databstrEC, np.float32)
-    frames = np.fromstring(databstrFR, np.int8)
-    # Write to hdf5:
-    sys.stdout.write("NICOMEDI: Saving to file: Converting to hdf5...\n")
-    sys.stdout.flush()
-    chlist = [stfio.Channel([stfio.Section(np.array(datalistIC, dtype=np.float)),]),
-              stfio.Channel([stfio.Section(np.array(datalistEC, dtype=np.float)),])]
-    chlist[0].yunits = yunitsIC
-    chlist[1].yunits = yunitsEC
-    rec = stfio.Recording(chlist)
-    rec.dt = dt # set sampling interval
-    rec.xunits = xunits # set time units
-    sys.stdout.write("NICOMEDI: Saving to file: Writing hdf5...")
-    sys.stdout.flush()
-    rec.write(fn)
-    sys.stdout.write("done\n")
-    sys.stdout.flush()
+def rescue1ch(filetrnk, xunits="ms", yunits="mV", dt=0.02):
+    import nirescue
+    nirescue.rescue1ch(filetrnk, xunits, yunits, dt)
 
-    # Write frame transition times
-    if frames[0] != 0:
-        sys.stdout.write("NICOMEDI: Warning: first frame isn't 0\n")
-    edges = find_edges(frames)
-    etmp = open(entmp, 'wb')
-    etmp.write(edges.astype(np.int32).tostring())
-    etmp.close()
-
-    # Close and delete temp file:
-    ftmpIC.close()
-    ftmpEC.close()
-    ftmpFR.close()
-    os.remove(fntmpIC)
-    os.remove(fntmpEC)
-    os.remove(fntmpFR)
-    sys.stdout.write("\nNICOMEDI: Stopping acquisition, read %d samples\n" \
-                     % len(datalistIC))
-    sys.stdout.flush()
+def rescue2ch(filetrnk, xunits="ms", yunitsIC="mV", yunitsEC="mV", dt=0.02):
+    import nirescue
+    nirescue.rescue2ch(filetrnk, xunits, yunitsIC, yunitsEC, dt)
 
 def rescue_framesonly(filetrnk):
-    sys.stdout.write("NICOMEDI: Rescuing file: Reading temp files...\n")
-    sys.stdout.flush()
-
-    fntmp2 = filetrnk + "_tmp2.bin"
-    entmp = filetrnk + "_edge.bin"
-
-    ftmp2 = open(fntmp2, 'rb')
-    databstr2 = ftmp2.read()
-
-    sys.stdout.write("NICOMEDI: Saving to file: Processing data...\n")
-    sys.stdout.flush()
-    frames = np.fromstring(databstr2, np.int8)
-
-    # Write frame transition times
-    if frames[0] != 0:
-        sys.stdout.write("NICOMEDI: Warning: first frame isn't 0\n")
-    edges = find_edges(frames)
-    etmp = open(entmp, 'wb')
-    etmp.write(edges.astype(np.int32).tostring())
-    etmp.close()
-
-    # Close and delete temp file:
-    ftmp2.close()
-    os.remove(fntmp2)
-
-def read_buffer(aichIC, aichEC, aichFR, gainIC, gainEC, connic, connec, connfr, plot_sample,
-                ftmpIC, ftmpEC, ftmpFR, databstr_old=b''):
-
-    databstr_full = b''
-    t0 = time.time()
+    import nirescue
+    nirescue.rescue_framesonly(filetrnk)
+
+def new_readbuffer(aich, channels):
+    """Preallocated buffer for the raw samples of an AI command; a
+    partial record stays in the buffer until the next read"""
+    layout = get_layout(channels)
+    return RecvBuffer(layout.recsize, layout.sampletype, 2*aich.maxbuffer)
+
+def read_device(aich, rbuf):
+    """Read everything the AI buffer holds into rbuf; returns the number
+    of bytes read and the largest buffer fill seen"""
+    nread = 0
+    maxfill = 0
     while True:
-        buffersize = c.comedi_get_buffer_contents(aichIC.dev, aichIC.subdev)
+        buffersize = c.comedi_get_buffer_contents(aich.dev, aich.subdev)
+        maxfill = max(maxfill, buffersize)
         if buffersize >= READBUFFER:
             try:
-                databstr_full += os.read(aichIC.fd, aichIC.maxbuffer)
+                nread += rbuf.readfd(aich.fd, aich.maxbuffer)
             except:
                 sys.stdout.write("NICOMEDI: Reading from device failed\n")
                 sys.stdout.flush()
@@ -691,45 +772,190 @@ def read_buffer(aichIC, aichEC, aichFR, gainIC, gainEC, connic, connec, connfr,
             sys.stdout.write("NICOMEDI: Warning: buffer error\n")
             comedi_errcheck()
             break
-        elif buffersize > aichIC.maxbuffer/2:
-            sys.stdout.write("NICOMEDI: Warning: buffer is more than half full\n")
         elif buffersize <= MINBUFFER:
             break    
-    
-#    t1 = time.time()   
-#    sys.stdout.write("R {0:.02f}\n".format(t1-t0))
-    if databstr_full == b'':
-        # time.sleep(5e-4)
-        return databstr_old
-
-    databstr_full = databstr_old + databstr_full
-    buffer12 = int(len(databstr_full)/12) * 12
-    databstr = databstr_full[:buffer12]
-    databstr_rem = databstr_full[buffer12:]
-#    t2 = time.time()   
-#    sys.stdout.write("C {0:.02f}\n".format(t2-t1))
-
-    tmpIC, tmpEC, frames = databstr2np(databstr, [gainIC, gainEC], [aichIC, aichEC, aichFR])
-#    t3 = time.time()   
-#    sys.stdout.write("N {0:.02f}\n".format(t3-t2))
-    ftmpIC.write(tmpIC.tostring()) 
+
+    return nread, maxfill
+
+class Acquisition(threading.Thread):
+    """Drains the comedi AI buffer on its own thread.
+
+    Every read is converted and handed to the consumers as a
+    (IC, EC, frames) block through two deques, one for the writer and
+    one for the scope. Appending and popping are atomic, so neither
+    side takes a lock, and a slow consumer (or a slow AO write on the
+    command thread) does not delay draining the device. The scope
+    deque is bounded and drops its oldest blocks when the scope falls
+    behind.
+    """
+    def __init__(self, aichIC, aichEC, aichFR, gainIC, gainEC, interval=0.01,
+                 maxplotblocks=100):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.aich = aichIC
+        self.channels = [aichIC, aichEC, aichFR]
+        self.gains = [gainIC, gainEC]
+        self.interval = interval
+        self.rbuf = new_readbuffer(aichIC, self.channels)
+        self.blocks = collections.deque()
+        self.plotblocks = collections.deque(maxlen=maxplotblocks)
+        self.stopped = threading.Event()
+        self.error = None
+        # statistics
+        self.nreads = 0
+        self.nsamples = 0
+        self.maxfill = 0
+        self.maxqueue = 0
+        self.maxgap = 0
+        self.tread = None
+
+    def read(self):
+        t = time.time()
+        if self.tread is not None:
+            self.maxgap = max(self.maxgap, t-self.tread)
+        nread, fill = read_device(self.aich, self.rbuf)
+        self.maxfill = max(self.maxfill, fill)
+        if fill > self.aich.maxbuffer/2:
+            sys.stdout.write(
+                "NICOMEDI: Warning: buffer is %.0f%% full after %.1f ms, "
+                "%d blocks waiting for the writer\n" % (
+                    100.0*fill/self.aich.maxbuffer, (t-self.tread)*1e3,
+                    len(self.blocks)))
+        self.tread = t
+        if nread == 0:
+            return
+        block = databstr2np(self.rbuf.take(), self.gains, self.channels)
+        self.blocks.append(block)
+        self.plotblocks.append(block)
+        self.nreads += 1
+        self.nsamples += len(block[0])
+        self.maxqueue = max(self.maxqueue, len(self.blocks))
+
+    def run(self):
+        self.tread = time.time()
+        while not self.stopped.is_set():
+            t0 = time.time()
+            try:
+                self.read()
+            except Exception as err:
+                self.error = err
+                sys.stdout.write("NICOMEDI: Acquisition failed: %s\n" % err)
+                sys.stdout.flush()
+                break
+            self.stopped.wait(max(self.interval-(time.time()-t0), 0))
+
+    def stop(self):
+        """Stop the thread and read what is left in the device"""
+        self.stopped.set()
+        self.join()
+        self.read()
+
+    def occupancy(self):
+        return {'fill': self.maxfill/float(self.aich.maxbuffer),
+                'queue': len(self.blocks),
+                'maxqueue': self.maxqueue,
+                'maxgap': self.maxgap}
+
+    def report(self):
+        sys.stdout.write(
+            "NICOMEDI: %d samples in %d reads, comedi buffer at most %.0f%% full, "
+            "at most %d blocks queued, longest gap between reads %.1f ms\n" % (
+                self.nsamples, self.nreads, 100.0*self.maxfill/self.aich.maxbuffer,
+                self.maxqueue, self.maxgap*1e3))
+        sys.stdout.flush()
+
+def write_blocks(acq, ftmpIC, ftmpEC, ftmpFR, h5w=None, edges=None):
+    """Writer side: save all blocks the acquisition thread handed over"""
+    while len(acq.blocks):
+        tmpIC, tmpEC, frames = acq.blocks.popleft()
+        ftmpIC.write(tmpIC.tobytes())
+        ftmpEC.write(tmpEC.tobytes())
+        ftmpFR.write(frames.tobytes())
+        if h5w is not None:
+            h5w.append(tmpIC, tmpEC)
+        if edges is not None:
+            edges.feed(frames)
     ftmpIC.flush()
-    ftmpEC.write(tmpEC.tostring()) 
     ftmpEC.flush()
-    ftmpFR.write(frames.tostring())
     ftmpFR.flush()
-#    t4 = time.time()   
-#    sys.stdout.write("F {0:.02f}\n".format(t4-t3))
-    if gPlot:
-        try:
-            connic.send(tmpIC[::plot_sample].tostring())
-            connec.send(tmpEC[::plot_sample].tostring())
-            connfr.send(frames[::plot_sample].tostring())
-        except:
-            sys.stdout.write("NICOMEDI: Error communicating with scope\n")
-    sys.stdout.write('.')
-    sys.stdout.flush()
-    return databstr_rem
+    if edges is not None:
+        edges.flush()
+
+class Scope(object):
+    """Sends min/max envelopes of IC, EC and frames to the wxplot scope.
+
+    Messages are queued per socket and sent as far as the non-blocking
+    sockets take them, so that a busy scope never splits a message. The
+    scope sets the bin duration to one screen pixel with WIDTH messages.
+    """
+    def __init__(self, connic, connec, connfr, dt, binsize=1,
+                 maxpending=1<<20, alive_interval=0.1):
+        self.conns = [connic, connec, connfr]
+        self.decimators = [scopestream.Decimator(dt, binsize) for conn in self.conns]
+        self.pending = [b'' for conn in self.conns]
+        self.reader = scopestream.Reader()
+        self.maxpending = maxpending
+        self.alive_interval = alive_interval
+        self.talive = 0
+        self.ndropped = 0
+
+    def send(self, nch, msg):
+        if len(self.pending[nch]) > self.maxpending:
+            # Scope is not keeping up; it only misses part of the display
+            self.ndropped += 1
+            return
+        self.pending[nch] += msg
+
+    def flush(self):
+        for nch, conn in enumerate(self.conns):
+            if len(self.pending[nch]):
+                try:
+                    n = conn.send(self.pending[nch])
+                    self.pending[nch] = self.pending[nch][n:]
+                except socket.error:
+                    pass
+
+    def control(self, kind):
+        self.send(0, scopestream.pack(kind))
+        self.flush()
+
+    def alive(self):
+        if time.time()-self.talive > self.alive_interval:
+            self.control(scopestream.ALIVE)
+            self.talive = time.time()
+
+    def begin(self):
+        for decimator in self.decimators:
+            decimator.reset()
+        self.control(scopestream.BEGIN)
+
+    def poll(self):
+        """Handle requests from the scope"""
+        for kind, t0, dtbin, env in self.reader.read(self.conns[0]):
+            if kind == scopestream.WIDTH:
+                for decimator in self.decimators:
+                    decimator.set_dtbin(dtbin)
+                sys.stdout.write("NICOMEDI: Scope bins are now %d samples\n" % (
+                    self.decimators[0].binsize))
+
+    def plot(self, block):
+        for nch, data in enumerate(block):
+            msg = self.decimators[nch].feed(data.astype(np.float32))
+            if msg is not None:
+                self.send(nch, msg)
+
+def plot_blocks(acq, scope):
+    """Scope side: send the envelopes of all blocks to the plotting process"""
+    scope.poll()
+    nblocks = len(acq.plotblocks)
+    while len(acq.plotblocks):
+        block = acq.plotblocks.popleft()
+        if gPlot:
+            scope.plot(block)
+    scope.flush()
+    if nblocks:
+        sys.stdout.write('.')
+        sys.stdout.flush()
 
 def shutdown(aich):
     ret = c.comedi_close(aich.dev)
@@ -0,0 +1,155 @@
+"""Recover comedi recordings from their temp files
+
+The temp files are memory-mapped and converted chunk by chunk, so
+recordings larger than physical memory can be recovered. After every
+chunk the number of samples done is saved next to the output file;
+an interrupted rescue continues from there when it is started again.
+
+Usage: python3 nirescue.py [options] FILETRUNK
+"""
+
+import os
+import sys
+import json
+import time
+import argparse
+import numpy as np
+
+import h5stream
+import nicomedilib as ncl
+
+CHUNKSIZE = 1<<20 # samples
+
+def map_samples(fn, dtype):
+    """Read-only view of a temp file; empty files can't be mapped"""
+    if os.path.getsize(fn) == 0:
+        return np.empty((0,), dtype=dtype)
+    return np.memmap(fn, dtype=dtype, mode='r')
+
+def load_state(statefn):
+    if not os.path.exists(statefn):
+        return None
+    with open(statefn) as f:
+        return json.load(f)
+
+def save_state(statefn, state):
+    # Replace atomically so that an interruption never leaves half a file
+    with open(statefn + ".tmp", 'w') as f:
+        json.dump(state, f)
+    os.rename(statefn + ".tmp", statefn)
+
+def rescue(statefn, fntmps, fntmpFR=None, fn=None, entmp=None, xunits="ms",
+           yunits=None, dt=0.02, chunksize=CHUNKSIZE, resume=True):
+    """Convert the float32 temp files fntmps to the hdf5 file fn and the
+    int8 frame file fntmpFR to the edge file entmp; returns the number
+    of samples"""
+    if len(fntmps) and not h5stream.has_h5py:
+        # Fall back to converting everything at once
+        sys.stdout.write("NIRESCUE: h5py not found, converting in memory with stfio\n")
+        nsamples = ncl.convert_h5(dt, xunits, yunits, fn, fntmps)
+        fntmps = []
+    data = [map_samples(fntmp, np.float32) for fntmp in fntmps]
+    frames = None
+    if fntmpFR is not None:
+        frames = map_samples(fntmpFR, np.int8)
+    nsamples = min([len(d) for d in data] + ([len(frames)] if frames is not None else []))
+
+    state = None
+    if resume:
+        state = load_state(statefn)
+    if state is not None:
+        pos = state['nsamples']
+        sys.stdout.write("NIRESCUE: Resuming at sample %d of %d\n" % (pos, nsamples))
+    else:
+        pos = 0
+    h5w = None
+    if len(data):
+        h5w = h5stream.H5Stream(fn, dt, xunits, yunits,
+                                resume=pos if state is not None else None)
+    edges = None
+    if frames is not None:
+        if state is not None and pos > 0:
+            edges = ncl.EdgeWriter(entmp, pos, state['nedges'], frames[pos-1])
+        else:
+            edges = ncl.EdgeWriter(entmp)
+
+    t0 = time.time()
+    while pos < nsamples:
+        end = min(pos + chunksize, nsamples)
+        if h5w is not None:
+            h5w.append(*[np.array(d[pos:end]) for d in data])
+            h5w.flush()
+        if edges is not None:
+            edges.feed(np.array(frames[pos:end]))
+            edges.flush()
+        pos = end
+        save_state(statefn, {'nsamples': pos,
+                             'nedges': edges.nedges if edges is not None else 0})
+        sys.stdout.write("\rNIRESCUE: %5.1f%% (%d of %d samples, %.0f s)" % (
+            100.0*pos/nsamples, pos, nsamples, time.time()-t0))
+        sys.stdout.flush()
+    sys.stdout.write("\n")
+
+    if h5w is not None:
+        h5w.close()
+    if edges is not None:
+        edges.close()
+    if os.path.exists(statefn):
+        os.remove(statefn)
+    sys.stdout.write("NIRESCUE: Recovered %d samples\n" % nsamples)
+    sys.stdout.flush()
+    return nsamples
+
+def remove(fntmps):
+    for fntmp in fntmps:
+        os.remove(fntmp)
+
+def rescue1ch(filetrnk, xunits="ms", yunits="mV", dt=0.02, resume=True, keep=False):
+    fntmp = filetrnk + "_tmp.bin"
+    fntmp2 = filetrnk + "_tmp2.bin"
+    rescue(filetrnk + "_rescue.json", [fntmp], fntmp2, filetrnk + ".h5",
+           filetrnk + "_edge.bin", xunits, [yunits], dt, resume=resume)
+    if not keep:
+        remove([fntmp, fntmp2])
+
+def rescue2ch(filetrnk, xunits="ms", yunitsIC="mV", yunitsEC="mV", dt=0.02,
+              resume=True, keep=False):
+    fntmpIC = filetrnk + "_IC.bin"
+    fntmpEC = filetrnk + "_EC.bin"
+    fntmpFR = filetrnk + "_FR.bin"
+    rescue(filetrnk + "_rescue.json", [fntmpIC, fntmpEC], fntmpFR, filetrnk + ".h5",
+           filetrnk + "_edge.bin", xunits, [yunitsIC, yunitsEC], dt, resume=resume)
+    if not keep:
+        remove([fntmpIC, fntmpEC, fntmpFR])
+
+def rescue_framesonly(filetrnk, resume=True, keep=False):
+    fntmp2 = filetrnk + "_tmp2.bin"
+    rescue(filetrnk + "_rescue.json", [], fntmp2, entmp=filetrnk + "_edge.bin",
+           resume=resume)
+    if not keep:
+        remove([fntmp2])
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Recover a comedi recording from its temp files")
+    parser.add_argument("filetrunk", help="recording file name without extension")
+    parser.add_argument("--mode", choices=["2ch", "1ch", "frames"], default="2ch",
+                        help="2ch: _IC/_EC/_FR.bin, 1ch: _tmp/_tmp2.bin, "
+                        "frames: edges from _tmp2.bin only")
+    parser.add_argument("--dt", type=float, default=0.02, help="sampling interval (ms)")
+    parser.add_argument("--restart", action="store_true",
+                        help="ignore a saved state and start from the beginning")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep the temp files after recovery")
+    args = parser.parse_args()
+
+    filetrnk = args.filetrunk
+    if filetrnk.endswith(".h5"):
+        filetrnk = filetrnk[:-3]
+    resume = not args.restart
+    if args.mode == "2ch":
+        rescue2ch(filetrnk, dt=args.dt, resume=resume, keep=args.keep)
+    elif args.mode == "1ch":
+        rescue1ch(filetrnk, dt=args.dt, resume=resume, keep=args.keep)
+    else:
+        rescue_framesonly(filetrnk, resume=resume, keep=args.keep)
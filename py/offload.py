@@ -0,0 +1,395 @@
+"""Copy finished session directories to the network share
+
+nicomedilib.stop used to start rsync for every recording and forget
+about it. Instead, directories are put on a queue that is kept in a
+file, and one daemon works through it:
+
+- Files that are new or differ in size or modification time from the
+  destination are copied to a temporary name. They are renamed only
+  after the copy has been read back and its SHA-256 matches the
+  source's.
+- While a session is live, the daemon runs with idle I/O priority and
+  copies at most settings.offload_live_rate bytes/s.
+- A job that fails is retried with increasing delays, up to
+  MAXATTEMPTS times.
+- The daemon writes its progress to a status file; see
+  `python3 offload.py status`.
+
+enqueue() starts a daemon unless one is running. A daemon exits once
+the queue has been empty for IDLE_EXIT seconds. The destination can be
+any directory, e.g. a second local disk standing in for the share.
+
+Usage: python3 offload.py status|daemon|retry
+       python3 offload.py enqueue SRCDIR DSTDIR [DSTROOT]
+"""
+
+import os
+import sys
+import json
+import time
+import fcntl
+import ctypes
+import hashlib
+import platform
+import threading
+import subprocess
+
+try:
+    import settings
+except ImportError:
+    settings = None
+
+CHUNKSIZE = 1<<20 # bytes
+MAXATTEMPTS = 5
+RETRY_DELAY = 30.0 # s, doubled after every failure
+IDLE_EXIT = 60.0 # s
+POLL_INTERVAL = 2.0 # s
+LIVE_RATE = 10e6 # bytes/s
+TMPSUFFIX = ".offload-tmp"
+KEEPDONE = 200 # finished jobs kept in the queue for status
+
+# ioprio_set(2); there is no wrapper in the standard library
+SYS_IOPRIO_SET = {'x86_64': 251, 'i686': 289, 'aarch64': 30, 'armv7l': 314}
+IOPRIO_WHO_PROCESS = 1
+IOPRIO_CLASS_BE = 2
+IOPRIO_CLASS_IDLE = 3
+IOPRIO_CLASS_SHIFT = 13
+
+def _setting(name, default):
+    return getattr(settings, name, default)
+
+def state_dir():
+    statedir = os.path.expanduser(_setting('offload_state_dir', "~/.gnoom-offload"))
+    if not os.path.isdir(statedir):
+        os.makedirs(statedir)
+    return statedir
+
+def _path(name):
+    return os.path.join(state_dir(), name)
+
+class QueueLock(object):
+    """Exclusive lock around every read-modify-write of the queue"""
+    def __enter__(self):
+        self.f = open(_path("queue.lock"), 'w')
+        fcntl.flock(self.f, fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.f, fcntl.LOCK_UN)
+        self.f.close()
+
+def _load(name, default):
+    fn = _path(name)
+    if not os.path.exists(fn):
+        return default
+    with open(fn) as f:
+        return json.load(f)
+
+def _save(name, data):
+    # Replace atomically so that a crash never leaves half a file
+    fn = _path(name)
+    with open(fn + ".tmp", 'w') as f:
+        json.dump(data, f, indent=1)
+    os.rename(fn + ".tmp", fn)
+
+def load_queue():
+    return _load("queue.json", [])
+
+def update_job(jobid, **changes):
+    with QueueLock():
+        queue = load_queue()
+        for job in queue:
+            if job['id'] == jobid:
+                job.update(changes)
+        _save("queue.json", queue)
+
+def enqueue(src, dst, root=None, mount=False, start=True):
+    """Queue the directory src to be copied to dst. A pending job for
+    the same directories is not queued twice.
+
+    root is the destination directory that dst lies in. It is never
+    created: while it doesn't exist, or with mount=True while it isn't
+    on a mounted file system, the job fails and is retried."""
+    src = os.path.abspath(src)
+    with QueueLock():
+        queue = load_queue()
+        for job in queue:
+            if job['src'] == src and job['dst'] == dst and job['state'] == 'pending':
+                job['next_try'] = 0
+                break
+        else:
+            done = [job for job in queue if job['state'] == 'done']
+            if len(done) > KEEPDONE:
+                queue = [job for job in queue if job not in done[:-KEEPDONE]]
+            queue.append({'id': max([job['id'] for job in queue] + [0]) + 1,
+                          'src': src, 'dst': dst, 'root': root, 'mount': mount,
+                          'state': 'pending',
+                          'attempts': 0, 'next_try': 0, 'error': None,
+                          'nfiles': 0, 'nbytes': 0,
+                          'tqueued': time.time(), 'tdone': None})
+        _save("queue.json", queue)
+    if start:
+        start_daemon()
+
+def start_daemon():
+    """Start a daemon in the background; it exits at once if another
+    one is running"""
+    proc = subprocess.Popen([sys.executable, os.path.realpath(__file__), "daemon"],
+                            start_new_session=True, stdin=subprocess.DEVNULL)
+    # Reap it when it exits instead of leaving a zombie
+    threading.Thread(target=proc.wait, name="offload-reaper", daemon=True).start()
+
+def set_live(live):
+    """Mark a session as running (or finished) on this rig"""
+    fn = _path("live")
+    if live:
+        with open(fn, 'w') as f:
+            f.write("%d\n" % os.getpid())
+    elif os.path.exists(fn):
+        os.remove(fn)
+
+def is_live():
+    fn = _path("live")
+    try:
+        with open(fn) as f:
+            pid = int(f.read())
+        os.kill(pid, 0)
+    except (IOError, OSError, ValueError):
+        # No marker, or left behind by a process that has gone
+        return False
+    return True
+
+def set_ioprio(ioclass, level=4):
+    nr = SYS_IOPRIO_SET.get(platform.machine())
+    if nr is None:
+        return False
+    libc = ctypes.CDLL(None, use_errno=True)
+    return libc.syscall(nr, IOPRIO_WHO_PROCESS, 0,
+                        (ioclass << IOPRIO_CLASS_SHIFT) | level) == 0
+
+def sha256(fn):
+    h = hashlib.sha256()
+    with open(fn, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNKSIZE)
+            if not len(chunk):
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+def on_mount(path):
+    """Whether path lies on a mounted file system other than /; an
+    unmounted share leaves only its empty mount point"""
+    path = os.path.realpath(path)
+    while path != os.path.dirname(path):
+        if os.path.ismount(path):
+            return True
+        path = os.path.dirname(path)
+    return False
+
+def check_root(job):
+    root = job.get('root')
+    if root is None:
+        return
+    if not os.path.isdir(root):
+        raise IOError("Destination %s does not exist" % root)
+    if job.get('mount') and not on_mount(root):
+        raise IOError("Destination %s is not mounted" % root)
+
+def unchanged(srcfn, dstfn):
+    if not os.path.exists(dstfn):
+        return False
+    srcst = os.stat(srcfn)
+    dstst = os.stat(dstfn)
+    return srcst.st_size == dstst.st_size and int(srcst.st_mtime) == int(dstst.st_mtime)
+
+class Daemon(object):
+    def __init__(self):
+        self.lockf = open(_path("daemon.lock"), 'w')
+        # Raises BlockingIOError if another daemon is running
+        fcntl.flock(self.lockf, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        # Jobs that a previous daemon didn't finish start over
+        with QueueLock():
+            queue = load_queue()
+            for job in queue:
+                if job['state'] == 'active':
+                    job['state'] = 'pending'
+            _save("queue.json", queue)
+        self.live = None
+        self.rate = _setting('offload_live_rate', LIVE_RATE)
+        self.status = {'pid': os.getpid(), 'job': None, 'file': None,
+                       'bytes': 0, 'rate': 0.0, 'live': False, 'updated': time.time()}
+
+    def check_live(self):
+        live = is_live()
+        if live != self.live:
+            set_ioprio(IOPRIO_CLASS_IDLE if live else IOPRIO_CLASS_BE)
+            self.live = live
+            self.status['live'] = live
+        return live
+
+    def save_status(self, **changes):
+        self.status.update(changes)
+        self.status['updated'] = time.time()
+        _save("status.json", self.status)
+
+    def copy_file(self, srcfn, dstfn):
+        """Copy with throttling while live and verify the copy; returns
+        the number of bytes"""
+        h = hashlib.sha256()
+        tmpfn = dstfn + TMPSUFFIX
+        t0 = time.time()
+        nbytes = 0
+        with open(srcfn, 'rb') as fsrc, open(tmpfn, 'wb') as fdst:
+            while True:
+                chunk = fsrc.read(CHUNKSIZE)
+                if not len(chunk):
+                    break
+                h.update(chunk)
+                fdst.write(chunk)
+                nbytes += len(chunk)
+                if self.check_live():
+                    # Stay below the rate while a session runs
+                    ahead = nbytes/self.rate - (time.time()-t0)
+                    if ahead > 0:
+                        time.sleep(ahead)
+            fdst.flush()
+            os.fsync(fdst.fileno())
+        self.save_status(file=srcfn, bytes=self.status['bytes'] + nbytes,
+                         rate=nbytes/max(time.time()-t0, 1e-6))
+        if sha256(tmpfn) != h.hexdigest():
+            os.remove(tmpfn)
+            raise IOError("Checksum mismatch for %s" % dstfn)
+        st = os.stat(srcfn)
+        os.utime(tmpfn, (st.st_atime, st.st_mtime))
+        os.rename(tmpfn, dstfn)
+        return nbytes
+
+    def run_job(self, job):
+        nfiles = 0
+        nbytes = 0
+        if not os.path.isdir(job['src']):
+            raise IOError("%s does not exist" % job['src'])
+        check_root(job)
+        for root, dirs, files in os.walk(job['src']):
+            dstroot = os.path.join(job['dst'], os.path.relpath(root, job['src']))
+            if not os.path.isdir(dstroot):
+                os.makedirs(dstroot)
+            for name in sorted(files):
+                if name.endswith(TMPSUFFIX):
+                    continue
+                srcfn = os.path.join(root, name)
+                dstfn = os.path.join(dstroot, name)
+                if unchanged(srcfn, dstfn):
+                    continue
+                nbytes += self.copy_file(srcfn, dstfn)
+                nfiles += 1
+        return nfiles, nbytes
+
+    def next_job(self):
+        now = time.time()
+        for job in load_queue():
+            if job['state'] == 'pending' and job['next_try'] <= now:
+                return job
+        return None
+
+    def release(self):
+        """Give up the daemon lock unless a job was queued meanwhile.
+        This is checked under the queue lock, so that a job queued by
+        enqueue() is either seen here or picked up by the daemon it
+        starts."""
+        with QueueLock():
+            if any([job['state'] == 'pending' for job in load_queue()]):
+                return False
+            self.save_status(job=None, file=None, pid=None)
+            fcntl.flock(self.lockf, fcntl.LOCK_UN)
+            self.lockf.close()
+        return True
+
+    def run(self):
+        self.check_live()
+        sys.stdout.write("OFFLOAD: Daemon running\n")
+        sys.stdout.flush()
+        tidle = time.time()
+        while True:
+            job = self.next_job()
+            if job is None:
+                if any([j['state'] == 'pending' for j in load_queue()]):
+                    tidle = time.time()
+                elif time.time()-tidle > IDLE_EXIT and self.release():
+                    break
+                self.check_live()
+                self.save_status(job=None, file=None)
+                time.sleep(POLL_INTERVAL)
+                continue
+            tidle = time.time()
+            self.save_status(job=job['id'])
+            update_job(job['id'], state='active')
+            try:
+                nfiles, nbytes = self.run_job(job)
+            except (IOError, OSError) as err:
+                attempts = job['attempts'] + 1
+                if attempts >= MAXATTEMPTS:
+                    state = 'failed'
+                    sys.stderr.write("OFFLOAD: Giving up on %s: %s\n" % (job['src'], err))
+                else:
+                    state = 'pending'
+                    sys.stderr.write("OFFLOAD: %s failed (attempt %d): %s\n" % (
+                        job['src'], attempts, err))
+                update_job(job['id'], state=state, attempts=attempts, error=str(err),
+                           next_try=time.time() + RETRY_DELAY * 2**(attempts-1))
+                continue
+            update_job(job['id'], state='done', error=None, nfiles=nfiles,
+                       nbytes=nbytes, tdone=time.time())
+            sys.stdout.write("OFFLOAD: %s: %d files, %.1f MB copied and verified\n" % (
+                job['src'], nfiles, nbytes*1e-6))
+            sys.stdout.flush()
+        sys.stdout.write("OFFLOAD: Queue empty, exiting\n")
+
+def retry_failed():
+    with QueueLock():
+        queue = load_queue()
+        for job in queue:
+            if job['state'] == 'failed':
+                job.update(state='pending', attempts=0, next_try=0)
+        _save("queue.json", queue)
+
+def print_status():
+    status = _load("status.json", {})
+    if status.get('pid'):
+        sys.stdout.write("Daemon %d, %s, %.1f MB copied, last file at %.1f MB/s\n" % (
+            status['pid'], "session live" if status['live'] else "idle rig",
+            status['bytes']*1e-6, status['rate']*1e-6))
+        if status['file'] is not None:
+            sys.stdout.write("Copying %s\n" % status['file'])
+    else:
+        sys.stdout.write("Daemon not running\n")
+    for job in load_queue():
+        line = "%4d %-8s %s -> %s" % (job['id'], job['state'], job['src'], job['dst'])
+        if job['state'] == 'done':
+            line += " (%d files, %.1f MB)" % (job['nfiles'], job['nbytes']*1e-6)
+        elif job['error'] is not None:
+            line += " (%d attempts: %s)" % (job['attempts'], job['error'])
+        sys.stdout.write(line + "\n")
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        sys.stdout.write(__doc__)
+        sys.exit(1)
+    cmd = sys.argv[1]
+    if cmd == "daemon":
+        try:
+            daemon = Daemon()
+        except BlockingIOError:
+            sys.exit(0)
+        daemon.run()
+    elif cmd == "status":
+        print_status()
+    elif cmd == "retry":
+        retry_failed()
+        start_daemon()
+    elif cmd == "enqueue":
+        enqueue(sys.argv[2], sys.argv[3], root=sys.argv[4] if len(sys.argv) > 4 else None)
+    else:
+        sys.stdout.write(__doc__)
+        sys.exit(1)
@@ -0,0 +1,209 @@
+"""Drive a New Era syringe pump from a background thread
+
+Rewards are requested from the game loop and only put on a queue; the
+thread sends the commands, waits for the pump's replies and keeps
+track of what the pump confirmed. A reply in basic mode is
+
+    STX, 2-digit address, status character, optional data, ETX
+
+where the data is a query result, an alarm ('?R', '?S', ...) after
+status 'A', or an error ('?', '?NA', '?OOR', '?COM', '?IGN').
+"""
+
+import sys
+import time
+import threading
+import collections
+
+STX = b'\x02'
+ETX = b'\x03'
+
+STATUS = {'I': 'infusing', 'W': 'withdrawing', 'S': 'stopped', 'P': 'paused',
+          'T': 'timed pause', 'U': 'waiting for user', 'X': 'purging', 'A': 'alarm'}
+ALARMS = {'R': 'pump was reset', 'S': 'pump motor stalled', 'T': 'safe mode timeout',
+          'E': 'pumping program error', 'O': 'pumping program phase out of range'}
+ERRORS = {'': 'command not recognized', 'NA': 'command not currently applicable',
+          'OOR': 'command data out of range', 'COM': 'invalid communications packet',
+          'IGN': 'command ignored due to a simultaneous new phase start'}
+
+RESPONSE_TIMEOUT = 1.0 # s
+
+class PumpResponse(object):
+    def __init__(self, address, status, data=''):
+        self.address = address
+        self.status = status
+        self.data = data
+        self.alarm = None
+        self.error = None
+        if status == 'A' and data.startswith('?'):
+            self.alarm = ALARMS.get(data[1:], data)
+        elif data.startswith('?'):
+            self.error = ERRORS.get(data[1:], data)
+
+    @property
+    def ok(self):
+        return self.alarm is None and self.error is None
+
+    def __str__(self):
+        msg = STATUS.get(self.status, self.status)
+        if self.alarm is not None:
+            msg += ": " + self.alarm
+        elif self.error is not None:
+            msg += ": " + self.error
+        elif len(self.data):
+            msg += " " + self.data
+        return msg
+
+def parse_response(resp):
+    """Parse one reply; returns None if it is incomplete or garbled"""
+    resp = bytes(resp)
+    start = resp.rfind(STX)
+    if start == -1 or not resp.endswith(ETX):
+        return None
+    body = resp[start+1:-1].decode('ascii', 'replace')
+    if len(body) < 3 or not body[:2].isdigit():
+        return None
+    return PumpResponse(int(body[:2]), body[2], body[3:])
+
+def parse_dispensed(data):
+    """Infused and withdrawn volume from the data of a DIS reply,
+    e.g. 'I1.234W0.000UL'"""
+    try:
+        infused = float(data[1:data.index('W')])
+        withdrawn = float(data[data.index('W')+1:-2])
+    except ValueError:
+        return None
+    return infused, withdrawn, data[-2:]
+
+class PumpDriver(threading.Thread):
+    """Owns the serial connection to the pump.
+
+    reward() and the other requests return at once; the thread works
+    through them in order, waiting at most timeout seconds for each
+    reply. A reward counts as delivered when the pump
+    replies to RUN that it is infusing; the time from the request to
+    that reply is its latency.
+    """
+    def __init__(self, ser, volume=0.0, timeout=RESPONSE_TIMEOUT):
+        threading.Thread.__init__(self, name="pumpdriver")
+        self.daemon = True
+        self.ser = ser
+        self.volume = volume # ul per reward
+        self.timeout = timeout
+        self.requests = collections.deque()
+        self.wake = threading.Event()
+        self.running = True
+        self.last = None
+
+        # metrics
+        self.nrequests = 0
+        self.ndelivered = 0
+        self.nfailed = 0
+        self.delivered = 0.0 # ul
+        self.dispensed = None # ul, as reported by the pump
+        self.latency_sum = 0.0
+        self.latency_max = 0.0
+
+    def put(self, kind, arg=None):
+        self.requests.append((time.time(), kind, arg))
+        self.wake.set()
+
+    def reward(self, buzz=True):
+        self.nrequests += 1
+        self.put('run')
+        if buzz:
+            self.put('buzz')
+
+    def buzz(self):
+        self.put('buzz')
+
+    def set_volume(self, vol):
+        self.put('volume', vol)
+
+    def command(self, cmd):
+        """Send one command and wait for its reply"""
+        self.ser.write(cmd.encode('ascii') + b"\r")
+        resp = parse_response(self.ser.read_until(ETX))
+        if resp is None:
+            sys.stderr.write("PUMP: No valid reply to {0}\n".format(cmd))
+        elif not resp.ok:
+            sys.stderr.write("PUMP: {0}: {1}\n".format(cmd, resp))
+        self.last = resp
+        return resp
+
+    def handle(self, trequest, kind, arg):
+        if kind == 'run':
+            resp = self.command("RUN")
+            if resp is not None and resp.ok and resp.status == 'I':
+                latency = time.time()-trequest
+                self.ndelivered += 1
+                self.delivered += self.volume
+                self.latency_sum += latency
+                self.latency_max = max(self.latency_max, latency)
+            else:
+                self.nfailed += 1
+        elif kind == 'buzz':
+            self.command("BUZ 1 2")
+        elif kind == 'volume':
+            svol = "%05.2f" % arg
+            self.command("VOL UL")
+            resp = self.command("VOL %s" % svol)
+            if resp is not None and resp.ok:
+                self.volume = arg
+        elif kind == 'dispensed':
+            resp = self.command("DIS")
+            if resp is not None and resp.ok:
+                dispensed = parse_dispensed(resp.data)
+                if dispensed is not None:
+                    self.dispensed = dispensed[0]
+
+    def run(self):
+        # read_until gives up after the port's timeout
+        self.ser.timeout = self.timeout
+        self.ser.reset_input_buffer()
+        while self.running or len(self.requests):
+            self.wake.wait(0.1)
+            self.wake.clear()
+            while len(self.requests):
+                trequest, kind, arg = self.requests.popleft()
+                try:
+                    self.handle(trequest, kind, arg)
+                except Exception as err:
+                    sys.stderr.write("PUMP: {0} failed: {1}\n".format(kind, err))
+                    if kind == 'run':
+                        self.nfailed += 1
+
+    def metrics(self):
+        return {'requests': self.nrequests,
+                'delivered': self.ndelivered,
+                'failed': self.nfailed,
+                'pending': len(self.requests),
+                'volume_ul': self.delivered,
+                'dispensed_ul': self.dispensed,
+                'latency_mean': self.latency_sum/self.ndelivered if self.ndelivered else 0.0,
+                'latency_max': self.latency_max,
+                'status': str(self.last) if self.last is not None else None}
+
+    def report(self):
+        m = self.metrics()
+        sys.stdout.write(
+            "PUMP: {0} rewards requested, {1} delivered ({2:.2f} ul), {3} failed\n".format(
+            m['requests'], m['delivered'], m['volume_ul'], m['failed']))
+        if m['dispensed_ul'] is not None:
+            sys.stdout.write("PUMP: Pump reports {0:.3f} ul infused\n".format(m['dispensed_ul']))
+        if m['delivered']:
+            sys.stdout.write(
+                "PUMP: Request to acknowledgement {0:.1f} ms mean, {1:.1f} ms max\n".format(
+                m['latency_mean']*1e3, m['latency_max']*1e3))
+        sys.stdout.flush()
+
+    def stop(self):
+        """Ask the pump for its infused volume, finish all requests and
+        print the metrics"""
+        if not self.is_alive():
+            return
+        self.put('dispensed')
+        self.running = False
+        self.wake.set()
+        self.join()
+        self.report()
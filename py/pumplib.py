@@ -20,6 +20,8 @@ import sys
 import time
 import socket
 
+import pumpdriver
+
 sys.stdout.write("Opening serial port...")
 sys.stdout.flush()
 
@@ -48,11 +50,11 @@ time.sleep(2.0)
 sys.stdout.write(" done\n")
 
 def write_bytes(string, block=True):
-    resp = '1'
-    while resp != '0':
+    # Repeat until the pump accepts the command
+    while True:
         ser.write(bytearray(string, 'ascii'))
-        resp = ser.read().decode('utf-8')
-        if not block:
+        resp = pumpdriver.parse_response(ser.read_until(pumpdriver.ETX))
+        if not block or (resp is not None and resp.ok):
             break
         time.sleep(0.5)
     print(resp)
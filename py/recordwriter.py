@@ -0,0 +1,109 @@
+"""Assemble the records of one logic tick in a single buffer
+
+Every tick write_record_file appends to the recording's .bin file
+(GameLogic.Object['current_file'])
+
+    20 float64   dt, translation, position, time, orientation and the
+                 numbers of mouse 1 samples, mouse 2 samples and frame
+                 times
+    4 float64    x, y, t, dt of each mouse 1 sample
+    4 float64    x, y, t, dt of each mouse 2 sample
+    float64      each camera frame time
+
+RecordBlock fills a preallocated buffer with all of it, so that a tick
+costs one write instead of one per sample.
+
+Run it directly to compare it with writing sample by sample:
+
+    python3 recordwriter.py [samples per mouse per tick]
+"""
+
+import sys
+import time
+import numpy as np
+
+NSTATE = 17 # header values before the three counts
+HEADERSIZE = NSTATE + 3
+RECSIZE = 4
+
+class RecordBlock(object):
+    def __init__(self, capacity=1024):
+        self.buf = np.empty((capacity,), dtype=np.float64)
+
+    def pack(self, state, move, frametimes):
+        """Returns the bytes of one tick; state holds the first 17
+        header values, move is (x1, y1, x2, y2, t1, t2, dt1, dt2)"""
+        n1 = len(move[0])
+        n2 = len(move[2])
+        nframes = len(frametimes)
+        end1 = HEADERSIZE + RECSIZE*n1
+        end2 = end1 + RECSIZE*n2
+        n = end2 + nframes
+        if n > len(self.buf):
+            self.buf = np.empty((max(n, 2*len(self.buf)),), dtype=np.float64)
+        buf = self.buf[:n]
+        buf[:NSTATE] = state
+        buf[NSTATE:HEADERSIZE] = (n1, n2, nframes)
+        samples1 = buf[HEADERSIZE:end1].reshape((n1, RECSIZE))
+        for ncol, nmove in enumerate((0, 1, 4, 6)):
+            samples1[:, ncol] = move[nmove]
+        samples2 = buf[end1:end2].reshape((n2, RECSIZE))
+        for ncol, nmove in enumerate((2, 3, 5, 7)):
+            samples2[:, ncol] = move[nmove]
+        buf[end2:] = frametimes
+        return memoryview(buf).cast('B')
+
+    def write(self, f, state, move, frametimes):
+        f.write(self.pack(state, move, frametimes))
+        f.flush()
+
+def write_by_sample(f, state, move, frametimes):
+    """How write_record_file used to write a tick"""
+    f.write(np.array(list(state) + [len(move[0]), len(move[2]), len(frametimes)],
+                     dtype=np.float64).tobytes())
+    f.flush()
+    for nm in range(len(move[0])):
+        f.write(np.array([
+            move[0][nm], move[1][nm], move[4][nm], move[6][nm]], dtype=np.float64).tobytes())
+    for nm in range(len(move[2])):
+        f.write(np.array([
+            move[2][nm], move[3][nm], move[5][nm], move[7][nm]], dtype=np.float64).tobytes())
+    if (len(move[0]) or len(move[2])):
+        f.flush()
+    if len(frametimes) > 0:
+        f.write(frametimes.tobytes())
+        f.flush()
+
+if __name__ == "__main__":
+    import os
+    import tempfile
+
+    nsamples = 8
+    if len(sys.argv) > 1:
+        nsamples = int(sys.argv[1])
+    nticks = 2000
+
+    ticks = []
+    for ntick in range(nticks):
+        n1 = np.random.randint(0, 2*nsamples+1)
+        n2 = np.random.randint(0, 2*nsamples+1)
+        move = [np.random.randn(n) for n in (n1, n1, n2, n2, n1, n2, n1, n2)]
+        ticks.append((np.random.randn(NSTATE), move, np.random.rand(np.random.randint(0, 3))))
+
+    fd, fn = tempfile.mkstemp(prefix="recordwriter")
+    os.close(fd)
+    results = {}
+    block = RecordBlock()
+    for name, write in [("by sample", write_by_sample), ("one block", block.write)]:
+        with open(fn, 'wb') as f:
+            t0 = time.time()
+            for state, move, frametimes in ticks:
+                write(f, state, move, frametimes)
+            dt = time.time()-t0
+        with open(fn, 'rb') as f:
+            results[name] = f.read()
+        sys.stdout.write("RECORDWRITER: %-9s %6.1f us per tick\n" % (name, dt*1e6/nticks))
+    os.remove(fn)
+    sys.stdout.write("RECORDWRITER: %d bytes, files %s\n" % (
+        len(results["one block"]),
+        "identical" if results["by sample"] == results["one block"] else "DIFFER"))
@@ -0,0 +1,95 @@
+"""Preallocated receive buffers for fixed-size sample records"""
+
+import os
+import socket
+import numpy as np
+
+BUFSIZE = 65536 # bytes
+
+class RecvBuffer(object):
+    """Receive buffer that hands out whole records as NumPy views.
+
+    fill() reads everything that is available on a non-blocking
+    socket with recv_into, take() returns all complete records as an
+    array that points into the buffer. A trailing partial record is
+    moved to the front of the buffer at the start of the next fill()
+    or feed(), so the returned array is only valid until then.
+    """
+    def __init__(self, recsize, dtype=np.float64, bufsize=BUFSIZE):
+        self.recsize = recsize
+        self.dtype = np.dtype(dtype)
+        self.buf = bytearray(max(bufsize, recsize))
+        self.view = memoryview(self.buf)
+        self.start = 0
+        self.end = 0
+        # statistics
+        self.nbytes = 0
+        self.nrecords = 0
+
+    def _compact(self):
+        nrem = self.end - self.start
+        if nrem and self.start:
+            self.buf[:nrem] = self.buf[self.start:self.end]
+        self.start = 0
+        self.end = nrem
+
+    def _grow(self):
+        buf = bytearray(2*len(self.buf))
+        buf[:self.end] = self.buf[:self.end]
+        self.buf = buf
+        self.view = memoryview(self.buf)
+
+    def fill(self, conn):
+        """Read from conn until it would block; returns number of bytes read"""
+        self._compact()
+        nread = 0
+        while True:
+            if self.end == len(self.buf):
+                self._grow()
+            try:
+                n = conn.recv_into(self.view[self.end:])
+            except (socket.error, OSError):
+                break
+            if n == 0:
+                break
+            self.end += n
+            nread += n
+        self.nbytes += nread
+        return nread
+
+    def readfd(self, fd, maxbytes=None):
+        """Read once from a file descriptor into the free space; returns
+        number of bytes read"""
+        self._compact()
+        if self.end == len(self.buf):
+            self._grow()
+        end = len(self.buf)
+        if maxbytes is not None:
+            end = min(end, self.end + maxbytes)
+        n = os.readv(fd, [self.view[self.end:end]])
+        self.end += n
+        self.nbytes += n
+        return n
+
+    def feed(self, data):
+        """Append data that was received elsewhere (e.g. a zmq message)"""
+        self._compact()
+        while self.end + len(data) > len(self.buf):
+            self._grow()
+        self.buf[self.end:self.end+len(data)] = data
+        self.end += len(data)
+        self.nbytes += len(data)
+
+    def take(self):
+        """Return all complete records as an array view into the buffer"""
+        nrec = (self.end - self.start) // self.recsize
+        nb = nrec * self.recsize
+        rec = np.frombuffer(self.buf, dtype=self.dtype,
+                            count=nb // self.dtype.itemsize, offset=self.start)
+        self.start += nb
+        self.nrecords += nrec
+        return rec
+
+    def read(self, conn):
+        self.fill(conn)
+        return self.take()
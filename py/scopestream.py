@@ -0,0 +1,120 @@
+"""Min/max envelope stream from nicomedi to the wxplot scope
+
+Instead of every n-th sample, nicomedi sends the minimum and maximum
+of each bin of samples, so that spikes shorter than the decimation
+interval still show up. Every message is a header
+
+    4 bytes  magic b'GNSC'
+    1 byte   kind
+    3 bytes  padding
+    uint32   number of bins
+    float64  t0: time of the first bin since the recording started (s)
+    float64  dtbin: duration of one bin (s)
+
+followed, for DATA messages, by nbins (min, max) pairs as float32.
+The scope asks for a bin duration with a WIDTH message whose dtbin is
+the visible time span divided by its width in pixels.
+
+Must run under python2 as well, since wxplot does.
+"""
+
+import sys
+import socket
+import struct
+import numpy as np
+
+MAGIC = b'GNSC'
+HEADER = struct.Struct('<4sBxxxIdd')
+
+DATA = 0
+BEGIN = 1
+ALIVE = 2
+QUIT = 3
+CLOSE = 4
+WIDTH = 5
+
+def pack(kind, nbins=0, t0=0.0, dtbin=0.0, env=None):
+    msg = HEADER.pack(MAGIC, kind, nbins, t0, dtbin)
+    if env is not None:
+        msg += np.ascontiguousarray(env, dtype=np.float32).tobytes()
+    return msg
+
+class Decimator(object):
+    """Reduces one channel to (min, max) pairs per bin.
+
+    Samples that do not fill a whole bin are kept for the next block,
+    so bins never straddle two messages.
+    """
+    def __init__(self, dt, binsize=1):
+        self.dt = dt
+        self.binsize = binsize
+        self.carry = np.empty((0,), dtype=np.float32)
+        self.nsamples = 0 # samples consumed so far, for t0
+
+    def set_dtbin(self, dtbin):
+        self.binsize = max(1, int(dtbin/self.dt))
+
+    def reset(self):
+        self.carry = self.carry[:0]
+        self.nsamples = 0
+
+    def feed(self, data):
+        """Returns a DATA message, or None if no bin is complete"""
+        if len(self.carry):
+            data = np.concatenate([self.carry, data])
+        nbins = len(data) // self.binsize
+        n = nbins * self.binsize
+        self.carry = data[n:].copy()
+        if nbins == 0:
+            return None
+        bins = data[:n].reshape((nbins, self.binsize))
+        env = np.empty((nbins, 2), dtype=np.float32)
+        bins.min(axis=1, out=env[:, 0])
+        bins.max(axis=1, out=env[:, 1])
+        t0 = self.nsamples * self.dt
+        self.nsamples += n
+        return pack(DATA, nbins, t0, self.binsize*self.dt, env)
+
+class Reader(object):
+    """Splits received bytes into (kind, t0, dtbin, env) messages"""
+    def __init__(self):
+        self.buf = b''
+
+    def feed(self, data):
+        self.buf += data
+
+    def messages(self):
+        msgs = []
+        while len(self.buf) >= HEADER.size:
+            magic, kind, nbins, t0, dtbin = HEADER.unpack_from(self.buf, 0)
+            if magic != MAGIC:
+                # Lost sync; skip ahead to the next magic
+                nextmagic = self.buf.find(MAGIC, 1)
+                if nextmagic == -1:
+                    self.buf = self.buf[-(len(MAGIC)-1):]
+                    break
+                self.buf = self.buf[nextmagic:]
+                continue
+            nbytes = HEADER.size
+            if kind == DATA:
+                nbytes += nbins*2*4
+            if len(self.buf) < nbytes:
+                break
+            env = None
+            if kind == DATA:
+                env = np.frombuffer(self.buf[HEADER.size:nbytes], dtype=np.float32).reshape((nbins, 2))
+            msgs.append((kind, t0, dtbin, env))
+            self.buf = self.buf[nbytes:]
+        return msgs
+
+    def read(self, sock):
+        """Receive everything available on a non-blocking socket"""
+        while True:
+            try:
+                data = sock.recv(65536)
+            except socket.error:
+                break
+            if not len(data):
+                break
+            self.feed(data)
+        return self.messages()
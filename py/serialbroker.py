@@ -0,0 +1,378 @@
+"""One process that owns a serial device for all its clients
+
+Blender and the lick readers talk to the same arduino. Instead of each
+opening the tty, they connect to a broker on a local socket. The broker
+queues their commands by priority, so that frame toggles go out before
+valve and polling commands. It writes the queue in batches whenever the
+port can take more, and forwards everything the arduino sends to the
+client that listens.
+
+Every message from a client is a header
+
+    2 bytes  magic b'SB'
+    1 byte   kind
+    1 byte   priority (lower goes first)
+    2 bytes  payload length
+
+followed by the payload. The broker answers LISTEN with one byte,
+ACCEPTED or REFUSED: a device has at most one listener, because the
+arduino's replies carry no address and a second reader would consume
+the first one's data. Bytes from the arduino are then sent to the
+listener as they are, without framing.
+
+BrokerPort can be used in place of arduino_serial.SerialPort:
+
+    arduino = serialbroker.open_port("/dev/ttyACM0", 19200)
+
+starts a broker for the device unless one is running. The broker exits
+shortly after its last client has disconnected.
+
+Usage: python3 serialbroker.py DEVICE [BAUDRATE]
+"""
+
+import os
+import sys
+import time
+import heapq
+import socket
+import struct
+import selectors
+import threading
+import subprocess
+
+sys.path.append(os.path.dirname(os.path.realpath(__file__)) + "/../arduino/py")
+import arduino_serial
+
+MAGIC = b'SB'
+HEADER = struct.Struct('<2sBBH')
+
+WRITE = 0  # bytes for the arduino
+LISTEN = 1 # no payload; send me what the arduino sends
+
+ACCEPTED = b'\x01'
+REFUSED = b'\x00'
+
+# Command priorities; frame toggles must not wait behind anything
+PRIO_FRAME = 0
+PRIO_VALVE = 1
+PRIO_DEFAULT = 2
+PRIO_POLL = 3
+PRIORITIES = {b'u': PRIO_FRAME, b'd': PRIO_FRAME, b'e': PRIO_FRAME, b'f': PRIO_FRAME,
+              b'w': PRIO_POLL, b'a': PRIO_POLL}
+PRIORITIES.update([(valve, PRIO_VALVE) for valve in
+                   [b'1', b'2', b'3', b'4', b'5', b'6', b'7', b'8', b'9', b'0']])
+
+# Largest write to the port (bytes); keeps later high-priority
+# commands from waiting behind a long batch in the tty buffer
+BATCHSIZE = 64
+# Exit this long after the last client has gone (s)
+LINGER = 1.0
+# How long open_port waits for a new broker (s)
+STARTUP_TIMEOUT = 5.0
+# A listener that falls this far behind is dropped (bytes)
+MAXCLIENTBUF = 1<<20
+
+class ListenerRefused(OSError):
+    """Another client listens to the device already"""
+
+def sockname(device):
+    return "\0gnoomserial" + os.path.realpath(device)
+
+def priority(cmd):
+    return PRIORITIES.get(bytes(cmd[:1]), PRIO_DEFAULT)
+
+class Client(object):
+    def __init__(self, conn):
+        self.conn = conn
+        self.buf = b''
+        self.listen = False
+        # bytes from the arduino that the socket couldn't take yet
+        self.outbuf = bytearray()
+        self.writing = False
+
+    def messages(self):
+        msgs = []
+        while len(self.buf) >= HEADER.size:
+            magic, kind, prio, length = HEADER.unpack_from(self.buf, 0)
+            if magic != MAGIC:
+                # Lost sync; skip ahead to the next magic
+                nextmagic = self.buf.find(MAGIC, 1)
+                if nextmagic == -1:
+                    self.buf = self.buf[-(len(MAGIC)-1):]
+                    break
+                self.buf = self.buf[nextmagic:]
+                continue
+            if len(self.buf) < HEADER.size + length:
+                break
+            msgs.append((kind, prio, self.buf[HEADER.size:HEADER.size+length]))
+            self.buf = self.buf[HEADER.size+length:]
+        return msgs
+
+class Broker(object):
+    def __init__(self, device, bps=19200):
+        self.device = device
+        self.port = arduino_serial.SerialPort(device, bps)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Fails if another broker owns the device already
+        self.listener.bind(sockname(device))
+        self.listener.listen(8)
+        self.listener.setblocking(0)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.listener, selectors.EVENT_READ, None)
+        self.sel.register(self.port.fd, selectors.EVENT_READ, self.port)
+        self.clients = {}
+        self.queue = []
+        self.seq = 0
+        self.outbuf = b''
+        self.writing = False
+        self.hangup = False
+        # statistics
+        self.ncommands = 0
+        self.nbatches = 0
+        self.nbytes = 0
+        self.maxqueue = 0
+
+    def accept(self):
+        conn, addr = self.listener.accept()
+        conn.setblocking(0)
+        self.clients[conn] = Client(conn)
+        self.sel.register(conn, selectors.EVENT_READ, self.clients[conn])
+
+    def drop(self, client):
+        if client.conn not in self.clients:
+            return
+        self.sel.unregister(client.conn)
+        client.conn.close()
+        del self.clients[client.conn]
+
+    def receive(self, client):
+        try:
+            data = client.conn.recv(65536)
+        except BlockingIOError:
+            return
+        except OSError:
+            data = b''
+        if not len(data):
+            self.drop(client)
+            return
+        client.buf += data
+        for kind, prio, payload in client.messages():
+            if kind == WRITE:
+                heapq.heappush(self.queue, (prio, self.seq, payload))
+                self.seq += 1
+                self.ncommands += 1
+            elif kind == LISTEN:
+                if any([other.listen for other in self.clients.values()]):
+                    sys.stderr.write("SERIALBROKER: {0} has a listener already\n".format(
+                        self.device))
+                    client.outbuf.extend(REFUSED)
+                else:
+                    client.listen = True
+                    client.outbuf.extend(ACCEPTED)
+                self.send(client)
+        self.maxqueue = max(self.maxqueue, len(self.queue))
+
+    def forward(self):
+        if self.port.fill() == 0:
+            # Readable without data: the device has gone
+            self.hangup = True
+            return
+        data = bytes(self.port.buf)
+        del self.port.buf[:]
+        for client in list(self.clients.values()):
+            if client.listen and len(data):
+                client.outbuf.extend(data)
+                if len(client.outbuf) > MAXCLIENTBUF:
+                    sys.stderr.write("SERIALBROKER: Client too slow, dropping it\n")
+                    self.drop(client)
+                else:
+                    self.send(client)
+
+    def send(self, client):
+        # Whatever the socket doesn't take now is sent once it is
+        # writable again
+        try:
+            nsent = client.conn.send(client.outbuf)
+        except BlockingIOError:
+            nsent = 0
+        except OSError:
+            self.drop(client)
+            return
+        del client.outbuf[:nsent]
+        writing = len(client.outbuf) > 0
+        if writing != client.writing:
+            events = selectors.EVENT_READ
+            if writing:
+                events |= selectors.EVENT_WRITE
+            self.sel.modify(client.conn, events, client)
+            client.writing = writing
+
+    def write(self):
+        # Only refill the batch once the last one has gone out, so that
+        # commands arriving in the meantime are still sorted
+        if not len(self.outbuf) and len(self.queue):
+            batch = []
+            nbytes = 0
+            while len(self.queue) and nbytes < BATCHSIZE:
+                prio, seq, payload = heapq.heappop(self.queue)
+                batch.append(payload)
+                nbytes += len(payload)
+            self.outbuf = b''.join(batch)
+            self.nbatches += 1
+        try:
+            nwritten = os.write(self.port.fd, self.outbuf)
+        except BlockingIOError:
+            nwritten = 0
+        self.outbuf = self.outbuf[nwritten:]
+        self.nbytes += nwritten
+
+    def update_writing(self):
+        writing = len(self.outbuf) > 0 or len(self.queue) > 0
+        if writing != self.writing:
+            events = selectors.EVENT_READ
+            if writing:
+                events |= selectors.EVENT_WRITE
+            self.sel.modify(self.port.fd, events, self.port)
+            self.writing = writing
+
+    def run(self):
+        tlast = time.time()
+        while (len(self.clients) or time.time()-tlast < LINGER) and not self.hangup:
+            for key, mask in self.sel.select(LINGER):
+                if key.data is None:
+                    self.accept()
+                elif key.data is self.port:
+                    if mask & selectors.EVENT_READ:
+                        self.forward()
+                    if mask & selectors.EVENT_WRITE:
+                        self.write()
+                else:
+                    if mask & selectors.EVENT_READ:
+                        self.receive(key.data)
+                    if mask & selectors.EVENT_WRITE and key.data.conn in self.clients:
+                        self.send(key.data)
+            self.update_writing()
+            if len(self.clients):
+                tlast = time.time()
+        if self.hangup:
+            sys.stderr.write("SERIALBROKER: Lost {0}\n".format(self.device))
+
+    def close(self):
+        self.sel.close()
+        self.listener.close()
+        for conn in self.clients:
+            conn.close()
+        os.close(self.port.fd)
+        sys.stdout.write(
+            "SERIALBROKER: {0} commands, {1} bytes in {2} writes, "
+            "at most {3} queued\n".format(
+            self.ncommands, self.nbytes, self.nbatches, self.maxqueue))
+        sys.stdout.flush()
+
+class BrokerPort(arduino_serial.SerialPort):
+    """Client end of a broker with the interface of SerialPort.
+
+    Reading works as for SerialPort, from the bytes that the broker
+    forwards; only a port opened with listen=True receives them. Raises
+    ListenerRefused if another port listens to the device already.
+
+    write() never blocks: what the socket can't take is kept and sent
+    before the next command, or by flush_output().
+    """
+    def __init__(self, device, listen=False):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(sockname(device))
+        self.fd = self.sock.fileno()
+        self.buf = bytearray()
+        self.outbuf = bytearray()
+        self.nreads = 0
+        self.nbytes = 0
+        if listen:
+            self.sock.settimeout(STARTUP_TIMEOUT)
+            self.sock.sendall(HEADER.pack(MAGIC, LISTEN, 0, 0))
+            try:
+                reply = self.sock.recv(1)
+            except socket.timeout:
+                reply = b''
+            if reply != ACCEPTED:
+                self.sock.close()
+                raise ListenerRefused("Another process listens to {0}".format(device))
+        self.sock.setblocking(0)
+
+    def write(self, cmd, prio=None):
+        if prio is None:
+            prio = priority(cmd)
+        self.outbuf.extend(HEADER.pack(MAGIC, WRITE, prio, len(cmd)))
+        self.outbuf.extend(cmd)
+        self.flush_output()
+        return len(cmd)
+
+    def flush_output(self):
+        """Send what earlier writes left; True once all has gone"""
+        if len(self.outbuf):
+            try:
+                nsent = self.sock.send(self.outbuf)
+            except BlockingIOError:
+                nsent = 0
+            del self.outbuf[:nsent]
+        return not len(self.outbuf)
+
+    def write_byte(self, byte):
+        self.write(bytes([byte]))
+
+    def close(self):
+        if len(self.outbuf):
+            self.sock.setblocking(1)
+            self.sock.sendall(self.outbuf)
+        self.sock.close()
+
+def open_port(device, bps=19200, listen=False):
+    """Connects to the broker of device, starting one if necessary.
+    Raises OSError if there is no broker after STARTUP_TIMEOUT, and
+    ListenerRefused if listen is set and the device has a listener."""
+    try:
+        return BrokerPort(device, listen)
+    except ListenerRefused:
+        raise
+    except OSError:
+        pass
+    if not os.path.exists(device):
+        raise OSError("No serial device {0}".format(device))
+    # Detached, so that it outlives a client that is stopped with ^C;
+    # the thread reaps it when it exits
+    proc = subprocess.Popen(['python3', os.path.realpath(__file__), device, str(bps)],
+                            start_new_session=True, stdin=subprocess.DEVNULL)
+    threading.Thread(target=proc.wait, name="serialbroker-reaper", daemon=True).start()
+    t0 = time.time()
+    while time.time()-t0 < STARTUP_TIMEOUT:
+        try:
+            return BrokerPort(device, listen)
+        except ListenerRefused:
+            raise
+        except OSError:
+            if proc.poll() is not None:
+                # Another process started a broker at the same time
+                try:
+                    return BrokerPort(device, listen)
+                except OSError:
+                    raise OSError("Serial broker for {0} exited".format(device))
+            time.sleep(0.01)
+    raise OSError("Serial broker for {0} did not start".format(device))
+
+if __name__ == "__main__":
+    device = sys.argv[1]
+    bps = 19200
+    if len(sys.argv) > 2:
+        bps = int(sys.argv[2])
+    try:
+        broker = Broker(device, bps)
+    except OSError as err:
+        sys.stderr.write("SERIALBROKER: Couldn't open {0}: {1}\n".format(device, err))
+        sys.exit(1)
+    sys.stdout.write("SERIALBROKER: Serving {0}\n".format(device))
+    sys.stdout.flush()
+    try:
+        broker.run()
+    except KeyboardInterrupt:
+        pass
+    broker.close()
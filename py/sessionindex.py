@@ -0,0 +1,83 @@
+"""Number the session files of a directory without probing for them
+
+Session files are named <trunk>_0000.<ext>, <trunk>_0001.<ext>, ... A
+SessionIndex lists its directory once with os.scandir and remembers the
+highest number in use, whatever the extension. Every later session
+costs a single open() that creates the new file with O_EXCL, so two
+rigs writing to the same directory can never pick the same number: the
+one that loses moves on to the next number.
+
+Directories are created with ensure_dir, which remembers the ones it
+has already seen.
+"""
+
+import os
+import re
+import sys
+
+FILEMODE = 0o664
+DIRMODE = 0o775
+
+# Directories known to exist, and the indices by trunk
+_dirs = set()
+_indices = {}
+
+def ensure_dir(path, gid=-1):
+    """Create path unless it exists; returns True if it was created"""
+    path = os.path.normpath(path)
+    if path in _dirs:
+        return False
+    try:
+        os.umask(0)
+        os.mkdir(path, DIRMODE)
+    except FileExistsError:
+        created = False
+    else:
+        created = True
+        if gid != -1:
+            os.chown(path, -1, gid)
+    _dirs.add(path)
+    return created
+
+class SessionIndex(object):
+    def __init__(self, trunk):
+        self.trunk = trunk
+        self.directory = os.path.dirname(trunk) or "."
+        self.highest = self.scan()
+
+    def scan(self):
+        """Highest number used by any file of this trunk, -1 if none"""
+        pattern = re.compile(re.escape(os.path.basename(self.trunk)) + r"_(\d{4})(?!\d)")
+        highest = -1
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                match = pattern.match(entry.name)
+                if match is not None:
+                    highest = max(highest, int(match.group(1)))
+        return highest
+
+    def name(self, no, ext):
+        return "%s_%04d.%s" % (self.trunk, no, ext)
+
+    def create(self, ext):
+        """Create the first file after the highest number; returns its
+        name and number"""
+        no = self.highest + 1
+        while True:
+            fn = self.name(no, ext)
+            try:
+                fd = os.open(fn, os.O_CREAT | os.O_EXCL | os.O_WRONLY, FILEMODE)
+            except FileExistsError:
+                # Taken by another rig since the directory was listed
+                sys.stdout.write("SESSIONINDEX: %s exists, trying next number\n" % fn)
+                no += 1
+                continue
+            os.close(fd)
+            self.highest = no
+            return fn, no
+
+def get_index(trunk):
+    """The index of trunk, listing its directory on first use"""
+    if trunk not in _indices:
+        _indices[trunk] = SessionIndex(trunk)
+    return _indices[trunk]
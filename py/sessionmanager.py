@@ -0,0 +1,120 @@
+"""Start and stop sessions without blocking the game loop
+
+Starting a session used to create directories, open its files, wait
+for comedi and copy settings inside one logic tick. A SessionManager
+moves that work to a worker thread:
+
+- prepare() opens the files of the next session of a kind in the
+  background, so that take() only hands them over when it starts;
+- submit() queues slow work (closing files, copying settings, writing
+  headers, talking to comedi). Jobs run one at a time in the order
+  they were submitted, so the jobs of one session always finish before
+  those of the next;
+- the event `armed` is set by a job once acquisition has started; the
+  game loop only checks it.
+"""
+
+import sys
+import time
+import threading
+import traceback
+try:
+    import queue
+except ImportError:
+    import Queue as queue
+
+_STOP = object()
+
+class SessionManager(object):
+    def __init__(self):
+        self.jobs = queue.Queue()
+        self.thread = None
+        self.prepared = {}
+        self.preparing = set()
+        self.cond = threading.Condition()
+        self.armed = threading.Event()
+        self.armed.set()
+
+        # statistics
+        self.njobs = 0
+        self.nfailed = 0
+        self.tjob_max = 0.0
+
+    def _run(self):
+        while True:
+            job = self.jobs.get()
+            if job is _STOP:
+                self.jobs.task_done()
+                break
+            name, func, args = job
+            t0 = time.time()
+            try:
+                func(*args)
+            except Exception:
+                self.nfailed += 1
+                sys.stderr.write("SESSION: %s failed:\n" % name)
+                traceback.print_exc()
+            self.njobs += 1
+            self.tjob_max = max(self.tjob_max, time.time()-t0)
+            self.jobs.task_done()
+
+    def submit(self, name, func, *args):
+        """Run func(*args) on the worker thread"""
+        if self.thread is None or not self.thread.is_alive():
+            self.thread = threading.Thread(target=self._run, name="sessionmanager")
+            self.thread.daemon = True
+            self.thread.start()
+        self.jobs.put((name, func, args))
+
+    def _prepare(self, kind, func):
+        try:
+            session = func()
+        finally:
+            with self.cond:
+                self.preparing.discard(kind)
+                self.cond.notify_all()
+        with self.cond:
+            self.prepared[kind] = session
+
+    def prepare(self, kind, func):
+        """Have func() open the files of the next session of this kind"""
+        with self.cond:
+            if kind in self.prepared or kind in self.preparing:
+                return
+            self.preparing.add(kind)
+        self.submit("preparing %s session" % kind, self._prepare, kind, func)
+
+    def take(self, kind, func):
+        """The prepared session of this kind. If it isn't ready yet, wait
+        for it; if none was prepared, or preparing it failed, prepare it
+        now"""
+        with self.cond:
+            while kind in self.preparing:
+                self.cond.wait()
+            session = self.prepared.pop(kind, None)
+        if session is None:
+            session = func()
+        return session
+
+    def discard(self, kind, func):
+        """Pass a session that was prepared but never started to func"""
+        with self.cond:
+            while kind in self.preparing:
+                self.cond.wait()
+            session = self.prepared.pop(kind, None)
+        if session is not None:
+            func(session)
+
+    def wait(self):
+        """Block until all submitted jobs have finished"""
+        if self.thread is not None and self.thread.is_alive():
+            self.jobs.join()
+
+    def stop(self):
+        if self.thread is not None and self.thread.is_alive():
+            self.jobs.put(_STOP)
+            self.thread.join()
+        if self.njobs:
+            sys.stdout.write("SESSION: %d jobs, %d failed, longest %.1f ms\n" % (
+                self.njobs, self.nfailed, self.tjob_max*1e3))
+            sys.stdout.flush()
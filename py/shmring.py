@@ -0,0 +1,163 @@
+"""Single-producer/single-consumer sample ring in POSIX shared memory
+
+The layout must match shm_ring in evread/readout.cpp:
+
+    offset   0  uint32  magic ("GNRB")
+    offset   4  uint32  version
+    offset   8  uint64  capacity (records)
+    offset  16  uint64  record size (bytes)
+    offset  64  uint64  head: number of records written by the producer
+    offset 128  uint64  tail: number of records consumed by the reader
+    offset 256          capacity records
+
+The producer never waits for the reader. It writes record n into slot
+n % capacity, overwriting record n-capacity, and only then publishes
+head = n+1. With head published, record head-capacity may therefore be
+half overwritten already, and the oldest record that is safe to read is
+head-capacity+1. The reader counts everything older as lost, both
+before and after it copies.
+"""
+
+import os
+import sys
+import mmap
+import time
+import numpy as np
+
+MAGIC = 0x42524e47
+VERSION = 1
+HEADER = 256
+OFFSET_HEAD = 64
+OFFSET_TAIL = 128
+CAPACITY = 4096 # records
+RECSIZE = 32 # [t, dt, x, y] as float64
+
+def shm_path(name):
+    return "/dev/shm/" + name.lstrip("/")
+
+class ShmRing(object):
+    def __init__(self, name, capacity=CAPACITY, recsize=RECSIZE, create=False):
+        self.name = name
+        self.path = shm_path(name)
+        self.owner = create
+        if create:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o600)
+            os.ftruncate(fd, HEADER + capacity*recsize)
+        else:
+            fd = os.open(self.path, os.O_RDWR)
+        self.mm = mmap.mmap(fd, 0)
+        os.close(fd)
+        hdr = np.frombuffer(self.mm, dtype=np.uint32, count=2)
+        cfg = np.frombuffer(self.mm, dtype=np.uint64, count=2, offset=8)
+        if create:
+            hdr[0] = MAGIC
+            hdr[1] = VERSION
+            cfg[0] = capacity
+            cfg[1] = recsize
+        elif hdr[0] != MAGIC or hdr[1] != VERSION:
+            raise ValueError("%s is not a version %d sample ring" % (self.path, VERSION))
+        self.capacity = int(cfg[0])
+        self.recsize = int(cfg[1])
+        self.head = np.frombuffer(self.mm, dtype=np.uint64, count=1, offset=OFFSET_HEAD)
+        self.tail = np.frombuffer(self.mm, dtype=np.uint64, count=1, offset=OFFSET_TAIL)
+        self.data = np.frombuffer(
+            self.mm, dtype=np.float64, count=self.capacity*self.recsize//8,
+            offset=HEADER).reshape((self.capacity, self.recsize//8))
+        # statistics
+        self.nrecords = 0
+        self.noverruns = 0
+
+    def read(self):
+        """Copy all unread records; returns (records, number of records lost)"""
+        head = int(self.head[0])
+        tail = int(self.tail[0])
+        nlost = 0
+        if head-tail >= self.capacity:
+            nlost = head-tail-self.capacity+1
+            tail = head-self.capacity+1
+        i0 = tail % self.capacity
+        i1 = head % self.capacity
+        if head == tail:
+            rec = self.data[:0].copy()
+        elif i0 < i1:
+            rec = self.data[i0:i1].copy()
+        else:
+            rec = np.concatenate((self.data[i0:], self.data[:i1]))
+        # Records the producer overwrote while we were copying are lost, too
+        nover = int(self.head[0]) - self.capacity + 1 - tail
+        if nover > 0:
+            rec = rec[nover:]
+            nlost += nover
+        self.tail[0] = head
+        self.nrecords += len(rec)
+        self.noverruns += nlost
+        return rec, nlost
+
+    def push(self, rec):
+        """Producer side, used for testing without readout"""
+        rec = np.atleast_2d(rec)
+        head = int(self.head[0])
+        for nr in range(rec.shape[0]):
+            self.data[(head+nr) % self.capacity] = rec[nr]
+        self.head[0] = head + rec.shape[0]
+
+    def close(self):
+        # Drop our views before unmapping
+        self.head = self.tail = self.data = None
+        try:
+            self.mm.close()
+        except BufferError:
+            pass
+        if self.owner and os.path.exists(self.path):
+            os.remove(self.path)
+
+def check_full(ring):
+    """Fill the ring to capacity-1 and to capacity records; in the second
+    case the oldest record may be the one being overwritten"""
+    results = []
+    for nrecords, nexpected in [(ring.capacity-1, ring.capacity-1),
+                                (ring.capacity, ring.capacity-1)]:
+        first = int(ring.head[0])
+        ring.push(np.outer(np.arange(first, first+nrecords), np.ones(ring.recsize//8)))
+        rec, nlost = ring.read()
+        results.append(len(rec) == nexpected and nlost == nrecords-nexpected and
+                       rec[0, 0] == first+nrecords-nexpected and
+                       rec[-1, 0] == first+nrecords-1)
+    ring.nrecords = ring.noverruns = 0
+    return all(results)
+
+if __name__ == "__main__":
+    # Synthetic producer at 1 kHz, reader at 100 Hz
+    name = "gnoom-shmring-test%d" % os.getpid()
+    duration = 5.0
+    if len(sys.argv) > 1:
+        duration = float(sys.argv[1])
+    ring = ShmRing(name, create=True)
+    sys.stdout.write("SHMRING: ring filled to capacity: %s\n" % (
+        "ok" if check_full(ring) else "FAILED"))
+    pid = os.fork()
+    if pid == 0:
+        producer = ShmRing(name)
+        t0 = time.time()
+        tprev = t0
+        while time.time()-t0 < duration:
+            t = time.time()
+            producer.push([t, t-tprev, 1.0, -1.0])
+            tprev = t
+            time.sleep(1e-3)
+        producer.close()
+        os._exit(0)
+    latencies = []
+    t0 = time.time()
+    while time.time()-t0 < duration + 0.1:
+        time.sleep(1e-2)
+        rec, nlost = ring.read()
+        if len(rec):
+            latencies.append(time.time()-rec[-1, 0])
+    os.waitpid(pid, 0)
+    sys.stdout.write(
+        "SHMRING: read %d records, %d lost, newest-sample age %.3f/%.3f ms (mean/max)\n" % (
+            ring.nrecords, ring.noverruns, np.mean(latencies)*1e3, np.max(latencies)*1e3))
+    ring.close()
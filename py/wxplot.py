@@ -46,6 +46,8 @@ from matplotlib.backends.backend_wxagg import \
 import numpy as np
 import pylab
 
+import scopestream
+
 def init_socket(sockname):
     s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
     connected = False
@@ -68,6 +70,62 @@ def init_socket(sockname):
 
     return s, blenderpath, connected
 
+class SweepBuffer(object):
+    """ Fixed-size buffer for one sweep of (min, max) pairs
+
+    The x values of a sweep are computed once when it starts; incoming
+    envelopes are written in place and bins that have not been filled
+    yet are NaN, so they are not drawn.
+    """
+    def __init__(self, plotsize):
+        self.plotsize = plotsize
+        self.dtbin = None
+        self.tsweep = 0.0
+
+    def resize(self, dtbin):
+        self.dtbin = dtbin
+        self.nbins = int(np.ceil(self.plotsize/dtbin))
+        self.xrel = np.repeat(np.arange(self.nbins)*dtbin, 2)
+        self.y = np.empty((2*self.nbins,))
+        self.start(self.tsweep)
+
+    def start(self, tsweep):
+        self.tsweep = tsweep
+        self.x = self.xrel + tsweep
+        self.y[:] = np.nan
+
+    def add(self, t0, dtbin, env):
+        """ Write one envelope message; returns True if a new sweep
+        was started
+        """
+        newsweep = False
+        if dtbin != self.dtbin:
+            self.resize(dtbin)
+            newsweep = True
+        ibin = int(round((t0-self.tsweep)/dtbin))
+        env = env.ravel()
+        while len(env):
+            if ibin < 0 or ibin >= self.nbins:
+                # Align the new sweep to a multiple of the sweep length
+                nsweep = np.floor((self.tsweep + ibin*dtbin)/(self.nbins*dtbin))
+                self.start(nsweep*self.nbins*dtbin)
+                ibin = int(round((t0-self.tsweep)/dtbin))
+                newsweep = True
+            n = min(self.nbins-ibin, len(env)//2)
+            self.y[2*ibin:2*(ibin+n)] = env[:2*n]
+            env = env[2*n:]
+            t0 += n*dtbin
+            ibin += n
+        return newsweep
+
+    def limits(self):
+        """ Range of the data in this sweep, or None if it is empty
+        """
+        valid = self.y[np.isfinite(self.y)]
+        if not len(valid):
+            return None
+        return np.min(valid), np.max(valid)
+
 class GraphFrame(wx.Frame):
     """ The main frame of the application
     """
@@ -77,23 +135,44 @@ class GraphFrame(wx.Frame):
         wx.Frame.__init__(self, None, -1, self.title, (1280,0))
         
         self.dt = dt
-        self.tinterval = 50.0e-3
+        self.tinterval = 20.0e-3
+        self.maxfps = 20.0
         self.plotsize = 1000.0e-3
         self.rectime = 0.0
-        self.dataIC = np.array([0,0])
-        self.dataFR = np.array([0,0])
-        self.dataEC = np.array([0,0])
+        self.buffers = [SweepBuffer(self.plotsize) for nch in range(3)]
         self.sockic, self.blenderpath, self.connected = init_socket("\0icsocket%d" % sockno)
         self.sockec, self.blenderpath, self.connected = init_socket("\0ecsocket%d" % sockno)
         self.sockfr, self.blenderpath, self.connected = init_socket("\0frsocket%d" % sockno)
+        self.readers = [scopestream.Reader() for nch in range(3)]
         self.t_disconnect = time.time()
         self.create_main_panel()
+        self.axes = [self.axesIC, self.axesEC, self.axesFR]
+        self.lines = [self.plot_dataIC, self.plot_dataEC, self.plot_dataFR]
+        self.backgrounds = None
+        self.tdraw = 0
         
         self.redraw_timer = wx.Timer(self)
         self.Bind(wx.EVT_TIMER, self.on_redraw_timer, self.redraw_timer)        
         self.redraw_timer.Start(self.tinterval * 1e3)
+        self.Bind(wx.EVT_SIZE, self.on_size)
 
         self.draw_plot()
+        self.send_width()
+
+    def send_width(self):
+        """Ask nicomedi for one (min, max) pair per screen pixel"""
+        width = max(int(self.axesIC.bbox.width), 1)
+        try:
+            self.sockic.send(scopestream.pack(
+                scopestream.WIDTH, width, 0.0, self.plotsize/width))
+        except socket.error:
+            pass
+
+    def on_size(self, event):
+        event.Skip()
+        # Cached backgrounds no longer match the canvas
+        self.backgrounds = None
+        wx.CallAfter(self.send_width)
 
     def create_main_panel(self):
         self.panel = wx.Panel(self)
@@ -119,8 +198,9 @@ class GraphFrame(wx.Frame):
         # plot the data as a line series, and save the reference 
         # to the plotted line series
         self.plot_dataIC = self.axesIC.plot(
-            np.arange(len(self.dataFR))*self.dt, self.dataIC, 
+            [], [],
             linewidth=1,
+            animated=True,
             color=(1, 1, 0),
             )[0]
         xmax = self.plotsize + self.tinterval*5.0
@@ -136,8 +216,9 @@ class GraphFrame(wx.Frame):
         # plot the data as a line series, and save the reference 
         # to the plotted line series
         self.plot_dataEC = self.axesEC.plot(
-            np.arange(len(self.dataEC))*self.dt, self.dataEC, 
+            [], [],
             linewidth=1,
+            animated=True,
             color=(1, 1, 0),
             )[0]
         xmax = self.plotsize + self.tinterval*5.0
@@ -154,8 +235,9 @@ class GraphFrame(wx.Frame):
         # plot the data as a line series, and save the reference 
         # to the plotted line series
         self.plot_dataFR = self.axesFR.plot(
-            np.arange(len(self.dataFR))*self.dt, self.dataFR, 
+            [], [],
             linewidth=1,
+            animated=True,
             color=(1, 1, 0),
             )[0]
         xmax = self.plotsize + self.tinterval*5.0
@@ -165,104 +247,78 @@ class GraphFrame(wx.Frame):
         self.axesFR.grid(True, color='gray')
 
     def draw_plot(self):
-        """ Redraws the plot
+        """ Redraws the whole figure and caches the background of each
+        axes for blitting
         """
-        self.plot_dataIC.set_xdata(np.arange(len(self.dataIC))*self.dt + self.rectime)
-        self.plot_dataIC.set_ydata(np.array(self.dataIC))
+        for line, buf in zip(self.lines, self.buffers):
+            if buf.dtbin is not None:
+                line.set_data(buf.x, buf.y)
+        self.canvas.draw()
+        self.backgrounds = [self.canvas.copy_from_bbox(axes.bbox) for axes in self.axes]
+        self.blit_plot()
 
-        self.plot_dataEC.set_xdata(np.arange(len(self.dataEC))*self.dt + self.rectime)
-        self.plot_dataEC.set_ydata(np.array(self.dataEC))
+    def blit_plot(self):
+        """ Redraws only the lines over the cached backgrounds
+        """
+        for axes, line, buf, background in zip(
+                self.axes, self.lines, self.buffers, self.backgrounds):
+            if buf.dtbin is None:
+                continue
+            self.canvas.restore_region(background)
+            line.set_data(buf.x, buf.y)
+            axes.draw_artist(line)
+            self.canvas.blit(axes.bbox)
+        self.tdraw = time.time()
 
-        self.plot_dataFR.set_xdata(np.arange(len(self.dataFR))*self.dt + self.rectime)
-        self.plot_dataFR.set_ydata(np.array(self.dataFR))
-        
-        self.canvas.draw()
-    
     def on_redraw_timer(self, event):
-        reset = False
-        replot = False
-        if len(self.dataIC) > self.plotsize/self.dt:
-            reset = True
-        datadec = ""
-        try:
-            data = self.sockic.recv(32768)
-            datadec = data.decode('latin-1')
-            has_data = True
-        except:
-            has_data = False
-        if has_data and datadec.find('quit') != -1:
-            sys.stdout.write("WXPLOT: Received termination signal... ")
-            sys.stdout.flush()
-            self.fig.clear()
-            self.sockic.send(b"close")
-            self.sockic.close()
-            self.sockec.close()
-            self.sockfr.close()
-            self.Destroy()
-            sys.exit(0)
-        elif has_data and datadec.find('begin') != -1:
-            self.rectime = 0
-            sys.stdout.write("WXPLOT: Starting new plot\n")
-        elif has_data and datadec.find('alive')==-1 and len(data)>0:
-            tmpIC = np.fromstring(data, dtype=np.float32)
-            if reset:
-                self.rectime += len(self.dataIC) * self.dt
-                self.dataIC = np.empty((0))
-            self.dataIC = np.concatenate([self.dataIC, tmpIC])
-            if reset:
-                xmin = self.rectime
-                xmax = self.rectime + self.plotsize + self.tinterval*5.0
-                ymin = np.min(self.dataIC)
-                ymax = np.max(self.dataIC)
-                amp = ymax-ymin
-                self.axesIC.set_xbound(lower=xmin, upper=xmax)
-                self.axesIC.set_ybound(lower=ymin-0.5*amp, upper=ymax+0.5*amp)
-            replot = True
-
-        reset = False
-        if len(self.dataEC) > self.plotsize/self.dt:
-            self.dataEC = np.empty((0))
-            reset = True
-        try:
-            dataec = self.sockec.recv(32768)
-            has_dataec = True
-        except:
-            has_dataec = False
-
-        if has_dataec and len(dataec)>0:
-            tmpEC = np.fromstring(dataec, dtype=np.float32)
-            self.dataEC = np.concatenate([self.dataEC, tmpEC])
-            if reset:
-                xmin = self.rectime
-                xmax = self.rectime + self.plotsize + self.tinterval*5.0
-                ymin = np.min(self.dataEC)
-                ymax = np.max(self.dataEC)
-                amp = ymax-ymin
-                self.axesEC.set_xbound(lower=xmin, upper=xmax)
-                self.axesEC.set_ybound(lower=ymin-0.5*amp, upper=ymax+0.5*amp)
-
-        reset = False
-        if len(self.dataFR) > self.plotsize/self.dt:
-            self.dataFR = np.empty((0))
-            reset = True
-        try:
-            datafr = self.sockfr.recv(32768)
-            has_datafr = True
-        except:
-            has_datafr = False
-
-        if has_datafr and len(datafr)>0:
-            tmpFR = np.fromstring(datafr, dtype=np.int8)
-            self.dataFR = np.concatenate([self.dataFR, tmpFR])
-            if reset:
-                xmin = self.rectime
-                xmax = self.rectime + self.plotsize + self.tinterval*5.0
-                self.axesFR.set_xbound(lower=xmin, upper=xmax)
+        msgs = [reader.read(sock) for reader, sock in
+                zip(self.readers, [self.sockic, self.sockec, self.sockfr])]
+        fullredraw = self.backgrounds is None
+        for kind, t0, dtbin, env in msgs[0]:
+            if kind == scopestream.QUIT:
+                sys.stdout.write("WXPLOT: Received termination signal... ")
+                sys.stdout.flush()
+                self.fig.clear()
+                self.sockic.send(scopestream.pack(scopestream.CLOSE))
+                self.sockic.close()
+                self.sockec.close()
+                self.sockfr.close()
+                self.Destroy()
+                sys.exit(0)
+            elif kind == scopestream.BEGIN:
+                self.rectime = 0
+                for buf in self.buffers:
+                    if buf.dtbin is not None:
+                        buf.start(0.0)
+                self.axesIC.set_xbound(lower=0, upper=self.plotsize + self.tinterval*5.0)
+                fullredraw = True
+                sys.stdout.write("WXPLOT: Starting new plot\n")
 
-        if replot:
+        replot = False
+        for nch, chmsgs in enumerate(msgs):
+            buf = self.buffers[nch]
+            for kind, t0, dtbin, env in chmsgs:
+                if kind != scopestream.DATA:
+                    continue
+                # Scale to the sweep that just finished
+                limits = buf.limits()
+                if buf.add(t0, dtbin, env):
+                    fullredraw = True
+                    if nch == 0:
+                        self.rectime = buf.tsweep
+                        self.axesIC.set_xbound(
+                            lower=self.rectime,
+                            upper=self.rectime + self.plotsize + self.tinterval*5.0)
+                    if nch < 2 and limits is not None:
+                        ymin, ymax = limits
+                        amp = ymax-ymin
+                        self.axes[nch].set_ybound(lower=ymin-0.5*amp, upper=ymax+0.5*amp)
+                replot = True
+
+        if fullredraw:
             self.draw_plot()
-        else:
-            time.sleep(1e-4)
+        elif replot and time.time()-self.tdraw > 1.0/self.maxfps:
+            self.blit_plot()
 
 class GraphApp(wx.PySimpleApp):
 